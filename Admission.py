@@ -0,0 +1,130 @@
+import threading
+from collections import deque
+from time import perf_counter
+from Instrumentation import get_logger
+
+logger = get_logger('admission')
+
+# Lower numbers are served first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BULK)
+
+
+class QueuedRequest:
+    def __init__(self, priority, task, reject, deadline):
+        self.priority = priority
+        self.task = task
+        self.reject = reject
+        # perf_counter() after which the request is no longer worth running
+        self.deadline = deadline
+        self.queued = perf_counter()
+
+
+class AdmissionQueue:
+    # Bounded, prioritised queue in front of a fixed pool of worker threads. A full queue makes
+    # room for a request by dropping the newest one of a lower priority, or turns the request
+    # away; either way the dropped request is answered at once with an "Overloaded" response
+    # telling the client when to try again, instead of waiting behind work it cannot overtake
+    def __init__(self, workers=32, max_depth=1024, metrics=None, max_retry_after=5.0):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.metrics = metrics
+        self.max_retry_after = max_retry_after
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.queues = {priority: deque() for priority in PRIORITIES}
+        self.depth = 0
+        self.busy = 0
+        self.idle = 0
+        # Moving average of how long a request keeps a worker, for the retry_after hint
+        self.service_time = 0.001
+        self.admitted = 0
+        self.rejected = 0
+        self.shed = 0
+        self.expired = 0
+        # Workers are started as the load needs them, up to `workers`
+        self.threads = []
+
+    def retry_after(self):
+        # Roughly how long the work queued now takes to drain
+        wait = (self.depth + self.busy) * self.service_time / self.workers
+        return round(min(self.max_retry_after, max(0.01, wait)), 3)
+
+    def overloaded(self, message):
+        return {"status": "Overloaded", "retry_after": self.retry_after(), "message": message}
+
+    def submit(self, priority, task, reject, deadline=None, force=False):
+        # Queues `task` (called with no arguments by a worker) or answers through `reject`.
+        # `deadline` is a budget in seconds for waiting in the queue; forced requests are
+        # always queued, for work whose refusal would stall others
+        request = QueuedRequest(priority, task, reject, None if deadline is None else perf_counter() + deadline)
+        victim = None
+        with self.lock:
+            if self.depth >= self.max_depth and not force:
+                lower = next((p for p in reversed(PRIORITIES) if p > priority and self.queues[p]), None)
+                if lower is None:
+                    self.rejected += 1
+                    victim, reason = request, "rejected"
+                else:
+                    self.shed += 1
+                    self.depth -= 1
+                    victim, reason = self.queues[lower].pop(), "shed"
+                response = self.overloaded(f"{self.depth} requests queued, try again later")
+            if victim is not request:
+                self.queues[priority].append(request)
+                self.depth += 1
+                self.admitted += 1
+                if not self.idle and len(self.threads) < self.workers:
+                    thread = threading.Thread(target=self.run, daemon=True)
+                    self.threads.append(thread)
+                    thread.start()
+                self.ready.notify()
+        if victim is not None:
+            if self.metrics is not None:
+                self.metrics.inc(f"admission.{reason}")
+            victim.reject(response)
+        return victim is not request
+
+    def next_request(self):
+        with self.lock:
+            self.idle += 1
+            while not self.depth:
+                self.ready.wait()
+            self.idle -= 1
+            request = next(self.queues[priority] for priority in PRIORITIES if self.queues[priority]).popleft()
+            self.depth -= 1
+            self.busy += 1
+            return request
+
+    def run(self):
+        while True:
+            request = self.next_request()
+            started = perf_counter()
+            if self.metrics is not None:
+                self.metrics.observe('queue_wait.request', started - request.queued)
+                self.metrics.observe(f"queue_wait.priority{request.priority}", started - request.queued)
+            try:
+                if request.deadline is not None and started > request.deadline:
+                    with self.lock:
+                        self.expired += 1
+                        response = self.overloaded("Request waited past its deadline")
+                    if self.metrics is not None:
+                        self.metrics.inc('admission.expired')
+                    request.reject(response)
+                else:
+                    request.task()
+            except Exception:
+                logger.exception("Queued request failed")
+            with self.lock:
+                self.busy -= 1
+                self.service_time = 0.9 * self.service_time + 0.1 * (perf_counter() - started)
+
+    def stats(self):
+        with self.lock:
+            return {"depth": self.depth, "busy": self.busy, "workers": len(self.threads), "max_workers": self.workers,
+                    "max_depth": self.max_depth,
+                    "depth_by_priority": {priority: len(queue) for priority, queue in self.queues.items()},
+                    "admitted": self.admitted, "rejected": self.rejected, "shed": self.shed, "expired": self.expired,
+                    "retry_after": self.retry_after()}
@@ -0,0 +1,149 @@
+import glob
+import json
+import sqlite3
+import threading
+from datetime import date, timedelta
+from time import sleep, perf_counter
+from Instrumentation import get_logger
+
+logger = get_logger('archive')
+
+LOAN_COLUMNS = "loan_id, book_id, user_id, borrow_date, return_date, due_date"
+# Oldest returns first, through idx_loans_return_due
+SQL_ARCHIVABLE = (f"SELECT {LOAN_COLUMNS} FROM Loans WHERE return_date IS NOT NULL AND return_date < ? "
+                  "ORDER BY return_date LIMIT ?")
+SQL_ARCHIVE_LOAN = f"INSERT INTO Loans ({LOAN_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(loan_id) DO NOTHING"
+# Only loans that are still returned: a row reopened in the meantime stays hot
+SQL_DELETE_ARCHIVED = ("DELETE FROM Loans WHERE return_date IS NOT NULL "
+                       "AND loan_id IN (SELECT value FROM json_each(?))")
+# Filters of archive queries, as in track_loans pages
+HISTORY_FILTERS = {'loan_id': " AND loan_id = ?", 'book_id': " AND book_id = ?", 'user_id': " AND user_id = ?"}
+
+
+def archive_path(db_name, month):
+    return f"{db_name}.archive-{month}"
+
+
+def archive_months(db_name):
+    prefix = archive_path(db_name, '')
+    return sorted(path[len(prefix):] for path in glob.glob(glob.escape(prefix) + '[0-9]*')
+                  if not path.endswith(('-wal', '-shm', '-journal')))
+
+
+def open_archive(db_name, month):
+    conn = sqlite3.connect(archive_path(db_name, month))
+    conn.execute('''CREATE TABLE IF NOT EXISTS Loans (
+                        loan_id INTEGER PRIMARY KEY,
+                        book_id INTEGER,
+                        user_id INTEGER,
+                        borrow_date DATE,
+                        return_date DATE,
+                        due_date DATE)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archive_user ON Loans (user_id, loan_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archive_book ON Loans (book_id, loan_id)")
+    return conn
+
+
+def query_archives(db_name, parameters):
+    # Archived loans matching the filters, from the months in [since, until] ('YYYY-MM', both
+    # optional). Months are those of the return date
+    since, until = parameters.get('since'), parameters.get('until')
+    sql = f"SELECT {LOAN_COLUMNS} FROM Loans WHERE 1"
+    arguments = []
+    for name, condition in HISTORY_FILTERS.items():
+        if parameters.get(name) is not None:
+            sql += condition
+            arguments.append(parameters[name])
+    rows = []
+    for month in archive_months(db_name):
+        if since and month < since or until and month > until:
+            continue
+        conn = sqlite3.connect(f"file:{archive_path(db_name, month)}?mode=ro", uri=True)
+        try:
+            rows += conn.execute(sql, arguments).fetchall()
+        finally:
+            conn.close()
+    return rows
+
+
+class LoanArchiver:
+    # Moves loans returned more than `horizon` days ago out of the hot Loans table into one
+    # archive file per month of return. Each batch is copied first and deleted from Loans
+    # after, each in its own short transaction: a crash in between leaves the rows in both
+    # places, which the next batch and history queries both tolerate. Batches are paced to at
+    # most `rate` rows per second so foreground hops keep the write lock most of the time
+    def __init__(self, server, horizon, batch_size=500, rate=5000, interval=60.0, today=None):
+        self.server = server
+        self.horizon = horizon
+        self.batch_size = batch_size
+        self.rate = rate
+        self.interval = interval
+        # Injectable for tests; date.today otherwise
+        self.today = today or date.today
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.archived = 0
+        self.batches = 0
+        self.last_run = None
+
+    def cutoff(self):
+        return (self.today() - timedelta(days=self.horizon)).isoformat()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.archive()
+            except Exception as e:
+                logger.warning("Archiving loans of %s failed: %s", self.server.db_name, e)
+            self.stopped.wait(self.interval)
+
+    def archive(self):
+        # One pass over everything past the horizon; returns how many loans were moved
+        cutoff = self.cutoff()
+        moved = 0
+        while not self.stopped.is_set():
+            started = perf_counter()
+            count = self.archive_batch(cutoff)
+            moved += count
+            if count < self.batch_size:
+                break
+            # Pace the batches: a batch of n rows may start no sooner than n / rate seconds
+            # after the previous one did
+            sleep(max(0.0, count / self.rate - (perf_counter() - started)))
+        with self.lock:
+            self.last_run = {"cutoff": cutoff, "moved": moved}
+        if moved:
+            logger.info("Archived %s loans of %s returned before %s", moved, self.server.db_name, cutoff)
+        return moved
+
+    def archive_batch(self, cutoff):
+        with self.server.pool.connection() as conn:
+            rows = conn.execute(SQL_ARCHIVABLE, (cutoff, self.batch_size)).fetchall()
+        if not rows:
+            return 0
+        months = {}
+        for row in rows:
+            months.setdefault(row[4][:7], []).append(row)
+        for month, loans in months.items():
+            archive = open_archive(self.server.db_name, month)
+            try:
+                with archive:
+                    archive.executemany(SQL_ARCHIVE_LOAN, loans)
+            finally:
+                archive.close()
+        with self.server.pool.connection() as conn:
+            conn.execute(SQL_DELETE_ARCHIVED, (json.dumps([row[0] for row in rows]),))
+            conn.commit()
+        with self.lock:
+            self.archived += len(rows)
+            self.batches += 1
+        self.server.metrics.inc('archive.loans', len(rows))
+        return len(rows)
+
+    def stop(self):
+        self.stopped.set()
+
+    def stats(self):
+        with self.lock:
+            return {"archived": self.archived, "batches": self.batches, "horizon_days": self.horizon,
+                    "months": len(archive_months(self.server.db_name)), "last_run": self.last_run}
@@ -0,0 +1,424 @@
+import argparse
+import bisect
+import json
+import math
+import multiprocessing
+import os
+import queue
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from time import perf_counter, sleep
+from Database import create_database
+from Partition import PartitionDirectory
+from Client import BaseClient, OriginOrderClient
+from Server import BaseServer, OriginOrderServer
+from ShardedServer import ShardedServer, shard_files
+
+LIBRARIES = {'Library A': 1000, 'Library B': 2000, 'Library C': 3000}
+
+DEFAULT_MIX = {'borrow_book': 0.35, 'return_book': 0.25, 'query_user': 0.2, 'track_loans': 0.05,
+               'add_user': 0.05, 'add_book': 0.05, 'delete_book': 0.05}
+
+SYSTEMS = {
+    'base': (BaseServer, BaseClient),
+    'origin': (OriginOrderServer, OriginOrderClient),
+    # Each library runs subshards=N worker processes (default: one per core)
+    'sharded': (ShardedServer, BaseClient),
+}
+
+
+class ZipfKeys:
+    # Draws keys with P(rank k) proportional to 1 / k**s; s = 0 is uniform
+    def __init__(self, keys, s=1.0, rng=None):
+        self.keys = list(keys)
+        self.rng = rng or random.Random()
+        weights = [1.0 / (rank ** s) for rank in range(1, len(self.keys) + 1)]
+        total = 0.0
+        self.cumulative = []
+        for weight in weights:
+            total += weight
+            self.cumulative.append(total)
+
+    def draw(self):
+        index = bisect.bisect_left(self.cumulative, self.rng.random() * self.cumulative[-1])
+        return self.keys[min(index, len(self.keys) - 1)]
+
+
+class WorkloadGenerator:
+    # Synthesizes workload records: one JSON object per line with a request_id, like the
+    # lines of requests.jsonl, plus the transaction type, the issuing library and parameters
+    def __init__(self, mix=DEFAULT_MIX, books_per_library=1000, zipf=1.0, seed=None):
+        self.rng = random.Random(seed)
+        self.types = list(mix)
+        self.weights = [mix[name] for name in self.types]
+        book_ids = [base_id + offset for base_id in LIBRARIES.values() for offset in range(1, books_per_library + 1)]
+        self.rng.shuffle(book_ids)
+        self.books = ZipfKeys(book_ids, zipf, self.rng)
+        self.next_id = 1
+        self.next_book = 900000
+        self.next_user = 900000
+
+    def record(self):
+        type = self.rng.choices(self.types, self.weights)[0]
+        location = self.rng.choice(list(LIBRARIES))
+        user_id = LIBRARIES[location] + self.rng.randint(1, 3)
+        if type in ('borrow_book', 'return_book', 'delete_book'):
+            book_id = self.books.draw()
+        if type == 'borrow_book':
+            params = {'book_id': book_id, 'user_id': user_id, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'}
+        elif type == 'return_book':
+            params = {'book_id': book_id, 'return_date': '2023-02-10'}
+        elif type == 'delete_book':
+            params = {'book_id': book_id}
+        elif type == 'add_book':
+            self.next_book += 1
+            params = {'book_id': self.next_book, 'title': f"Book {self.next_book}", 'author': 'Author',
+                      'publication_date': '2023-01-01', 'category': 'Fiction', 'status': 'Available'}
+        elif type == 'add_user':
+            self.next_user += 1
+            params = {'user_id': self.next_user, 'name': f"User {self.next_user}",
+                      'email': f"user{self.next_user}@example.com", 'membership': location}
+        elif type == 'query_user':
+            params = {'user_id': user_id}
+        else:
+            params = {}
+        record = {'request_id': f"t-{self.next_id}", 'type': type, 'location': location, 'params': params}
+        self.next_id += 1
+        return record
+
+    def __iter__(self):
+        while True:
+            yield self.record()
+
+
+def load_workload(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def save_workload(path, records):
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def percentile(sorted_values, q):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(round(q / 100 * len(sorted_values), 9)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies):
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "mean_ms": sum(values) / len(values) * 1000 if values else None,
+        "p50_ms": percentile(values, 50) * 1000 if values else None,
+        "p99_ms": percentile(values, 99) * 1000 if values else None,
+        "p999_ms": percentile(values, 99.9) * 1000 if values else None,
+        "max_ms": values[-1] * 1000 if values else None,
+    }
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.transactions = {}
+        self.hops = {}
+        self.committed = {}
+        self.aborted = {}
+        self.errors = {}
+
+    def transaction(self, type, latency, outcome):
+        with self.lock:
+            self.transactions.setdefault(type, []).append(latency)
+            counts = {True: self.committed, False: self.aborted}.get(outcome, self.errors)
+            counts[type] = counts.get(type, 0) + 1
+
+    def hop(self, action, latency):
+        with self.lock:
+            self.hops.setdefault(action, []).append(latency)
+
+    def timed_send_hop(self, send_hop):
+        def send(server, hop, *args, **kwargs):
+            start = perf_counter()
+            try:
+                return send_hop(server, hop, *args, **kwargs)
+            finally:
+                self.hop(hop.action, perf_counter() - start)
+        return send
+
+
+def prepare_databases(directory, books_per_library):
+    for name, base_id in LIBRARIES.items():
+        path = os.path.join(directory, name)
+        create_database(path, base_id)
+        books = [(base_id + offset, f"Book {offset}", 'Author', '2023-01-01', 'Fiction', 'Available')
+                 for offset in range(4, books_per_library + 1)]
+        with sqlite3.connect(path) as conn:
+            conn.executemany("INSERT INTO Books (book_id, title, author, publication_date, category, status) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", books)
+
+
+def run_servers(system, directory, server_options, addresses):
+    # Runs in its own process so server work does not compete with the clients for the GIL
+    os.chdir(directory)
+    server_class = SYSTEMS[system][0]
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        servers = {name: server_class('localhost', 0, name, **server_options) for name in LIBRARIES}
+        peers = {name: server.socket.getsockname() for name, server in servers.items()}
+        for server in servers.values():
+            server.peers = peers
+            threading.Thread(target=server.start, daemon=True).start()
+        addresses.put(peers)
+        threading.Event().wait()
+
+
+def check_consistency(directory, subshards=None):
+    # Every library keeps a full copy of Loans, and every borrowed book needs its open loan.
+    # A sharded library's rows are the union of its sub-shard files
+    tables = {}
+    borrowed = {}
+    for name in LIBRARIES:
+        path = os.path.join(directory, name)
+        tables[name] = {}
+        borrowed[name] = []
+        for file in (shard_files(path, subshards) if subshards else [path]):
+            with sqlite3.connect(file) as conn:
+                tables[name].update((row[0], row) for row in conn.execute(
+                    "SELECT loan_id, book_id, user_id, borrow_date, return_date, due_date FROM Loans"))
+                borrowed[name] += conn.execute("SELECT book_id, loan_id FROM Books WHERE status = 'Borrowed'").fetchall()
+
+    loan_ids = set().union(*(loans.keys() for loans in tables.values()))
+    mismatched = sorted(loan_id for loan_id in loan_ids
+                        if len({loans.get(loan_id) for loans in tables.values()}) > 1)
+    dangling = [{"library": name, "book_id": book_id, "loan_id": loan_id}
+                for name, rows in borrowed.items() for book_id, loan_id in rows
+                if any(loan_id not in loans or loans[loan_id][4] is not None for loans in tables.values())]
+    return {
+        "consistent": not mismatched and not dangling,
+        "loans": {name: len(loans) for name, loans in tables.items()},
+        "mismatched_loans": len(mismatched),
+        "mismatched_sample": mismatched[:10],
+        "borrowed_without_open_loan": len(dangling),
+        "borrowed_sample": dangling[:10],
+    }
+
+
+class Benchmark:
+    def __init__(self, system='base', clients=8, mode='closed', rate=100.0, duration=10.0, transactions=None,
+                 workload=None, mix=DEFAULT_MIX, zipf=1.0, books_per_library=1000, seed=None,
+                 server_options=None, client_options=None, verbose=False):
+        self.system = system
+        self.clients = clients
+        self.mode = mode
+        self.rate = rate
+        self.duration = duration
+        self.transactions = transactions
+        self.workload = workload
+        self.mix = mix
+        self.zipf = zipf
+        self.books_per_library = books_per_library
+        self.seed = seed
+        self.server_options = server_options or {}
+        self.client_options = client_options or {}
+        self.verbose = verbose
+        self.recorder = Recorder()
+        self.records_lock = threading.Lock()
+
+    def records(self):
+        if self.workload is not None:
+            records = load_workload(self.workload)
+        else:
+            records = iter(WorkloadGenerator(self.mix, self.books_per_library, self.zipf, self.seed))
+        for count, record in enumerate(records):
+            if self.transactions is not None and count >= self.transactions:
+                return
+            yield record
+
+    def next_record(self, records):
+        with self.records_lock:
+            return next(records, None)
+
+    def execute(self, clients, record, intended_start=None):
+        client = clients[record['location']]
+        transaction_id = int(str(record['request_id']).rsplit('-', 1)[-1])
+        start = intended_start if intended_start is not None else perf_counter()
+        try:
+            outcome = getattr(client, record['type'])(transaction_id, record['params'])
+        except Exception as e:
+            outcome = None
+            if self.verbose:
+                print(f"{record['request_id']} raised {e}", file=sys.stderr)
+        # Open-loop latency counts from the intended start, so queueing behind slow requests shows
+        self.recorder.transaction(record['type'], perf_counter() - start, outcome)
+
+    def closed_loop(self, clients, records, deadline):
+        def worker():
+            while perf_counter() < deadline:
+                record = self.next_record(records)
+                if record is None:
+                    return
+                self.execute(clients, record)
+        threads = [threading.Thread(target=worker) for _ in range(self.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def open_loop(self, clients, records, deadline):
+        # Poisson arrivals at `rate` per second, independent of how fast requests complete
+        rng = random.Random(self.seed)
+        with ThreadPoolExecutor(max_workers=max(self.clients, 64)) as executor:
+            next_arrival = perf_counter()
+            while next_arrival < deadline:
+                record = self.next_record(records)
+                if record is None:
+                    break
+                delay = next_arrival - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+                executor.submit(self.execute, clients, record, next_arrival)
+                next_arrival += rng.expovariate(self.rate)
+
+    def run(self):
+        server_class, client_class = SYSTEMS[self.system]
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                prepare_databases(directory, self.books_per_library)
+            addresses = multiprocessing.Queue()
+            # Sharded libraries start worker processes, which a daemonic process may not
+            servers = multiprocessing.Process(target=run_servers, daemon=self.system != 'sharded',
+                                              args=(self.system, directory, self.server_options, addresses))
+            servers.start()
+            try:
+                peers = addresses.get(timeout=30)
+            except queue.Empty:
+                servers.terminate()
+                raise RuntimeError("Servers did not start")
+
+            try:
+                output = sys.stdout if self.verbose else open(os.devnull, 'w')
+                with redirect_stdout(output):
+                    clients = {name: client_class(peers, base_id + 100, name, directory=PartitionDirectory(list(peers)),
+                                                  **self.client_options)
+                               for name, base_id in LIBRARIES.items()}
+                    for client in clients.values():
+                        client.send_hop = self.recorder.timed_send_hop(client.send_hop)
+
+                    records = self.records()
+                    started = perf_counter()
+                    deadline = started + self.duration
+                    if self.mode == 'open':
+                        self.open_loop(clients, records, deadline)
+                    else:
+                        self.closed_loop(clients, records, deadline)
+                    elapsed = perf_counter() - started
+                    # Let chained forwards and skip notices still in flight land before checking
+                    sleep(0.5)
+                    for client in clients.values():
+                        client.close()
+                subshards = None
+                if self.system == 'sharded':
+                    subshards = self.server_options.get('subshards') or os.cpu_count()
+                consistency = check_consistency(directory, subshards)
+            finally:
+                servers.terminate()
+                servers.join()
+
+        return self.report(elapsed, clients, consistency)
+
+    def report(self, elapsed, clients, consistency):
+        recorder = self.recorder
+        total = sum(len(latencies) for latencies in recorder.transactions.values())
+        committed = sum(recorder.committed.values())
+        return {
+            "config": {
+                "system": self.system, "clients": self.clients, "mode": self.mode,
+                "rate": self.rate if self.mode == 'open' else None, "duration": self.duration,
+                "workload": self.workload, "mix": self.mix if self.workload is None else None,
+                "zipf": self.zipf, "books_per_library": self.books_per_library, "seed": self.seed,
+                "server_options": self.server_options, "client_options": self.client_options,
+            },
+            "elapsed": elapsed,
+            "transactions": total,
+            "throughput": total / elapsed if elapsed else 0.0,
+            "committed_throughput": committed / elapsed if elapsed else 0.0,
+            "aborts": sum(recorder.aborted.values()),
+            "errors": sum(recorder.errors.values()),
+            "retries": sum(client.retries for client in clients.values()),
+            "per_type": {type: dict(summarize(latencies), committed=recorder.committed.get(type, 0),
+                                    aborted=recorder.aborted.get(type, 0), errors=recorder.errors.get(type, 0))
+                         for type, latencies in sorted(recorder.transactions.items())},
+            "per_hop": {action: summarize(latencies) for action, latencies in sorted(recorder.hops.items())},
+            "consistency": consistency,
+        }
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, weight = part.split('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def parse_options(pairs):
+    options = {}
+    for pair in pairs or []:
+        key, value = pair.split('=', 1)
+        try:
+            options[key] = json.loads(value)
+        except json.JSONDecodeError:
+            options[key] = value
+    return options
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive local library servers with a synthetic or recorded workload")
+    parser.add_argument('--system', choices=sorted(SYSTEMS), default='base')
+    parser.add_argument('--clients', type=int, default=8, help="closed-loop concurrency")
+    parser.add_argument('--mode', choices=['closed', 'open'], default='closed')
+    parser.add_argument('--rate', type=float, default=100.0, help="open-loop arrivals per second")
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--transactions', type=int, default=None, help="stop after this many transactions")
+    parser.add_argument('--workload', help="replay records from this JSONL file instead of synthesizing them")
+    parser.add_argument('--record', help="write the synthesized records to this JSONL file and exit")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help="e.g. borrow_book=0.5,query_user=0.5")
+    parser.add_argument('--zipf', type=float, default=1.0, help="skew of book_id popularity, 0 is uniform")
+    parser.add_argument('--books', type=int, default=1000, help="books per library")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--server-option', action='append', metavar='KEY=VALUE', help="e.g. group_commit=true")
+    parser.add_argument('--client-option', action='append', metavar='KEY=VALUE', help="e.g. chained=true")
+    parser.add_argument('--output', help="write the JSON report here as well as to stdout")
+    parser.add_argument('--verbose', action='store_true', help="keep client output")
+    args = parser.parse_args(argv)
+
+    if args.record:
+        generator = WorkloadGenerator(args.mix, args.books, args.zipf, args.seed)
+        save_workload(args.record, (generator.record() for _ in range(args.transactions or 10000)))
+        return
+
+    benchmark = Benchmark(system=args.system, clients=args.clients, mode=args.mode, rate=args.rate,
+                          duration=args.duration, transactions=args.transactions, workload=args.workload,
+                          mix=args.mix, zipf=args.zipf, books_per_library=args.books, seed=args.seed,
+                          server_options=parse_options(args.server_option),
+                          client_options=parse_options(args.client_option), verbose=args.verbose)
+    report = json.dumps(benchmark.run(), indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
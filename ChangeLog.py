@@ -0,0 +1,186 @@
+import threading
+from time import time
+from Instrumentation import get_logger
+
+logger = get_logger('change_log')
+
+# Seconds an entry is kept after every peer has applied it; longer than a snapshot may take to
+# be fetched and restored (SnapshotStore's ttl is five minutes)
+DEFAULT_RETENTION = 3600.0
+SQL_APPEND = ("INSERT INTO LoanLog (kind, loan_id, book_id, user_id, borrow_date, return_date, due_date, created) "
+              "VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+SQL_READ = ("SELECT seq, kind, loan_id, book_id, user_id, borrow_date, return_date, due_date, created "
+            "FROM LoanLog WHERE seq > ? ORDER BY seq LIMIT ?")
+# The last number handed out, which compaction does not reset
+SQL_HEAD = "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'LoanLog'), 0)"
+# The last number compaction has removed; a peer behind it cannot catch up from the log
+SQL_FLOOR = "SELECT COALESCE((SELECT MIN(seq) - 1 FROM LoanLog), (SELECT seq FROM sqlite_sequence WHERE name = 'LoanLog'), 0)"
+SQL_APPLY_BORROW = ("INSERT INTO Loans (loan_id, book_id, user_id, borrow_date, due_date) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(loan_id) DO NOTHING")
+SQL_APPLY_RETURN = "UPDATE Loans SET return_date = ? WHERE loan_id = ? AND book_id = ?"
+SQL_LOAN_BOOK = "SELECT book_id FROM Loans WHERE loan_id = ?"
+# The newest entry at most ? that was written before ?
+SQL_COMPACTABLE = "SELECT MAX(seq) FROM LoanLog WHERE seq <= ? AND created < ?"
+SQL_CURSORS = "SELECT origin, seq FROM LogCursors"
+SQL_SAVE_CURSOR = ("INSERT INTO LogCursors (origin, seq, applied_at) VALUES (?, ?, ?) "
+                   "ON CONFLICT(origin) DO UPDATE SET seq = excluded.seq, applied_at = excluded.applied_at")
+
+
+class ChangeLog:
+    # Owner side: every borrow and return of a book this library owns is appended to LoanLog in
+    # the transaction that makes it, so the log is exactly as durable as the loan. Peers pull it
+    # by sequence number; the cursor each peer pulls from is what it has applied so far.
+    # Entries stay for at least `retention` seconds even once every peer has them, so a node
+    # restored from a snapshot taken in that window can still catch up from its cursors
+    def __init__(self, pool, retention=DEFAULT_RETENTION):
+        self.pool = pool
+        self.retention = retention
+        self.lock = threading.Lock()
+        # peer -> highest sequence number the peer has applied
+        self.acked = {}
+        self.pulls = 0
+        self.compacted = 0
+
+    @staticmethod
+    def append(cursor, kind, loan_id, book_id=None, user_id=None, borrow_date=None, return_date=None, due_date=None):
+        cursor.execute(SQL_APPEND, (kind, loan_id, book_id, user_id, borrow_date, return_date, due_date, time()))
+
+    def read(self, peer, after, limit):
+        with self.lock:
+            self.acked[peer] = max(after, self.acked.get(peer, 0))
+            self.pulls += 1
+        with self.pool.connection() as conn:
+            floor = conn.execute(SQL_FLOOR).fetchone()[0]
+            if after < floor:
+                # E.g. a node restored from a snapshot older than the compacted prefix
+                return {"status": "Failed", "floor": floor,
+                        "message": f"Entries up to {floor} were compacted; {peer} needs a newer snapshot"}
+            entries = conn.execute(SQL_READ, (after, limit)).fetchall()
+            head = conn.execute(SQL_HEAD).fetchone()[0]
+        return {"status": "Success", "entries": entries, "head": head}
+
+    def compact(self, peers):
+        # Entries every peer has applied and older than the retention window are no longer needed
+        with self.lock:
+            if any(peer not in self.acked for peer in peers) or not peers:
+                return 0
+            low = min(self.acked[peer] for peer in peers)
+            if low <= self.compacted:
+                return 0
+        with self.pool.connection() as conn:
+            upto = conn.execute(SQL_COMPACTABLE, (low, time() - self.retention)).fetchone()[0]
+            if upto is None or upto <= self.compacted:
+                return 0
+            deleted = conn.execute("DELETE FROM LoanLog WHERE seq <= ?", (upto,)).rowcount
+            conn.commit()
+        with self.lock:
+            self.compacted = max(self.compacted, upto)
+        return deleted
+
+    def stats(self):
+        with self.pool.connection() as conn:
+            head = conn.execute(SQL_HEAD).fetchone()[0]
+        with self.lock:
+            return {"head": head, "pulls": self.pulls,
+                    "peers": {peer: {"cursor": seq, "lag": head - seq} for peer, seq in sorted(self.acked.items())}}
+
+
+class LogReplicator:
+    # Replica side: pulls the change logs of the other libraries in batches and applies each
+    # batch with its new cursor in one transaction. Applying an entry twice has no further
+    # effect, so a batch retried after a lost response or a crash is harmless
+    def __init__(self, server, batch_size=500, poll_interval=0.05, max_backoff=2.0):
+        self.server = server
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        with server.pool.connection() as conn:
+            self.cursors = dict(conn.execute(SQL_CURSORS).fetchall())
+        # origin -> {"head", "lag", "lag_seconds", "applied", "conflicts", "errors"}
+        self.origins = {}
+        self.stopped = threading.Event()
+
+    def origin_stats(self, origin):
+        return self.origins.setdefault(origin, {"head": 0, "lag": 0, "lag_seconds": 0.0, "applied": 0,
+                                                "conflicts": 0, "errors": 0})
+
+    def run(self):
+        backoff = self.poll_interval
+        while not self.stopped.is_set():
+            origins = [origin for origin in list(self.server.peers) if origin != self.server.db_name]
+            pulled = 0
+            failed = False
+            for origin in origins:
+                try:
+                    pulled += self.pull(origin)
+                except Exception as e:
+                    logger.warning("Pulling the change log of %s at %s failed: %s", origin, self.server.db_name, e)
+                    with self.lock:
+                        self.origin_stats(origin)["errors"] += 1
+                    failed = True
+            # An unreachable peer is retried less and less often, the others keep their pace
+            backoff = min(backoff * 2, self.max_backoff) if failed else self.poll_interval
+            if self.server.change_log is not None:
+                self.server.change_log.compact(origins)
+            if not pulled:
+                self.stopped.wait(backoff)
+
+    def pull(self, origin):
+        after = self.cursors.get(origin, 0)
+        request = {'pull_log': {'peer': self.server.db_name, 'after': after, 'limit': self.batch_size}}
+        response = self.server.peer_pool(origin).request(request)
+        if response.get('status') != 'Success':
+            raise RuntimeError(f"{origin} refused the pull: {response.get('message')}")
+        entries = response['entries']
+        if entries:
+            self.apply(origin, entries)
+        with self.lock:
+            stats = self.origin_stats(origin)
+            stats["head"] = response['head']
+            stats["lag"] = response['head'] - self.cursors.get(origin, 0)
+            stats["lag_seconds"] = time() - entries[-1][-1] if entries and stats["lag"] else 0.0
+        return len(entries)
+
+    def apply(self, origin, entries):
+        applied = []
+        with self.server.pool.connection() as conn:
+            for seq, kind, loan_id, book_id, user_id, borrow_date, return_date, due_date, _ in entries:
+                if kind == 'borrow':
+                    if conn.execute(SQL_APPLY_BORROW, (loan_id, book_id, user_id, borrow_date, due_date)).rowcount == 0:
+                        # Already here: a repeat of this entry, or another owner's loan with the same id
+                        self.check_clash(conn, origin, seq, loan_id, book_id)
+                    applied.append(('add_loan', loan_id))
+                elif kind == 'return':
+                    if conn.execute(SQL_APPLY_RETURN, (return_date, loan_id, book_id)).rowcount == 0:
+                        self.check_clash(conn, origin, seq, loan_id, book_id)
+                    applied.append(('update_loan', loan_id))
+            last = entries[-1][0]
+            conn.execute(SQL_SAVE_CURSOR, (origin, last, time()))
+            conn.commit()
+        with self.lock:
+            self.cursors[origin] = last
+            stats = self.origin_stats(origin)
+            stats["applied"] += len(entries)
+        for action, loan_id in applied:
+            self.server.cache.apply(action, {}, {"return_value": {"loan_id": loan_id}})
+        self.server.metrics.inc('change_log.applied', len(entries))
+
+    def check_clash(self, conn, origin, seq, loan_id, book_id):
+        # Loan ids are unique across libraries, so a loan of another book under this id means
+        # the libraries disagree on ids. Nothing of the batch is applied and the cursor stays
+        # put, so the puller stops at this entry instead of losing a loan
+        existing = conn.execute(SQL_LOAN_BOOK, (loan_id,)).fetchone()
+        if existing is not None and existing[0] != book_id:
+            with self.lock:
+                self.origin_stats(origin)["conflicts"] += 1
+            raise RuntimeError(f"Entry {seq} of {origin}: loan {loan_id} of book {book_id} clashes with "
+                               f"loan {loan_id} of book {existing[0]} at {self.server.db_name}")
+
+    def stop(self):
+        self.stopped.set()
+
+    def stats(self):
+        with self.lock:
+            return {origin: dict(stats, cursor=self.cursors.get(origin, 0))
+                    for origin, stats in sorted(self.origins.items())}
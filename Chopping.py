@@ -0,0 +1,216 @@
+from collections import deque
+from functools import lru_cache
+from itertools import combinations
+
+# Tables each action reads and writes at the node it runs on
+ACTION_ACCESS = {
+    'add_book':    ({'Books'}, {'Books'}),
+    'add_user':    ({'Users'}, {'Users'}),
+    'delete_book': ({'Books'}, {'Books'}),
+    'borrow_book': ({'Books'}, {'Books', 'Loans'}),
+    'add_loan':    (set(), {'Loans'}),
+    'return_book': ({'Books'}, {'Books', 'Loans'}),
+    'update_loan': ({'Loans'}, {'Loans'}),
+    'query_user':  ({'Users'}, set()),
+    'track_loans': ({'Books', 'Loans'}, set()),
+    'bulk_add_books': ({'Books'}, {'Books'}),
+    'bulk_add_users': ({'Users'}, {'Users'}),
+    'loan_history': ({'Loans'}, set()),
+}
+
+# Roles say where a piece runs relative to the rest of its transaction: 'local' is the
+# client's own library, 'owner' the library holding the book and 'replicaN' the others.
+# Distinct owner/replica roles of one transaction are always distinct nodes.
+DISTINCT_ROLES = ('owner', 'replica')
+
+
+class Piece:
+    def __init__(self, action, role):
+        self.action = action
+        self.role = role
+        self.reads, self.writes = ACTION_ACCESS[action]
+
+    def conflicts(self, other):
+        return bool(self.writes & (other.reads | other.writes) or other.writes & self.reads)
+
+    def same_node_possible(self, other):
+        # Within one transaction owner and replica pieces are known to land on different libraries
+        if self.role == other.role:
+            return True
+        return not (self.role.startswith(DISTINCT_ROLES) and other.role.startswith(DISTINCT_ROLES))
+
+    def __repr__(self):
+        return f"{self.action}@{self.role}"
+
+
+class TransactionType:
+    def __init__(self, name, pieces):
+        self.name = name
+        self.pieces = [Piece(action, role) for action, role in pieces]
+
+
+def transaction_types(replicas=2):
+    # The chopping the Client builds its hop lists from. Borrows and returns have one piece per
+    # replica, so the types depend on how many libraries there are besides the owner
+    return [
+        TransactionType('add_user',    [('add_user', 'local')]),
+        TransactionType('add_book',    [('add_book', 'owner')]),
+        TransactionType('delete_book', [('delete_book', 'owner')]),
+        TransactionType('query_user',  [('query_user', 'local')]),
+        TransactionType('track_loans', [('track_loans', 'local')]),
+        TransactionType('bulk_add_books', [('bulk_add_books', 'owner')]),
+        TransactionType('bulk_add_users', [('bulk_add_users', 'local')]),
+        TransactionType('loan_history', [('loan_history', 'local')]),
+        TransactionType('borrow_book', [('borrow_book', 'owner')] +
+                        [('add_loan', f'replica{n}') for n in range(1, replicas + 1)]),
+        TransactionType('return_book', [('return_book', 'owner')] +
+                        [('update_loan', f'replica{n}') for n in range(1, replicas + 1)]),
+    ]
+
+
+TRANSACTION_TYPES = transaction_types()
+
+
+class ExecutionPlan:
+    def __init__(self, type, pieces, ordered, commutes, parallel_groups):
+        self.type = type
+        self.pieces = pieces
+        # False when no piece of this type lies on an SC-cycle, so origin ordering can be skipped
+        self.ordered = ordered
+        # True when no piece conflicts with any piece of any type, so no locking is needed
+        self.commutes = commutes
+        # Piece indexes grouped into waves; pieces within a wave may run in parallel
+        self.parallel_groups = parallel_groups
+
+    def to_dict(self):
+        return {
+            "type": self.type,
+            "pieces": [repr(piece) for piece in self.pieces],
+            "ordered": self.ordered,
+            "commutes": self.commutes,
+            "parallel_groups": self.parallel_groups,
+        }
+
+
+class ChoppingAnalyzer:
+    # Builds the S/C graph of Shasha et al. over two instances of every transaction type
+    # (so a type can conflict with itself) and derives execution plans from its SC-cycles
+    def __init__(self, transaction_types=TRANSACTION_TYPES):
+        self.types = {t.name: t for t in transaction_types}
+        self.nodes = [(name, instance, index)
+                      for name, t in self.types.items()
+                      for instance in (0, 1)
+                      for index in range(len(t.pieces))]
+        self.c_edges = self.build_c_edges()
+        self.cycles = None
+        self.cycle_nodes = None
+        self.plan_cache = {}
+
+    def piece(self, node):
+        name, _, index = node
+        return self.types[name].pieces[index]
+
+    def build_c_edges(self):
+        edges = {node: set() for node in self.nodes}
+        for a, b in combinations(self.nodes, 2):
+            if a[:2] == b[:2]:
+                continue
+            if self.piece(a).conflicts(self.piece(b)):
+                edges[a].add(b)
+                edges[b].add(a)
+        return edges
+
+    def s_neighbours(self, node):
+        name, instance, index = node
+        return [(name, instance, i) for i in range(len(self.types[name].pieces)) if i != index]
+
+    def reachable(self, start, excluded):
+        # Everything reachable from `start` without using the S-edges of the `excluded` instance,
+        # searched breadth first in a fixed order so witness paths are short and reproducible
+        seen = {start: None}
+        frontier = deque([start])
+        while frontier:
+            node = frontier.popleft()
+            neighbours = sorted(self.c_edges[node])
+            if node[:2] != excluded:
+                neighbours += self.s_neighbours(node)
+            for neighbour in neighbours:
+                if neighbour not in seen:
+                    seen[neighbour] = node
+                    frontier.append(neighbour)
+        return seen
+
+    def find_sc_cycles(self):
+        # Two sibling pieces connected outside their own S-edges close a cycle that holds
+        # both an S-edge and a C-edge
+        if self.cycles is not None:
+            return self.cycles
+        self.cycles = []
+        self.cycle_nodes = set()
+        for name, t in self.types.items():
+            for i, j in combinations(range(len(t.pieces)), 2):
+                start, end = (name, 0, i), (name, 0, j)
+                seen = self.reachable(start, (name, 0))
+                if end not in seen:
+                    continue
+                path = [end]
+                while path[-1] != start:
+                    path.append(seen[path[-1]])
+                path.reverse()
+                self.cycles.append({"type": name, "pieces": (i, j),
+                                    "path": [f"{n}#{inst}.{self.piece((n, inst, k))!r}" for n, inst, k in path]})
+                self.cycle_nodes.update((n, k) for n, _, k in path)
+        return self.cycles
+
+    def plan(self, type_name):
+        if type_name in self.plan_cache:
+            return self.plan_cache[type_name]
+
+        self.find_sc_cycles()
+        t = self.types[type_name]
+        # Only the pieces on a witness path need ordering, and a type that is not chopped
+        # runs atomically at one node, so it never does
+        ordered = len(t.pieces) > 1 and any((type_name, index) in self.cycle_nodes for index in range(len(t.pieces)))
+        commutes = not any(self.c_edges[(type_name, 0, index)] for index in range(len(t.pieces)))
+
+        # The first piece is the only one allowed to abort, so it always runs alone;
+        # later pieces share a wave unless they might touch the same node and conflict
+        groups = [[0]] if t.pieces else []
+        for index in range(1, len(t.pieces)):
+            piece = t.pieces[index]
+            wave = groups[-1] if len(groups) > 1 else None
+            if wave is not None and not any(piece.conflicts(t.pieces[other]) and piece.same_node_possible(t.pieces[other])
+                                            for other in wave):
+                wave.append(index)
+            else:
+                groups.append([index])
+
+        plan = ExecutionPlan(type_name, t.pieces, ordered, commutes, groups)
+        self.plan_cache[type_name] = plan
+        return plan
+
+    def plans(self):
+        return {name: self.plan(name) for name in self.types}
+
+    def unordered_actions(self):
+        # Actions that only ever appear in types needing no ordering
+        ordered = {piece.action for plan in self.plans().values() if plan.ordered for piece in plan.pieces}
+        return {piece.action for plan in self.plans().values() for piece in plan.pieces} - ordered
+
+    def report(self):
+        return {
+            "sc_cycles": self.find_sc_cycles(),
+            "plans": {name: plan.to_dict() for name, plan in self.plans().items()},
+        }
+
+
+@lru_cache(maxsize=None)
+def default_analyzer(replicas=2):
+    # Plans for the built-in transaction types with `replicas` libraries besides the owner,
+    # computed once per count and shared by clients and servers
+    return ChoppingAnalyzer(transaction_types(replicas))
+
+
+if __name__ == "__main__":
+    import json
+    print(json.dumps(ChoppingAnalyzer().report(), indent=2))
@@ -1,199 +1,530 @@
-import socket
-import pickle
+import csv
+import itertools
+import json
+import os
+import random
 import threading
-from time import sleep
+import uuid
+from collections import deque
+from time import sleep, monotonic
+from concurrent.futures import ThreadPoolExecutor
 from Transaction import Transaction
 from Hop import Hop
+from ConnectionPool import ConnectionPool
+from Chopping import default_analyzer
+from Partition import PartitionDirectory
+from Sequencer import SequenceLease
+from Outbox import Outbox, OutboxWorkers, backoff_delay, DEFAULT_MAX_AGE
+from Instrumentation import get_logger, configure_logging
+
+logger = get_logger('client')
+
+# Integer columns of the rows read from CSV, where every field arrives as a string
+INTEGER_FIELDS = ('book_id', 'user_id')
+
+
+def read_rows(path):
+    # Streams rows from a .jsonl or .csv file one at a time, for the bulk_add_* methods
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            for row in csv.DictReader(f):
+                for field in INTEGER_FIELDS:
+                    if row.get(field):
+                        row[field] = int(row[field])
+                yield row
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
 
 class Client:
-    def __init__(self, servers, id, location, max_retries=3):
+    def __init__(self, servers, id, location, max_retries=3, max_connections=2, idle_timeout=30.0, fanout_workers=8,
+                 directory=None, chained=False, chain_ack='first', replication='sync',
+                 outbox=None, retry_workers=4, retry_base=0.05, retry_cap=30.0, max_attempts=None,
+                 max_age=DEFAULT_MAX_AGE, queue_deadline=None, overload_retries=5):
         self.servers = servers
+        # 'sync' writes each loan to every library with add_loan/update_loan pieces; 'log' only
+        # waits for the owning library and lets the replicas pull its change log
+        self.replication = replication
+        # In chained mode the first-hop server forwards the later pieces itself and
+        # acknowledges after piece 1 ('first') or after every piece ('all')
+        self.chained = chained
+        self.chain_ack = chain_ack
+        self.directory = directory or PartitionDirectory(list(servers))
         self.id = id
         self.location = location
         self.max_retries = max_retries
         self.lock = threading.Lock()
-
-    def send_hop(self, server, hop, return_value = None, sequence_number = None):
-        server_host, server_port = self.servers[server]
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((server_host, server_port))
-            hop_data = {'hop': hop, 'return_value': return_value}
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+        # Later pieces of a chopped transaction are independent, so they are sent concurrently
+        self.executor = ThreadPoolExecutor(max_workers=fanout_workers)
+        self.plans = default_analyzer().plans()
+        self.retries = 0
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        # Seconds a request may wait in a library's queue before it is refused, and how often
+        # an "Overloaded" refusal is retried after the delay the library asked for
+        self.queue_deadline = queue_deadline
+        self.overload_retries = overload_retries
+        self.overloaded = 0
+        # With an outbox file, BaseClient hands the pieces after the first to background workers
+        # that retry them until they commit, and returns once the first piece is done
+        self.outbox = None
+        if outbox is not None:
+            self.outbox = Outbox(outbox, retry_base=retry_base, retry_cap=retry_cap, max_attempts=max_attempts,
+                                 max_age=max_age)
+            self.outbox_workers = OutboxWorkers(self.outbox, self.deliver, workers=retry_workers)
+
+    def pool(self, server):
+        pool = self.pools.get(server)
+        if pool is None:
+            with self.pools_lock:
+                pool = self.pools.get(server)
+                if pool is None:
+                    pool = ConnectionPool(server, self.servers[server],
+                                          max_connections=self.max_connections,
+                                          idle_timeout=self.idle_timeout)
+                    self.pools[server] = pool
+        return pool
+
+    def request(self, server, message):
+        if self.queue_deadline is not None:
+            message.setdefault('deadline', self.queue_deadline)
+        for attempt in range(self.overload_retries + 1):
+            response = self.pool(server).request(message)
+            if not isinstance(response, dict) or response.get('status') != 'Overloaded':
+                return response
+            with self.lock:
+                self.overloaded += 1
+            if attempt < self.overload_retries:
+                # A little jitter keeps the refused clients from coming back all at once
+                sleep(response['retry_after'] * random.uniform(1.0, 1.5))
+        logger.warning("%s stayed overloaded after %s attempts", server, self.overload_retries + 1)
+        # Callers treat this like any other failed request
+        return {"status": "Failed", "message": f"{server} is overloaded: {response.get('message')}",
+                "retry_after": response['retry_after']}
+
+    def close(self):
+        if self.outbox is not None:
+            # Undelivered pieces stay in the file and are sent by the next client using it
+            self.outbox.close()
+        self.executor.shutdown()
+        for pool in self.pools.values():
+            pool.close()
+
+    def send_hop(self, server, hop, return_value = None, sequence_number = None, previous = None, dedup = None):
+        hop_data = {'hop': hop, 'return_value': return_value}
+        if dedup is not None:
+            # (transaction_key, hop_id): the library applies a repeat of this piece only once
+            hop_data['dedup'] = dedup
+        if sequence_number is not None:
+            # Sequence numbers are only ordered within this client's stream; `previous` maps each
+            # node to the number of the stream's last hop there, which this hop has to follow
+            hop_data['sequence_number'] = sequence_number
+            hop_data['origin'] = self.location
+            hop_data['stream'] = self.stream
+        for _ in range(len(self.servers)):
+            hop_data['epoch'] = self.directory.epoch
             if sequence_number is not None:
-                hop_data['sequence_number'] = sequence_number
-            s.sendall(pickle.dumps(hop_data))
-            response = s.recv(1024)
-            return pickle.loads(response)
+                hop_data['previous'] = (previous or {}).get(server)
+            response = self.request(server, hop_data)
+            if response.get('status') != 'Redirect':
+                return response
+            # Our routing table is stale: adopt the server's and follow it to the new owner
+            self.directory.update(response['directory'])
+            logger.info("Hop %s redirected from %s to %s (epoch %s)", hop.hop_id, server, response['node'], self.directory.epoch)
+            server = hop.node = response['node']
+        return response
         
     def send_transaction(self, transaction):
         raise NotImplementedError("Must be implemented by subclass.")
 
+    def send_chain(self, transaction):
+        first_hop = transaction.hops[0]
+        for _ in range(len(self.servers)):
+            response = self.request(first_hop.node, {'transaction': transaction, 'chain': self.chain_ack,
+                                                     'epoch': self.directory.epoch})
+            if response.get('status') != 'Redirect':
+                return response
+            # Re-plan every piece around the new owner before resubmitting
+            self.directory.update(response['directory'])
+            first_hop.node = response['node']
+            self.replan(transaction)
+        return response
+
+    def replan(self, transaction):
+        # Later pieces go to every library other than the one the first hop ended up at
+        for hop, node in zip(transaction.hops[1:], self.other_locations(transaction.hops[0].node)):
+            hop.node = node
+
+    def send_piece(self, transaction, hop, return_value = None, sequence_number = None, previous = None):
+        retries = 0
+        logger.debug("Executing hop %s for Transaction %s", hop.hop_id, transaction.transaction_id)
+        while True:
+            response = self.send_hop(hop.node, hop, return_value, sequence_number=sequence_number, previous=previous)
+            if response.get('status') == 'Success':
+                return response
+            retries += 1
+            if retries == self.max_retries:
+                logger.warning("Transaction %s failed at hop %s after %s retries", transaction.transaction_id, hop.node, self.max_retries)
+                return response
+            logger.warning("Retrying hop %s for transaction %s, attempt %s", hop.hop_id, transaction.transaction_id, retries)
+            with self.lock:
+                self.retries += 1
+            sleep(backoff_delay(retries, self.retry_base, self.retry_cap))
+
+    def deliver(self, entry):
+        hop = entry.hop
+        return self.send_hop(hop.node, hop, entry.return_value, dedup=(entry.transaction_key, hop.hop_id))
+
+    def flush_outbox(self, timeout=None):
+        # Waits until every queued piece has been delivered (or given up on)
+        deadline = None if timeout is None else monotonic() + timeout
+        while self.outbox.stats()['pending']:
+            if deadline is not None and monotonic() > deadline:
+                return False
+            sleep(0.01)
+        return True
+
+    def plan(self, transaction):
+        plan = self.plans.get(transaction.type)
+        if plan is not None and len(plan.pieces) != len(transaction.hops) > 1:
+            # A directory with more or fewer than three libraries: plan for its replica count
+            plan = default_analyzer(len(transaction.hops) - 1).plans().get(transaction.type)
+        if plan is None or len(plan.pieces) != len(transaction.hops):
+            return None
+        return plan
+
+    def send_later_pieces(self, transaction, return_value = None, sequence_number = None, previous = None):
+        # Later pieces only need the first hop's return value, so each wave of the plan starts
+        # all of its pieces at once and waits for the slowest replica instead of the sum of them
+        plan = self.plan(transaction)
+        if plan is not None:
+            waves = [[transaction.hops[index] for index in group] for group in plan.parallel_groups[1:]]
+        else:
+            waves = [transaction.hops[1:]]
+
+        failed_hops = []
+        for hops in waves:
+            futures = [self.executor.submit(self.send_piece, transaction, hop, return_value, sequence_number, previous)
+                       for hop in hops]
+            for hop, future in zip(hops, futures):
+                try:
+                    response = future.result()
+                except Exception as e:
+                    logger.warning("Hop %s for Transaction %s raised %s", hop.hop_id, transaction.transaction_id, e)
+                    response = {"status": "Failed", "message": str(e)}
+                if response.get('status') != 'Success':
+                    failed_hops.append(hop)
+        return failed_hops
 
     def add_user(self, t_id, params):
         transaction = Transaction(transaction_id=t_id, type='add_user', hops=[
             Hop(hop_id=1, node=self.location, action='add_user', parameters=params)
         ])
-        self.send_transaction(transaction)
+        return self.send_transaction(transaction)
     
 
     def add_book(self, t_id, params):
         transaction = Transaction(transaction_id=t_id, type='add_book', hops=[
-            Hop(hop_id=1, node=self.location, action='add_book', parameters=params)
+            Hop(hop_id=1, node=self.book_location(params.get("book_id")), action='add_book', parameters=params)
         ])
-        self.send_transaction(transaction)
+        return self.send_transaction(transaction)
 
 
     def delete_book(self, t_id, params):
         transaction = Transaction(transaction_id=t_id, type='delete_book', hops=[
             Hop(hop_id=1, node=self.book_location(params.get("book_id")), action='delete_book', parameters=params)
         ])
-        self.send_transaction(transaction)
+        return self.send_transaction(transaction)
 
 
     def query_user(self, t_id, params):
         transaction = Transaction(transaction_id=t_id, type='query_user', hops=[
             Hop(hop_id=1, node=self.location, action='query_user', parameters=params)
         ])
-        self.send_transaction(transaction)
+        return self.send_transaction(transaction)
 
     
     def borrow_book(self, t_id, params):
         book_location = self.book_location(params['book_id'])
-        other_locations = self.other_locations(book_location)
-
+        # One add_loan piece per other library, however many the directory has
         transaction = Transaction(transaction_id=t_id, type='borrow_book', hops=[
             Hop(hop_id=1, node=book_location, action='borrow_book', parameters=params),
-            Hop(hop_id=2, node=other_locations[0], action='add_loan', parameters=params),
-            Hop(hop_id=3, node=other_locations[1], action='add_loan', parameters=params),
-        ])
-        self.send_transaction(transaction)
+        ] + [Hop(hop_id=hop_id, node=node, action='add_loan', parameters=params)
+             for hop_id, node in enumerate(self.other_locations(book_location), start=2)])
+        if self.replication == 'log':
+            transaction.hops = transaction.hops[:1]
+        return self.send_transaction(transaction)
     
 
     def return_book(self, t_id, params):
         book_location = self.book_location(params['book_id'])
-        other_locations = self.other_locations(book_location)
-
+        # One update_loan piece per other library, however many the directory has
         transaction = Transaction(transaction_id=t_id, type='return_book', hops=[
             Hop(hop_id=1, node=book_location, action='return_book', parameters=params),
-            Hop(hop_id=2, node=other_locations[0], action='update_loan', parameters=params),
-            Hop(hop_id=3, node=other_locations[1], action='update_loan', parameters=params),
-        ])
-        self.send_transaction(transaction)
+        ] + [Hop(hop_id=hop_id, node=node, action='update_loan', parameters=params)
+             for hop_id, node in enumerate(self.other_locations(book_location), start=2)])
+        if self.replication == 'log':
+            transaction.hops = transaction.hops[:1]
+        return self.send_transaction(transaction)
 
 
     def track_loans(self, t_id, params):
         transaction = Transaction(transaction_id=t_id, type='track_loans', hops=[
             Hop(hop_id=1, node=self.location, action='track_loans', parameters = params),
         ])
-        self.send_transaction(transaction)
-
+        return self.send_transaction(transaction)
+
+
+    def iter_loans(self, location=None, page_size=500, **filters):
+        # Streams the outstanding loans of a library page by page, asking for each page after
+        # the last loan_id seen. Filters: user_id, due_before='YYYY-MM-DD', overdue=True
+        node = location or self.location
+        after = 0
+        page = 0
+        while after is not None:
+            page += 1
+            hop = Hop(hop_id=page, node=node, action='track_loans',
+                      parameters=dict(filters, after=after, limit=page_size))
+            response = self.request(node, {'hop': hop, 'return_value': None, 'epoch': self.directory.epoch})
+            if response.get('status') != 'Success':
+                raise RuntimeError(f"track_loans page {page} failed at {node}: {response.get('message')}")
+            yield from response['data']
+            after = response['next']
+
+    def loan_history(self, location=None, **filters):
+        # Every loan of a library matching the filters, archived ones included. Filters: loan_id,
+        # book_id, user_id, and since/until='YYYY-MM' to bound the archive months read
+        node = location or self.location
+        hop = Hop(hop_id=1, node=node, action='loan_history', parameters=filters)
+        response = self.request(node, {'hop': hop, 'return_value': None, 'epoch': self.directory.epoch})
+        if response.get('status') != 'Success':
+            raise RuntimeError(f"loan_history failed at {node}: {response.get('message')}")
+        return response['data']
+
+    def bulk_add_books(self, t_id, rows, chunk_size=500, on_chunk=None):
+        return self.bulk_load(t_id, 'bulk_add_books', 'books', rows,
+                              lambda row: self.book_location(row['book_id']), chunk_size, on_chunk)
+
+    def bulk_add_users(self, t_id, rows, chunk_size=500, on_chunk=None):
+        # Users are members of the library named by their membership, like add_user from that library
+        return self.bulk_load(t_id, 'bulk_add_users', 'users', rows,
+                              lambda row: row['membership'] if row.get('membership') in self.servers else self.location,
+                              chunk_size, on_chunk)
+
+    def bulk_load(self, t_id, action, field, rows, route, chunk_size, on_chunk):
+        # Rows are buffered per library and a buffer is sent as soon as it holds chunk_size rows,
+        # with no more chunks in flight than there are libraries. Memory therefore stays bounded
+        # by a few chunks whatever the size of `rows`, which may be any iterable such as
+        # read_rows(path).
+        # on_chunk gets the report of every chunk; the totals are returned
+        summary = {"chunks": 0, "rows": 0, "added": 0, "duplicates": 0, "failed": 0}
+        buffers = {}
+        in_flight = deque()
+        chunk_numbers = itertools.count(1)
+
+        def collect(future):
+            for report in future.result():
+                summary["chunks"] += 1
+                summary["rows"] += report["rows"]
+                summary["added"] += report["added"]
+                summary["duplicates"] += len(report["duplicates"])
+                if report["status"] != 'Success':
+                    summary["failed"] += report["rows"]
+                if on_chunk is not None:
+                    on_chunk(report)
+
+        def send(node, chunk):
+            in_flight.append(self.executor.submit(self.send_chunk, t_id, next(chunk_numbers), action, field,
+                                                  node, chunk, route))
+            while len(in_flight) > len(self.servers):
+                collect(in_flight.popleft())
+
+        for row in rows:
+            node = route(row)
+            buffer = buffers.setdefault(node, [])
+            buffer.append(row)
+            if len(buffer) >= chunk_size:
+                send(node, buffer)
+                buffers[node] = []
+        for node, buffer in buffers.items():
+            if buffer:
+                send(node, buffer)
+        while in_flight:
+            collect(in_flight.popleft())
+        logger.info("Transaction %s loaded %s rows in %s chunks: %s added, %s duplicates, %s failed", t_id,
+                    summary["rows"], summary["chunks"], summary["added"], summary["duplicates"], summary["failed"])
+        return summary
+
+    def send_chunk(self, t_id, chunk, action, field, node, rows, route, attempts=None):
+        # Returns one report per chunk actually applied; a redirect re-partitions the rows
+        # under the refreshed directory and sends each part to its owner
+        attempts = len(self.servers) if attempts is None else attempts
+        hop = Hop(hop_id=chunk, node=node, action=action, parameters={field: rows})
+        try:
+            response = self.request(node, {'hop': hop, 'return_value': None, 'epoch': self.directory.epoch})
+        except Exception as e:
+            response = {"status": "Failed", "message": str(e)}
+        if response.get('status') == 'Redirect' and attempts > 1:
+            self.directory.update(response['directory'])
+            logger.info("Chunk %s of transaction %s redirected from %s (epoch %s)", chunk, t_id, node, self.directory.epoch)
+            parts = {}
+            for row in rows:
+                parts.setdefault(route(row), []).append(row)
+            return [report for part_node, part in parts.items()
+                    for report in self.send_chunk(t_id, chunk, action, field, part_node, part, route, attempts - 1)]
+        return_value = response.get('return_value') or {}
+        if response.get('status') != 'Success':
+            logger.warning("Chunk %s of transaction %s failed at %s: %s", chunk, t_id, node, response.get('message'))
+        return [{"transaction_id": t_id, "chunk": chunk, "node": node, "rows": len(rows),
+                 "status": response.get('status'), "message": response.get('message'),
+                 "added": return_value.get('added', 0), "duplicates": return_value.get('duplicates', [])}]
 
     def book_location(self, book_id):
-        start_digit = round(book_id / 1000)
-        if start_digit == 1:
-            return "Library A"
-        elif start_digit == 2:
-            return "Library B"
-        else:
-            return "Library C"
+        return self.directory.node_for_book(book_id)
         
     def other_locations(self, node):
-        nodes = ['Library A', 'Library B', 'Library C']
-        nodes.remove(node)
-        return nodes
+        return self.directory.replicas(node)
 
 
 class BaseClient(Client):
     def send_transaction(self, transaction):
         # with self.lock: 
+            if self.chained and len(transaction.hops) > 1:
+                response = self.send_chain(transaction)
+                if response.get('status') != 'Success':
+                    logger.warning("Transaction %s failed in chained mode: %s", transaction.transaction_id, response.get('message'))
+                    return False
+                logger.info("Transaction %s completed successfully", transaction.transaction_id)
+                return True
+
             return_value = None
             # Execute the first hop
             first_hop = transaction.hops[0]
+            owner = first_hop.node
             response = self.send_hop(first_hop.node, first_hop)
             
             if response.get('status') == 'Failed':
-                print(f"## Transaction {transaction.transaction_id} aborted at first hop {first_hop.node}")
-                return
+                logger.warning("Transaction %s aborted at first hop %s", transaction.transaction_id, first_hop.node)
+                return False
+            if first_hop.node != owner:
+                # The first hop was redirected, so the replicas moved with it
+                self.replan(transaction)
             return_value = response.get('return_value', None)
-            print(f"First hop {first_hop.node} completed successfully for Transaction {transaction.transaction_id}")
-
-            # Execute the rest of the hops and retry if necessary
-            for hop in transaction.hops[1:]:
-                retries = 0
-                print(f"Executing hop {hop.hop_id} for Transaction {transaction.transaction_id}")
-                while retries < self.max_retries:
-                    response = self.send_hop(hop.node, hop, return_value)
-                    if response.get('status') == 'Success':
-                        return_value = response.get('return_value', None)
-                        break
-                    else:
-                        retries += 1
-                        print(f"Retrying hop {hop.hop_id} for transaction {transaction.transaction_id}, attempt {retries}")
-                        sleep(1)
-                if retries == self.max_retries:
-                    print(f"Transaction {transaction.transaction_id} failed at hop {hop.node} after {self.max_retries} retries")
-                    return
-
-            print(f"## Transaction {transaction.transaction_id} completed successfully")
+            logger.debug("First hop %s completed successfully for Transaction %s", first_hop.node, transaction.transaction_id)
+
+            if self.outbox is not None and len(transaction.hops) > 1:
+                # Piece 1 committed, so the rest only has to commit eventually: hand it to the
+                # retry workers. The key is unique per transaction, also across client restarts
+                transaction_key = f"{self.outbox.client_key}/{transaction.transaction_id}/{uuid.uuid4().hex[:8]}"
+                self.outbox.enqueue(transaction_key, transaction.hops[1:], return_value)
+                logger.info("Transaction %s committed its first piece, %s pieces queued", transaction.transaction_id,
+                            len(transaction.hops) - 1)
+                return True
+
+            # Execute the rest of the hops in parallel, each with its own retries
+            failed_hops = self.send_later_pieces(transaction, return_value)
+            if failed_hops:
+                logger.warning("Transaction %s failed at hops %s", transaction.transaction_id, [hop.node for hop in failed_hops])
+                return False
+
+            logger.info("Transaction %s completed successfully", transaction.transaction_id)
+            return True
 
 class OriginOrderClient(Client):
+    def __init__(self, servers, id, location, lease_size=64, **kwargs):
+        super().__init__(servers, id, location, **kwargs)
+        # Sequence numbers are leased from the home library in blocks, so transactions of one
+        # client no longer serialize on a round-trip (or on self.lock) to get their number
+        self.sequencer = SequenceLease(self.lease_sequence_block, block_size=lease_size)
+        # Each client is its own ordering stream; servers order its hops per node by chaining
+        # every hop to the stream's previous hop at that node
+        self.stream = f"{location}/{id}/{uuid.uuid4().hex[:8]}"
+        self.chain_lock = threading.Lock()
+        self.last_sequence = {}
+
+    def lease_sequence_block(self, size):
+        start, end = self.request(self.location, {'lease_sequence': size})
+        return start, end
+
     def get_sequence_number(self):
-        server_host, server_port = self.servers[self.location]
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((server_host, server_port))
-            s.sendall(pickle.dumps({'get_sequence_number': True}))
-            sequence_number = pickle.loads(s.recv(1024))
-            return sequence_number
+        return self.sequencer.next()
+
+    def sequence_transaction(self, transaction):
+        # Numbering and chaining happen together so the chains follow sequence order. A redirect
+        # only shuffles the pieces among these libraries, so each still gets exactly one hop
+        with self.chain_lock:
+            sequence_number = self.get_sequence_number()
+            previous = {hop.node: self.last_sequence.get(hop.node) for hop in transaction.hops}
+            for node in previous:
+                self.last_sequence[node] = sequence_number
+        transaction.sequence_number = sequence_number
+        for hop in transaction.hops:
+            hop.sequence_number = sequence_number
+        return sequence_number, previous
+
+    def skip_pieces(self, transaction, sequence_number, previous):
+        # Libraries that will never see the later pieces are told to move on, so the stream's
+        # next hop there does not wait out the gap timeout
+        for hop in transaction.hops[1:]:
+            skip = {'skip': True, 'hop': hop, 'sequence_number': sequence_number,
+                    'stream': self.stream, 'previous': previous.get(hop.node)}
+            self.executor.submit(self.request, hop.node, skip)
         
     def send_transaction(self, transaction):
-        with self.lock:
-            sequence_number = self.get_sequence_number()
-            transaction.sequence_number = sequence_number
-            print(f"## Sequence number for T{transaction.transaction_id}: {sequence_number}")
+        plan = self.plan(transaction)
+        if plan is not None and not plan.ordered:
+            # The chopping analysis shows this type is on no SC-cycle, so it needs no origin order
+            return BaseClient.send_transaction(self, transaction)
 
-            return_value = None
+        sequence_number, previous = self.sequence_transaction(transaction)
+        logger.debug("Sequence number for T%s: %s", transaction.transaction_id, sequence_number)
 
-            first_hop = transaction.hops[0]
-            first_hop.sequence_number = sequence_number
-            response = self.send_hop(first_hop.node, first_hop, sequence_number=sequence_number)
+        return_value = None
 
-            if response.get('status') == 'Failed':
-                print(f"## Transaction {transaction.transaction_id} aborted at first hop {first_hop.node}")
-                return
-            return_value = response.get('return_value', None)
-            print(f"First hop {first_hop.node} completed successfully for Transaction {transaction.transaction_id}")
+        first_hop = transaction.hops[0]
+        owner = first_hop.node
+        response = self.send_hop(first_hop.node, first_hop, sequence_number=sequence_number, previous=previous)
+        if first_hop.node != owner:
+            # The first hop was redirected, so the replicas moved with it
+            self.replan(transaction)
 
-            for hop in transaction.hops[1:]:
-                retries = 0
-                hop.sequence_number = sequence_number
-                print(f"Executing hop {hop.hop_id} for Transaction {transaction.transaction_id}")
-                while retries < self.max_retries:
-                    response = self.send_hop(hop.node, hop, return_value, sequence_number=sequence_number)
-                    if response.get('status') == 'Success':
-                        return_value = response.get('return_value', None)
-                        break
-                    else:
-                        retries += 1
-                        print(f"Retrying hop {hop.hop_id} for transaction {transaction.transaction_id}, attempt {retries}")
-                        sleep(1)
-                if retries == self.max_retries:
-                    print(f"Transaction {transaction.transaction_id} failed at hop {hop.node} after {self.max_retries} retries")
-                    return
+        if response.get('status') == 'Failed':
+            logger.warning("Transaction %s aborted at first hop %s", transaction.transaction_id, first_hop.node)
+            self.skip_pieces(transaction, sequence_number, previous)
+            return False
+        return_value = response.get('return_value', None)
+        logger.debug("First hop %s completed successfully for Transaction %s", first_hop.node, transaction.transaction_id)
 
-            print(f"## Transaction {transaction.transaction_id} completed successfully")
+        failed_hops = self.send_later_pieces(transaction, return_value, sequence_number, previous)
+        if failed_hops:
+            logger.warning("Transaction %s failed at hops %s", transaction.transaction_id, [hop.node for hop in failed_hops])
+            return False
+
+        logger.info("Transaction %s completed successfully", transaction.transaction_id)
+        return True
 
 
 
 if __name__ == "__main__":
+    configure_logging('INFO')
     servers = {
         'Library A': ('localhost', 9000),
         'Library B': ('localhost', 9001),
         'Library C': ('localhost', 9002)
     }
 
-    librarian1 = BaseClient(servers, 1001, 'Library A')
-    librarian2 = BaseClient(servers, 2001, 'Library B')
-    librarian3 = BaseClient(servers, 3001, 'Library C')
-    member1 = BaseClient(servers, 1002, 'Library A')
+    directory = PartitionDirectory.load('partitions.json') if os.path.exists('partitions.json') else None
+
+    librarian1 = BaseClient(servers, 1001, 'Library A', directory=directory)
+    librarian2 = BaseClient(servers, 2001, 'Library B', directory=directory)
+    librarian3 = BaseClient(servers, 3001, 'Library C', directory=directory)
+    member1 = BaseClient(servers, 1002, 'Library A', directory=directory)
 
     threads = []
 
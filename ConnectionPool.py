@@ -0,0 +1,204 @@
+import itertools
+import threading
+from time import monotonic
+from Protocol import connect_channel, ProtocolError, MSG_REQUEST, MSG_PING
+from Instrumentation import get_logger
+
+logger = get_logger('connection_pool')
+
+
+class StaleConnectionError(ConnectionError):
+    # Raised when a request could not even be sent, so it is safe to retry elsewhere
+    pass
+
+
+class PendingResponse:
+    def __init__(self):
+        self.event = threading.Event()
+        self.message = None
+        self.error = None
+
+    def set(self, message):
+        self.message = message
+        self.event.set()
+
+    def fail(self, error):
+        self.error = error
+        self.event.set()
+
+    def wait(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise TimeoutError("Timed out waiting for a response")
+        if self.error is not None:
+            raise self.error
+        return self.message
+
+
+class PooledConnection:
+    # One keep-alive socket that carries many in-flight requests matched by request id
+    def __init__(self, channel, name):
+        self.channel = channel
+        self.name = name
+        self.request_ids = itertools.count(1)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        self.last_used = monotonic()
+        self.reader = threading.Thread(target=self.read_responses, daemon=True)
+        self.reader.start()
+
+    @property
+    def in_flight(self):
+        return len(self.pending)
+
+    def read_responses(self):
+        error = ConnectionError(f"Connection to {self.name} closed")
+        try:
+            while True:
+                message = self.channel.recv()
+                if message is None:
+                    break
+                _, request_id, response = message
+                with self.lock:
+                    pending = self.pending.pop(request_id, None)
+                if pending is not None:
+                    pending.set(response)
+        except (OSError, ProtocolError) as e:
+            error = ConnectionError(f"Connection to {self.name} failed: {e}")
+        self.close(error)
+
+    def request(self, message, msg_type=MSG_REQUEST, timeout=None):
+        pending = PendingResponse()
+        with self.lock:
+            if self.closed:
+                raise StaleConnectionError(f"Connection to {self.name} is closed")
+            request_id = next(self.request_ids)
+            self.pending[request_id] = pending
+        try:
+            self.channel.send(msg_type, request_id, message)
+        except OSError as e:
+            with self.lock:
+                self.pending.pop(request_id, None)
+            self.close()
+            raise StaleConnectionError(f"Connection to {self.name} failed: {e}")
+        try:
+            return pending.wait(timeout)
+        finally:
+            self.last_used = monotonic()
+
+    def ping(self, timeout):
+        try:
+            self.request(None, msg_type=MSG_PING, timeout=timeout)
+            return True
+        except (OSError, TimeoutError):
+            self.close()
+            return False
+
+    def close(self, error=None):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        try:
+            self.channel.close()
+        except OSError:
+            pass
+        for waiter in pending.values():
+            waiter.fail(error or ConnectionError(f"Connection to {self.name} closed"))
+
+
+class ConnectionPool:
+    def __init__(self, name, address, max_connections=2, idle_timeout=30.0,
+                 health_check_interval=5.0, timeout=None):
+        self.name = name
+        self.address = address
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+        self.connections = []
+        self.lock = threading.Lock()
+        # Set once the server closes the connection on HELLO; such peers get a socket per request
+        self.legacy = False
+        self.reconnects = 0
+
+    def checkout(self):
+        while True:
+            with self.lock:
+                now = monotonic()
+                for conn in list(self.connections):
+                    if conn.closed or (conn.in_flight == 0 and now - conn.last_used > self.idle_timeout):
+                        conn.close()
+                        self.connections.remove(conn)
+
+                # Prefer an idle socket, then open another one, then share the least loaded one
+                best = min(self.connections, key=lambda c: c.in_flight, default=None)
+                if best is None or (best.in_flight > 0 and len(self.connections) < self.max_connections):
+                    break
+                if best.in_flight > 0 or now - best.last_used <= self.health_check_interval:
+                    return best
+                # Take the idle socket out while it is pinged so other callers are not held up
+                self.connections.remove(best)
+
+            if best.ping(self.health_check_interval):
+                with self.lock:
+                    self.connections.append(best)
+                return best
+            with self.lock:
+                self.reconnects += 1
+        return self.open_connection()
+
+    def open_connection(self):
+        if self.legacy:
+            return None
+        channel = connect_channel(self.address, timeout=self.timeout)
+        if channel is None:
+            logger.warning("%s does not support the framed protocol, falling back to pickle", self.name)
+            self.legacy = True
+            return None
+        channel.sock.settimeout(None)
+        conn = PooledConnection(channel, self.name)
+        with self.lock:
+            self.connections.append(conn)
+        return conn
+
+    def request(self, message):
+        conn = self.checkout()
+        if conn is None:
+            return self.legacy_request(message)
+        try:
+            return conn.request(message, timeout=self.timeout)
+        except StaleConnectionError:
+            # The request never left, so retrying once on a fresh socket cannot apply it twice
+            with self.lock:
+                if conn in self.connections:
+                    self.connections.remove(conn)
+                self.reconnects += 1
+            conn = self.checkout()
+            if conn is None:
+                return self.legacy_request(message)
+            return conn.request(message, timeout=self.timeout)
+
+    def legacy_request(self, message):
+        with connect_channel(self.address, legacy=True, timeout=self.timeout) as channel:
+            channel.send(MSG_REQUEST, 0, message)
+            response = channel.recv()
+            if response is None:
+                raise ConnectionError(f"{self.name} closed the connection without a response")
+            return response[2]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "connections": len(self.connections),
+                "in_flight": sum(conn.in_flight for conn in self.connections),
+                "reconnects": self.reconnects,
+                "legacy": self.legacy,
+            }
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
@@ -1,9 +1,71 @@
 import sqlite3
 
-def create_database(db_name, base_id):
+# Schema changes after the initial tables, applied in order. PRAGMA user_version records how
+# many have run, so migrate() is cheap to call every time a server opens its database
+MIGRATIONS = [
+    # 1: indexes for track_loans; outstanding loans are found through Books(status, loan_id)
+    # in loan_id order, so each page is a short index range scan however large Loans grows
+    [
+        "CREATE INDEX IF NOT EXISTS idx_books_status_loan ON Books (status, loan_id)",
+        "CREATE INDEX IF NOT EXISTS idx_books_loan ON Books (loan_id)",
+        "CREATE INDEX IF NOT EXISTS idx_loans_user ON Loans (user_id, loan_id)",
+        "CREATE INDEX IF NOT EXISTS idx_loans_return_due ON Loans (return_date, due_date)",
+    ],
+    # 2: change log of the loans this library owns, and how far it has applied each peer's log
+    [
+        '''CREATE TABLE IF NOT EXISTS LoanLog (
+               seq INTEGER PRIMARY KEY AUTOINCREMENT,
+               kind TEXT,
+               loan_id INTEGER,
+               book_id INTEGER,
+               user_id INTEGER,
+               borrow_date DATE,
+               return_date DATE,
+               due_date DATE,
+               created REAL)''',
+        '''CREATE TABLE IF NOT EXISTS LogCursors (
+               origin TEXT PRIMARY KEY,
+               seq INTEGER,
+               applied_at REAL)''',
+    ],
+    # 3: results of retried pieces already applied here, keyed by (transaction, hop)
+    [
+        '''CREATE TABLE IF NOT EXISTS AppliedHops (
+               transaction_key TEXT,
+               hop_id INTEGER,
+               result TEXT,
+               applied_at REAL,
+               PRIMARY KEY (transaction_key, hop_id)) WITHOUT ROWID''',
+        "CREATE INDEX IF NOT EXISTS idx_applied_hops_time ON AppliedHops (applied_at)",
+    ],
+    # 4: highest loan id handed out here, which archiving the newest loans cannot move back
+    # the way it moves MAX(loan_id)
+    [
+        "CREATE TABLE IF NOT EXISTS LoanIds (high INTEGER)",
+        "INSERT INTO LoanIds (high) SELECT COALESCE(MAX(loan_id), 0) FROM Loans",
+    ],
+]
+
+
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        with conn:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {number}")
+    return len(MIGRATIONS) - version
+
+
+def migrate_database(db_name):
     conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
+    try:
+        return migrate(conn)
+    finally:
+        conn.close()
 
+
+def create_tables(cursor):
     cursor.execute('''CREATE TABLE IF NOT EXISTS Books (
                         book_id INTEGER PRIMARY KEY,
                         title TEXT,
@@ -28,7 +90,13 @@ def create_database(db_name, base_id):
                         name TEXT,
                         email TEXT,
                         membership TEXT)''')
-    
+
+
+def create_database(db_name, base_id):
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    create_tables(cursor)
+
     init_users = ((base_id + 1, 'User 1', 'user1@example.com', db_name), 
                   (base_id + 2, 'User 2', 'user2@example.com', db_name), 
                   (base_id + 3, 'User 3', 'user3@example.com', db_name))
@@ -45,9 +113,40 @@ def create_database(db_name, base_id):
                        VALUES (?, ?, ?, ?, ?, ?)''', init_books)
 
     conn.commit()
+    migrate(conn)
     conn.close()
     print(f"{db_name} created.")
 
+def split_database(db_name, shard_names, book_shard, user_shard):
+    # Seeds one file per sub-shard from a library's file. book_shard and user_shard map an id to
+    # the index of its sub-shard; a loan goes with its book
+    source = sqlite3.connect(db_name)
+    migrate(source)
+    # Every sub-shard starts above every loan id of the library, not just those it gets
+    high = source.execute("SELECT MAX(high, COALESCE((SELECT MAX(loan_id) FROM Loans), 0)) FROM LoanIds").fetchone()[0]
+    tables = {
+        'Books': ("book_id, title, author, publication_date, category, status, loan_id", book_shard),
+        'Users': ("user_id, name, email, membership", user_shard),
+        'Loans': ("book_id, loan_id, user_id, borrow_date, return_date, due_date", book_shard),
+    }
+    rows = {index: {table: [] for table in tables} for index in range(len(shard_names))}
+    for table, (columns, shard) in tables.items():
+        for row in source.execute(f"SELECT {columns} FROM {table}"):
+            rows[shard(row[0])][table].append(row)
+    source.close()
+    for index, name in enumerate(shard_names):
+        conn = sqlite3.connect(name)
+        create_tables(conn.cursor())
+        for table, (columns, _) in tables.items():
+            conn.executemany(f"INSERT INTO {table} ({columns}) VALUES ({', '.join('?' * len(columns.split(', ')))})",
+                             rows[index][table])
+        conn.commit()
+        migrate(conn)
+        conn.execute("UPDATE LoanIds SET high = ?", (high,))
+        conn.commit()
+        conn.close()
+
+
 def initialize_db():
     # Create three nodes
     create_database('Library A', 1000)
@@ -55,4 +154,5 @@ def initialize_db():
     create_database('Library C', 3000)
 
 
-initialize_db()
\ No newline at end of file
+if __name__ == "__main__":
+    initialize_db()
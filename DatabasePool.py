@@ -0,0 +1,110 @@
+import sqlite3
+import threading
+import uuid
+import queue
+from time import perf_counter
+from contextlib import contextmanager
+
+class DatabasePool:
+    def __init__(self, db_name, size=8, synchronous='NORMAL', cached_statements=256, busy_timeout=5000, memory=False):
+        self.db_name = db_name
+        # memory=True keeps the database in RAM, shared by the pool's connections under a name
+        # private to this pool; it lives as long as the pool does
+        self.memory = memory
+        self.uri = f"file:memory-{uuid.uuid4().hex}?mode=memory&cache=shared" if memory else None
+        self.size = size
+        self.synchronous = synchronous
+        self.cached_statements = cached_statements
+        self.busy_timeout = busy_timeout
+
+        self.idle = queue.LifoQueue(maxsize=size)
+        self.local = threading.local()
+        self.stats_lock = threading.Lock()
+        self.in_use = 0
+        self.max_in_use = 0
+        self.acquisitions = 0
+        self.waits = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+        # Open every connection once at startup so hops never pay for connect()
+        self.connections = [self.open_connection() for _ in range(size)]
+        for conn in self.connections:
+            self.idle.put(conn)
+
+    def open_connection(self):
+        # check_same_thread is off because a connection moves between handler threads,
+        # but the pool guarantees only one thread holds it at a time
+        conn = sqlite3.connect(self.uri or self.db_name, check_same_thread=False,
+                               cached_statements=self.cached_statements,
+                               timeout=self.busy_timeout / 1000, uri=self.memory)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout}")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        # Re-entrant per thread: a nested acquire reuses the connection the thread already holds
+        held = getattr(self.local, 'conn', None)
+        if held is not None:
+            self.local.depth += 1
+            try:
+                yield held
+            finally:
+                self.local.depth -= 1
+            return
+
+        conn = self.acquire()
+        self.local.conn = conn
+        self.local.depth = 0
+        try:
+            yield conn
+        finally:
+            self.local.conn = None
+            self.release(conn)
+
+    def acquire(self):
+        start = perf_counter()
+        try:
+            conn = self.idle.get_nowait()
+            waited = False
+        except queue.Empty:
+            conn = self.idle.get()
+            waited = True
+        wait_time = perf_counter() - start
+
+        with self.stats_lock:
+            self.acquisitions += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            if waited:
+                self.waits += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+        return conn
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self.stats_lock:
+            self.in_use -= 1
+        self.idle.put(conn)
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                "size": self.size,
+                "in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+                "utilization": self.in_use / self.size,
+                "acquisitions": self.acquisitions,
+                "waits": self.waits,
+                "total_wait_time": self.total_wait_time,
+                "avg_wait_time": self.total_wait_time / self.acquisitions if self.acquisitions else 0.0,
+                "max_wait_time": self.max_wait_time,
+            }
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
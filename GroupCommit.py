@@ -0,0 +1,134 @@
+import queue
+import threading
+from time import monotonic, perf_counter
+from Instrumentation import get_logger
+
+logger = get_logger('group_commit')
+
+class PendingHop:
+    def __init__(self, action, parameters, return_value, dedup=None):
+        self.action = action
+        self.parameters = parameters
+        self.return_value = return_value
+        self.dedup = dedup
+        self.result = None
+        self.queued = perf_counter()
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    # Collects hops from every client connection for up to `window` seconds (or
+    # max_batch_size hops) and commits them together, so one fsync covers the whole batch
+    def __init__(self, pool, run_action, window=0.002, max_batch_size=64, metrics=None, on_commit=None):
+        self.pool = pool
+        # Called with (action, parameters, result) for every successful hop once its batch committed
+        self.on_commit = on_commit
+        self.metrics = metrics
+        self.run_action = run_action
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.requests = queue.Queue()
+
+        self.stats_lock = threading.Lock()
+        self.batches = 0
+        self.hops = 0
+        self.max_batch = 0
+        self.batch_sizes = {}
+        self.failed_commits = 0
+
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, action, parameters, return_value = None, dedup = None):
+        return self.submit_many([(action, parameters, return_value)], [dedup])[0]
+
+    def submit_many(self, hops, dedups=None):
+        # Hops submitted together are queued back to back, so they commit in the given order
+        pending = [PendingHop(action, parameters, return_value, dedup)
+                   for (action, parameters, return_value), dedup in zip(hops, dedups or [None] * len(hops))]
+        for hop in pending:
+            self.requests.put(hop)
+        for hop in pending:
+            hop.done.wait()
+        return [hop.result for hop in pending]
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - monotonic()
+                try:
+                    if remaining > 0:
+                        batch.append(self.requests.get(timeout=remaining))
+                    else:
+                        batch.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            self.commit_batch(batch)
+
+    def commit_batch(self, batch):
+        started = perf_counter()
+        locked = None
+        committed = False
+        with self.pool.connection() as conn_db:
+            acquired = perf_counter()
+            try:
+                conn_db.execute("BEGIN IMMEDIATE")
+                locked = perf_counter()
+                for hop in batch:
+                    # A savepoint per hop lets a failed hop roll back without poisoning the batch
+                    conn_db.execute("SAVEPOINT hop")
+                    try:
+                        hop.result = self.run_action(conn_db, hop.action, hop.parameters, hop.return_value, hop.dedup)
+                    except Exception as e:
+                        hop.result = {"status": "Failed", "message": f"{hop.action} failed: {e}"}
+                    if hop.result.get('status') != 'Success':
+                        conn_db.execute("ROLLBACK TO hop")
+                    conn_db.execute("RELEASE hop")
+                conn_db.commit()
+                committed = True
+            except Exception as e:
+                if conn_db.in_transaction:
+                    conn_db.rollback()
+                logger.error("Group commit of %s hops failed: %s", len(batch), e)
+                with self.stats_lock:
+                    self.failed_commits += 1
+                for hop in batch:
+                    hop.result = {"status": "Failed", "message": f"Commit failed: {e}"}
+
+        if committed and self.on_commit is not None:
+            for hop in batch:
+                if hop.result.get('status') == 'Success':
+                    self.on_commit(hop.action, hop.parameters, hop.result)
+        if self.metrics is not None:
+            finished = perf_counter()
+            self.metrics.observe('pool_wait.group_commit', acquired - started)
+            if locked is not None:
+                # Time spent waiting for SQLite's write lock
+                self.metrics.observe('lock_wait.group_commit', locked - acquired)
+            self.metrics.observe('sql.group_commit', finished - acquired)
+            for hop in batch:
+                self.metrics.observe('queue_wait.group_commit', started - hop.queued)
+                self.metrics.inc(f"actions.{hop.action}.{hop.result.get('status')}")
+        with self.stats_lock:
+            size = len(batch)
+            self.batches += 1
+            self.hops += size
+            self.max_batch = max(self.max_batch, size)
+            self.batch_sizes[size] = self.batch_sizes.get(size, 0) + 1
+        for hop in batch:
+            hop.done.set()
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                "window": self.window,
+                "max_batch_size": self.max_batch_size,
+                "batches": self.batches,
+                "hops": self.hops,
+                "avg_batch_size": self.hops / self.batches if self.batches else 0.0,
+                "max_batch": self.max_batch,
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                "failed_commits": self.failed_commits,
+                "queued": self.requests.qsize(),
+            }
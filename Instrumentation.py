@@ -0,0 +1,325 @@
+import bisect
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import perf_counter, time
+from urllib.parse import urlparse, parse_qs
+
+# ---- Logging ----
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+ROOT_LOGGER = 'library'
+
+log_listener = None
+# Stream given to the last configure_logging call; None is stdout
+log_stream = None
+log_lock = threading.Lock()
+
+
+class StdoutHandler(logging.StreamHandler):
+    # Writes to whatever sys.stdout is when the record is written, so redirecting stdout
+    # (as test runners and the benchmark do) redirects the log with it
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    def emit(self, record):
+        self.stream = sys.stdout
+        super().emit(record)
+
+
+def get_logger(name):
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def configure_logging(level=None, stream=None):
+    # Records are put on a queue and written by a background listener, so a thread that logs
+    # never waits on stdout. The default level is WARNING: hot-path debug and info calls then
+    # cost a single isEnabledFor check and their arguments are never formatted
+    global log_listener, log_stream
+    if level is None:
+        level = os.environ.get('LIBRARY_LOG_LEVEL', 'WARNING')
+    if isinstance(level, str):
+        level = getattr(logging, level.upper())
+    with log_lock:
+        logger = logging.getLogger(ROOT_LOGGER)
+        logger.setLevel(level)
+        if log_listener is not None and stream is log_stream:
+            return logger
+        if log_listener is not None:
+            log_listener.stop()
+            logger.handlers = []
+        records = queue.SimpleQueue()
+        handler = logging.StreamHandler(stream) if stream is not None else StdoutHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        log_stream = stream
+        log_listener = logging.handlers.QueueListener(records, handler)
+        log_listener.start()
+        logger.addHandler(logging.handlers.QueueHandler(records))
+        logger.propagate = False
+        return logger
+
+
+def flush_logging():
+    # Stops the listener after it has written everything queued so far, then restarts it
+    with log_lock:
+        if log_listener is not None:
+            log_listener.stop()
+            log_listener.start()
+
+
+configure_logging()
+
+
+# ---- Metrics ----
+
+# Bucket upper bounds in seconds, doubling from 1 microsecond to about 2 minutes
+BUCKETS = [1e-6 * 2 ** k for k in range(28)]
+
+
+class Histogram:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(BUCKETS, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        target = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return BUCKETS[index] if index < len(BUCKETS) else self.max
+        return None
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else 0.0,
+                "max": self.max,
+                "p50": self.quantile(0.5),
+                "p99": self.quantile(0.99),
+                "p999": self.quantile(0.999),
+                "buckets": {f"{BUCKETS[index]:.6g}" if index < len(BUCKETS) else "+Inf": count
+                            for index, count in enumerate(self.counts) if count},
+            }
+
+
+class MetricsRegistry:
+    # Counters, timing histograms and gauges of one server. Gauges are callbacks read at
+    # scrape time, so components that keep their own stats() need no extra bookkeeping
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.started = time()
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start)
+
+    def register_gauge(self, name, read):
+        with self.lock:
+            self.gauges[name] = read
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+            gauges = dict(self.gauges)
+        gauge_values = {}
+        for name, read in gauges.items():
+            try:
+                gauge_values[name] = read()
+            except Exception as e:
+                gauge_values[name] = {"error": str(e)}
+        return {
+            "time": time(),
+            "uptime": time() - self.started,
+            "counters": dict(sorted(counters.items())),
+            "timers": {name: histogram.snapshot() for name, histogram in sorted(histograms.items())},
+            "gauges": gauge_values,
+        }
+
+
+class SnapshotWriter:
+    # Writes the registry to a JSON file every `interval` seconds, replacing it atomically
+    def __init__(self, metrics, path, interval=10.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def write(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.metrics.snapshot(), f, indent=2, default=str)
+        os.replace(tmp_path, self.path)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                get_logger('metrics').warning("Could not write metrics snapshot %s: %s", self.path, e)
+
+    def stop(self):
+        self.stopped.set()
+
+
+# ---- Profiling ----
+
+class SamplingProfiler:
+    # Samples the stacks of every other thread while running; costs nothing when stopped
+    def __init__(self, interval=0.005, max_depth=32):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.lock = threading.Lock()
+        self.stacks = {}
+        self.samples = 0
+        self.thread = None
+        self.stopped = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval=None):
+        with self.lock:
+            if self.running:
+                return False
+            if interval is not None:
+                self.interval = interval
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        return self.report()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            collapsed = []
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                collapsed.append(';'.join(reversed(stack)))
+            with self.lock:
+                self.samples += 1
+                for stack in collapsed:
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def report(self, top=50):
+        # Collapsed stacks (root;...;leaf), the input format of flame graph tools
+        with self.lock:
+            ranked = sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)[:top]
+            return {"running": self.running, "interval": self.interval, "samples": self.samples,
+                    "stacks": [{"stack": stack, "count": count} for stack, count in ranked]}
+
+    def reset(self):
+        with self.lock:
+            self.stacks = {}
+            self.samples = 0
+
+
+# ---- Scrape endpoint ----
+
+class MetricsEndpoint:
+    # Local HTTP endpoint: GET /metrics for the snapshot, /profile, /profile/start?interval=
+    # and /profile/stop to drive the sampling profiler at runtime
+    def __init__(self, metrics, profiler=None, address=('localhost', 0)):
+        self.metrics = metrics
+        self.profiler = profiler
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                body = endpoint.handle(url.path, parse_qs(url.query))
+                status = 404 if body is None else 200
+                data = json.dumps(body if body is not None else {"error": f"Unknown path {url.path}"},
+                                  default=str).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                get_logger('metrics').debug(format, *args)
+
+        self.server = ThreadingHTTPServer(address, Handler)
+        self.server.daemon_threads = True
+        self.address = self.server.server_address
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def handle(self, path, query):
+        if path == '/metrics':
+            return self.metrics.snapshot()
+        if self.profiler is None or not path.startswith('/profile'):
+            return None
+        if path == '/profile/start':
+            interval = float(query['interval'][0]) if 'interval' in query else None
+            return {"started": self.profiler.start(interval)}
+        if path == '/profile/stop':
+            return self.profiler.stop()
+        if path == '/profile/reset':
+            self.profiler.reset()
+            return {"reset": True}
+        if path == '/profile':
+            return self.profiler.report()
+        return None
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,206 @@
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from Instrumentation import get_logger
+
+logger = get_logger('key_scheduler')
+
+# Actions that read across every key of the node and so conflict with all other hops
+GLOBAL_ACTIONS = {'track_loans'}
+
+
+def hop_keys(action, parameters, return_value = None):
+    if action in GLOBAL_ACTIONS:
+        return None
+    keys = set()
+    if 'book_id' in parameters:
+        keys.add(('book', parameters['book_id']))
+    if 'user_id' in parameters:
+        keys.add(('user', parameters['user_id']))
+    for row in parameters.get('books', ()):
+        keys.add(('book', row['book_id']))
+    for row in parameters.get('users', ()):
+        keys.add(('user', row['user_id']))
+    loan_id = (return_value or {}).get('loan_id')
+    if loan_id is not None:
+        keys.add(('loan', loan_id))
+    return sorted(keys, key=str)
+
+
+class ScheduledHop:
+    def __init__(self, order, keys, item):
+        self.order = order
+        self.keys = keys
+        self.item = item
+        self.arrived = monotonic()
+        self.running = False
+        self.blocked_by = set()
+
+    @property
+    def is_global(self):
+        return self.keys is None
+
+
+class KeyContention:
+    def __init__(self):
+        self.waits = 0
+        self.total_wait = 0.0
+        self.lock_wait = 0.0
+
+
+class KeyScheduler:
+    # Orders only conflicting hops: a hop runs once it is the earliest submitted hop queued on
+    # each of its keys, so hops on disjoint keys run in parallel on the worker pool. Callers
+    # submit hops in the order they must take effect, e.g. as released by a ReorderBuffer
+    def __init__(self, execute, fail=None, workers=8, lock_stripes=1024, metrics=None):
+        self.execute = execute
+        self.metrics = metrics
+        # Called with (item, exception) when execute raises, so the hop still gets an answer
+        self.fail = fail
+        self.workers = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.tickets = itertools.count()
+        self.queues = {}
+        self.global_queue = []
+        self.entries = {}
+        # Striped key locks keep memory bounded however many keys the node sees
+        self.key_locks = [threading.Lock() for _ in range(lock_stripes)]
+        self.contention = {}
+        self.running = 0
+        self.max_running = 0
+        self.dispatched = 0
+
+    def submit(self, keys, item):
+        entry = ScheduledHop(next(self.tickets), keys, item)
+        with self.lock:
+            self.entries[entry.order] = entry
+            if entry.is_global:
+                heapq.heappush(self.global_queue, entry.order)
+            else:
+                for key in keys:
+                    heapq.heappush(self.queues.setdefault(key, []), entry.order)
+            ready = self.claim(entry)
+            if not ready:
+                entry.blocked_by = self.blockers(entry)
+        if ready:
+            self.dispatch(entry)
+
+    def is_ready(self, entry):
+        if entry.running:
+            return False
+        earliest_global = self.global_queue[0] if self.global_queue else None
+        if entry.is_global:
+            return earliest_global == entry.order and all(queue[0] > entry.order for queue in self.queues.values())
+        if earliest_global is not None and earliest_global < entry.order:
+            return False
+        return all(self.queues[key][0] == entry.order for key in entry.keys)
+
+    def blockers(self, entry):
+        if entry.is_global:
+            return {('*',)}
+        return {key for key in entry.keys if self.queues[key][0] != entry.order} or {('*',)}
+
+    def claim(self, entry):
+        if not self.is_ready(entry):
+            return False
+        entry.running = True
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        self.dispatched += 1
+        wait = monotonic() - entry.arrived
+        for key in entry.blocked_by:
+            stats = self.contention.setdefault(key, KeyContention())
+            stats.waits += 1
+            stats.total_wait += wait
+        return True
+
+    def dispatch(self, entry):
+        self.workers.submit(self.run, entry)
+
+    def run(self, entry):
+        locks = [] if entry.is_global else self.locks_for(entry.keys)
+        start = monotonic()
+        for lock in locks:
+            lock.acquire()
+        lock_wait = monotonic() - start
+        if self.metrics is not None:
+            self.metrics.observe('queue_wait.key_scheduler', start - entry.arrived)
+            self.metrics.observe('lock_wait.key_scheduler', lock_wait)
+        try:
+            if entry.keys and lock_wait > 0.001:
+                with self.lock:
+                    self.contention.setdefault(entry.keys[0], KeyContention()).lock_wait += lock_wait
+            self.execute(entry.item)
+        except Exception as e:
+            logger.exception("Scheduled hop %s failed", entry.order)
+            if self.fail is not None:
+                self.fail(entry.item, e)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+            self.finish(entry)
+
+    def run_unordered(self, keys, function):
+        # For hops that need no ordering: still take the key locks so they never interleave
+        # with a scheduled hop on the same keys
+        locks = self.locks_for(keys or [])
+        for lock in locks:
+            lock.acquire()
+        try:
+            return function()
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def locks_for(self, keys):
+        # Stripes are taken in ascending index order, which rules out lock-order deadlocks
+        stripes = sorted({hash(key) % len(self.key_locks) for key in keys})
+        return [self.key_locks[stripe] for stripe in stripes]
+
+    def finish(self, entry):
+        ready = []
+        with self.lock:
+            self.running -= 1
+            del self.entries[entry.order]
+            if entry.is_global:
+                self.global_queue.remove(entry.order)
+                heapq.heapify(self.global_queue)
+                candidates = [queue[0] for queue in self.queues.values()]
+            else:
+                candidates = []
+                for key in entry.keys:
+                    queue = self.queues[key]
+                    queue.remove(entry.order)
+                    if queue:
+                        heapq.heapify(queue)
+                        candidates.append(queue[0])
+                    else:
+                        del self.queues[key]
+            if self.global_queue:
+                candidates.append(self.global_queue[0])
+
+            for order in dict.fromkeys(candidates):
+                candidate = self.entries[order]
+                if self.claim(candidate):
+                    ready.append(candidate)
+        for candidate in ready:
+            self.dispatch(candidate)
+
+    def hot_keys(self, n=10):
+        with self.lock:
+            ranked = sorted(self.contention.items(), key=lambda item: item[1].total_wait, reverse=True)[:n]
+            return [{"key": list(key), "waits": stats.waits, "total_wait": stats.total_wait,
+                     "lock_wait": stats.lock_wait} for key, stats in ranked]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": len(self.entries),
+                "running": self.running,
+                "max_running": self.max_running,
+                "dispatched": self.dispatched,
+                "queued_keys": len(self.queues),
+                "hot_keys_tracked": len(self.contention),
+            }
@@ -0,0 +1,181 @@
+import random
+import sqlite3
+import threading
+import uuid
+from time import time
+from Protocol import encode, decode
+from Instrumentation import get_logger
+
+logger = get_logger('outbox')
+
+# Seconds a piece is retried before it is given up on. Libraries remember the pieces they
+# applied for longer than this (Server's dedup_retention), so every retry is recognised
+DEFAULT_MAX_AGE = 6 * 3600.0
+
+
+def backoff_delay(attempt, base=0.05, cap=30.0):
+    # Exponential backoff with full jitter: retries of many clients spread out instead of
+    # hitting a recovering library in lockstep
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class OutboxEntry:
+    def __init__(self, entry_id, transaction_key, hop, return_value, attempts, created):
+        self.entry_id = entry_id
+        self.transaction_key = transaction_key
+        self.hop = hop
+        self.return_value = return_value
+        self.attempts = attempts
+        self.created = created
+
+
+class Outbox:
+    # Durable queue of the later pieces of transactions whose first piece committed. Chopping
+    # lets such a piece be retried until it commits, so an entry is only deleted once a library
+    # acknowledged it. The file also keeps the client's key, so after a restart the client
+    # resends its pending pieces under the same (transaction, hop) identity and the libraries
+    # recognise the ones they already applied. A piece is given up on after max_attempts
+    # deliveries or once it has been queued for max_age seconds, whichever comes first
+    def __init__(self, path, retry_base=0.05, retry_cap=30.0, max_attempts=None, max_age=DEFAULT_MAX_AGE):
+        self.path = path
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self.max_attempts = max_attempts
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS Outbox (
+                                 entry_id INTEGER PRIMARY KEY,
+                                 transaction_key TEXT,
+                                 hop_id INTEGER,
+                                 hop BLOB,
+                                 return_value BLOB,
+                                 attempts INTEGER DEFAULT 0,
+                                 next_attempt REAL,
+                                 last_error TEXT,
+                                 dead INTEGER DEFAULT 0,
+                                 created REAL,
+                                 UNIQUE (transaction_key, hop_id))''')
+        if 'created' not in {row[1] for row in self.conn.execute("PRAGMA table_info(Outbox)")}:
+            # A file from before entries were dated: their age counts from now
+            self.conn.execute(f"ALTER TABLE Outbox ADD COLUMN created REAL DEFAULT {time()}")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS OutboxMeta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("INSERT OR IGNORE INTO OutboxMeta (key, value) VALUES ('client_key', ?)", (uuid.uuid4().hex,))
+        self.conn.commit()
+        self.client_key = self.conn.execute("SELECT value FROM OutboxMeta WHERE key = 'client_key'").fetchone()[0]
+        # Entries handed to a worker and not yet settled
+        self.claimed = set()
+        self.closed = False
+
+        self.enqueued = 0
+        self.delivered = 0
+        self.retries = 0
+        self.dead = 0
+
+    def enqueue(self, transaction_key, hops, return_value=None):
+        now = time()
+        rows = [(transaction_key, hop.hop_id, encode(hop), encode(return_value), now, now) for hop in hops]
+        with self.wakeup:
+            with self.conn:
+                self.conn.executemany("INSERT OR IGNORE INTO Outbox (transaction_key, hop_id, hop, return_value, next_attempt, "
+                                      "created) VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.enqueued += len(rows)
+            self.wakeup.notify_all()
+
+    def claim(self, timeout=1.0):
+        # The due entry waiting longest, or None when nothing is due within `timeout`
+        deadline = time() + timeout
+        with self.wakeup:
+            while not self.closed:
+                row = self.conn.execute("SELECT entry_id, transaction_key, hop, return_value, attempts, created, next_attempt "
+                                        "FROM Outbox WHERE dead = 0 AND entry_id NOT IN (SELECT value FROM json_each(?)) "
+                                        "ORDER BY next_attempt LIMIT 1", (f"[{','.join(map(str, self.claimed))}]",)).fetchone()
+                now = time()
+                if row is not None:
+                    entry_id, transaction_key, hop, return_value, attempts, created, next_attempt = row
+                    if next_attempt <= now:
+                        self.claimed.add(entry_id)
+                        return OutboxEntry(entry_id, transaction_key, decode(hop), decode(return_value), attempts,
+                                           created)
+                if now >= deadline:
+                    return None
+                # Woken early by enqueue or a failed delivery, or when the next entry falls due
+                self.wakeup.wait(min(deadline, next_attempt if row is not None else deadline) - now)
+            return None
+
+    def delivered_entry(self, entry):
+        with self.wakeup:
+            if self.closed:
+                # Still pending in the file; the next run resends it and the library deduplicates
+                return
+            with self.conn:
+                self.conn.execute("DELETE FROM Outbox WHERE entry_id = ?", (entry.entry_id,))
+            self.claimed.discard(entry.entry_id)
+            self.delivered += 1
+
+    def failed_entry(self, entry, error):
+        attempts = entry.attempts + 1
+        dead = (self.max_attempts is not None and attempts >= self.max_attempts or
+                self.max_age is not None and time() - entry.created >= self.max_age)
+        with self.wakeup:
+            if self.closed:
+                return
+            with self.conn:
+                self.conn.execute("UPDATE Outbox SET attempts = ?, next_attempt = ?, last_error = ?, dead = ? "
+                                  "WHERE entry_id = ?",
+                                  (attempts, time() + backoff_delay(attempts, self.retry_base, self.retry_cap),
+                                   str(error), int(dead), entry.entry_id))
+            self.claimed.discard(entry.entry_id)
+            self.retries += 1
+            if dead:
+                self.dead += 1
+                logger.error("Giving up on hop %s of transaction %s after %s attempts in %.0fs: %s",
+                             entry.hop.hop_id, entry.transaction_key, attempts, time() - entry.created, error)
+            self.wakeup.notify_all()
+
+    def stats(self):
+        with self.lock:
+            pending = self.conn.execute("SELECT COUNT(*) FROM Outbox WHERE dead = 0").fetchone()[0]
+            return {"pending": pending, "in_flight": len(self.claimed), "enqueued": self.enqueued,
+                    "delivered": self.delivered, "retries": self.retries, "dead": self.dead}
+
+    def close(self):
+        with self.wakeup:
+            self.closed = True
+            self.wakeup.notify_all()
+        # Workers only touch the connection under the lock, so it is safe to close now
+        with self.lock:
+            self.conn.close()
+
+
+class OutboxWorkers:
+    # Fixed pool of threads delivering outbox entries through `send`, which returns the
+    # library's response to one hop
+    def __init__(self, outbox, send, workers=4):
+        self.outbox = outbox
+        self.send = send
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        while not self.outbox.closed:
+            entry = self.outbox.claim()
+            if entry is None:
+                continue
+            try:
+                response = self.send(entry)
+            except Exception as e:
+                response = {"status": "Failed", "message": str(e)}
+            if response.get('status') == 'Success':
+                self.outbox.delivered_entry(entry)
+            else:
+                logger.debug("Hop %s of transaction %s failed, retrying: %s",
+                             entry.hop.hop_id, entry.transaction_key, response.get('message'))
+                self.outbox.failed_entry(entry, response.get('message'))
+
+    def join(self, timeout=None):
+        for thread in self.threads:
+            thread.join(timeout)
@@ -1,21 +1,230 @@
+import bisect
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from Instrumentation import get_logger
+
+logger = get_logger('partition')
+
+DEFAULT_NODES = ['Library A', 'Library B', 'Library C']
+# Each entry is the first id of a range; a range runs up to the next start and the first
+# range also takes every id below it
+DEFAULT_RANGES = [[1000, 'Library A'], [2000, 'Library B'], [3000, 'Library C']]
+
+
+class RangeMap:
+    def __init__(self, ranges):
+        ranges = sorted(ranges)
+        self.starts = [start for start, _ in ranges]
+        self.nodes = [node for _, node in ranges]
+
+    def lookup(self, key):
+        index = bisect.bisect_right(self.starts, key) - 1
+        return self.nodes[max(index, 0)]
+
+    def assign(self, start, end, node):
+        # Split at both ends, then hand every range inside [start, end) to `node`
+        for boundary in (start, end):
+            if boundary is not None and boundary not in self.starts:
+                owner = self.lookup(boundary)
+                index = bisect.bisect_left(self.starts, boundary)
+                self.starts.insert(index, boundary)
+                self.nodes.insert(index, owner)
+        for index, range_start in enumerate(self.starts):
+            if range_start >= start and (end is None or range_start < end):
+                self.nodes[index] = node
+        self.merge()
+
+    def merge(self):
+        starts, nodes = self.starts[:1], self.nodes[:1]
+        for start, node in zip(self.starts[1:], self.nodes[1:]):
+            if node != nodes[-1]:
+                starts.append(start)
+                nodes.append(node)
+        self.starts, self.nodes = starts, nodes
+
+    def to_list(self):
+        return [[start, node] for start, node in zip(self.starts, self.nodes)]
+
+
+class HashRing:
+    def __init__(self, nodes, vnodes=64):
+        self.vnodes = vnodes
+        ring = sorted((self.hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self.hashes = [h for h, _ in ring]
+        self.nodes = [node for _, node in ring]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+    def lookup(self, key):
+        index = bisect.bisect(self.hashes, self.hash(key)) % len(self.hashes)
+        return self.nodes[index]
+
+
+class PartitionDirectory:
+    # Single source of routing for clients and servers. Every change bumps the epoch so
+    # servers can tell a stale client and redirect it
+    def __init__(self, nodes=DEFAULT_NODES, book_ranges=DEFAULT_RANGES, user_ranges=DEFAULT_RANGES,
+                 kind='range', epoch=0, path=None, vnodes=64):
+        self.nodes = list(nodes)
+        self.kind = kind
+        self.epoch = epoch
+        self.path = path
+        self.vnodes = vnodes
+        self.lock = threading.Lock()
+        self.loaded_mtime = None
+        if kind == 'hash':
+            self.books = HashRing(self.nodes, vnodes)
+            self.users = self.books
+        elif kind == 'range':
+            self.books = RangeMap(book_ranges)
+            self.users = RangeMap(user_ranges)
+        else:
+            raise ValueError(f"Unknown partitioning kind {kind}")
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            config = json.load(f)
+        directory = cls.from_dict(config, path)
+        directory.loaded_mtime = os.path.getmtime(path)
+        return directory
+
+    @classmethod
+    def from_dict(cls, config, path=None):
+        return cls(nodes=config.get('nodes', DEFAULT_NODES),
+                   book_ranges=config.get('book_ranges', DEFAULT_RANGES),
+                   user_ranges=config.get('user_ranges', DEFAULT_RANGES),
+                   kind=config.get('kind', 'range'),
+                   epoch=config.get('epoch', 0),
+                   path=path,
+                   vnodes=config.get('vnodes', 64))
+
+    def to_dict(self):
+        config = {"epoch": self.epoch, "kind": self.kind, "nodes": self.nodes}
+        if self.kind == 'range':
+            config["book_ranges"] = self.books.to_list()
+            config["user_ranges"] = self.users.to_list()
+        else:
+            config["vnodes"] = self.vnodes
+        return config
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_path, self.path)
+        self.loaded_mtime = os.path.getmtime(self.path)
+
+    def update(self, config):
+        # Adopt a newer routing table, e.g. one carried by a redirect
+        if config.get('epoch', 0) <= self.epoch:
+            return False
+        fresh = PartitionDirectory.from_dict(config, self.path)
+        with self.lock:
+            self.nodes, self.kind, self.epoch = fresh.nodes, fresh.kind, fresh.epoch
+            self.books, self.users = fresh.books, fresh.users
+        return True
+
+    def refresh(self):
+        # Pick up moves made by another process through the shared config file
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        if os.path.getmtime(self.path) == self.loaded_mtime:
+            return False
+        with open(self.path) as f:
+            updated = self.update(json.load(f))
+        self.loaded_mtime = os.path.getmtime(self.path)
+        return updated
+
+    def node_for_book(self, book_id):
+        return self.books.lookup(book_id)
+
+    def node_for_user(self, user_id):
+        return self.users.lookup(user_id)
+
+    def replicas(self, node):
+        return [other for other in self.nodes if other != node]
+
+    def move_books(self, start, end, target, databases):
+        # Move books with start <= book_id < end to `target`. Rows are copied and deleted in one
+        # transaction that keeps every source locked, and the new epoch is published before it
+        # commits, so no server can serve the range from a source that has lost its rows
+        if self.kind != 'range':
+            raise ValueError("Only range partitioning supports moving ranges")
+        sources = {self.node_for_book(key) for key in self.books.starts
+                   if key >= start and (end is None or key < end)}
+        sources.add(self.node_for_book(start))
+        sources.discard(target)
+        upper = end if end is not None else 2**63 - 1
+
+        moved = 0
+        previous = self.books.to_list()
+        published = False
+        conn = sqlite3.connect(databases[target], timeout=30)
+        aliases = []
+        try:
+            for index, source in enumerate(sorted(sources)):
+                alias = f"source{index}"
+                conn.execute(f"ATTACH DATABASE ? AS {alias}", (databases[source],))
+                aliases.append(alias)
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for alias in aliases:
+                    conn.execute(f"""INSERT OR IGNORE INTO main.Loans SELECT * FROM {alias}.Loans
+                                     WHERE loan_id IN (SELECT loan_id FROM {alias}.Books
+                                                       WHERE book_id >= ? AND book_id < ? AND loan_id IS NOT NULL)""",
+                                 (start, upper))
+                    cursor = conn.execute(f"""INSERT OR REPLACE INTO main.Books SELECT * FROM {alias}.Books
+                                              WHERE book_id >= ? AND book_id < ?""", (start, upper))
+                    moved += cursor.rowcount
+                    conn.execute(f"DELETE FROM {alias}.Books WHERE book_id >= ? AND book_id < ?", (start, upper))
+                self.publish_books(start, end, target)
+                published = True
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                if published:
+                    # The rows stayed where they were, so route the range back to them
+                    self.publish_ranges(previous)
+                raise
+            finally:
+                for alias in aliases:
+                    conn.execute(f"DETACH DATABASE {alias}")
+        finally:
+            conn.close()
+
+        logger.info("Moved %s books in [%s, %s) to %s, routing epoch is now %s", moved, start, end, target, self.epoch)
+        return moved
+
+    def publish_books(self, start, end, target):
+        with self.lock:
+            self.books.assign(start, end, target)
+            self.epoch += 1
+        self.save()
+
+    def publish_ranges(self, book_ranges):
+        with self.lock:
+            self.books = RangeMap(book_ranges)
+            self.epoch += 1
+        self.save()
+
+
 class PartitionStrategy:
-    def __init__(self, servers):
+    def __init__(self, servers, directory=None):
         self.servers = servers
+        self.directory = directory or PartitionDirectory(list(servers))
 
     def get_server_for_user(self, user_id):
         # 根據用戶ID範圍分區
-        if user_id < 2000:
-            return 'Library A'
-        elif user_id < 3000:
-            return 'Library B'
-        else:
-            return 'Library C'
+        return self.directory.node_for_user(user_id)
 
     def get_server_for_book(self, book_id):
         # 根據書籍ID範圍分區
-        if book_id < 2000:
-            return 'Library A'
-        elif book_id < 3000:
-            return 'Library B'
-        else:
-            return 'Library C'
\ No newline at end of file
+        return self.directory.node_for_book(book_id)
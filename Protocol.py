@@ -0,0 +1,328 @@
+import socket
+import struct
+import pickle
+import threading
+from time import perf_counter
+from Hop import Hop
+from Transaction import Transaction
+
+# Frame header: magic, message type, flags, request id, payload length
+MAGIC = b'TP'
+VERSION = 1
+HEADER = struct.Struct('!2sBBII')
+CHUNK_SIZE = 64 * 1024
+
+MSG_HELLO = 1
+MSG_REQUEST = 2
+MSG_RESPONSE = 3
+MSG_PING = 4
+MSG_PONG = 5
+
+# Set on every chunk of a streamed message except the last one
+FLAG_MORE = 0x01
+
+INT64 = struct.Struct('!q')
+FLOAT64 = struct.Struct('!d')
+LENGTH = struct.Struct('!I')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# ---- Schema-based encoding ----
+
+def encode(obj):
+    buf = bytearray()
+    encode_into(buf, obj)
+    return buf
+
+
+def encode_into(buf, obj):
+    if obj is None:
+        buf += b'N'
+    elif obj is True:
+        buf += b'T'
+    elif obj is False:
+        buf += b'F'
+    elif isinstance(obj, int):
+        if -2**63 <= obj < 2**63:
+            buf += b'i'
+            buf += INT64.pack(obj)
+        else:
+            encode_bytes(buf, b'L', str(obj).encode())
+    elif isinstance(obj, float):
+        buf += b'f'
+        buf += FLOAT64.pack(obj)
+    elif isinstance(obj, str):
+        encode_bytes(buf, b's', obj.encode())
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        encode_bytes(buf, b'b', obj)
+    elif isinstance(obj, list):
+        encode_sequence(buf, b'l', obj)
+    elif isinstance(obj, tuple):
+        encode_sequence(buf, b't', obj)
+    elif isinstance(obj, dict):
+        buf += b'd'
+        buf += LENGTH.pack(len(obj))
+        for key, value in obj.items():
+            encode_into(buf, key)
+            encode_into(buf, value)
+    elif isinstance(obj, Hop):
+        buf += b'H'
+        encode_into(buf, obj.hop_id)
+        encode_into(buf, obj.node)
+        encode_into(buf, obj.action)
+        encode_into(buf, obj.parameters)
+        encode_into(buf, obj.sequence_number)
+    elif isinstance(obj, Transaction):
+        buf += b'X'
+        encode_into(buf, obj.transaction_id)
+        encode_into(buf, obj.type)
+        encode_sequence(buf, b'l', obj.hops)
+        encode_into(buf, obj.sequence_number)
+    else:
+        raise ProtocolError(f"Cannot encode object of type {type(obj).__name__}")
+
+
+def encode_bytes(buf, tag, data):
+    buf += tag
+    buf += LENGTH.pack(len(data))
+    buf += data
+
+
+def encode_sequence(buf, tag, items):
+    buf += tag
+    buf += LENGTH.pack(len(items))
+    for item in items:
+        encode_into(buf, item)
+
+
+def decode(data):
+    view = memoryview(data)
+    obj, offset = decode_from(view, 0)
+    if offset != len(view):
+        raise ProtocolError(f"Trailing {len(view) - offset} bytes after message")
+    return obj
+
+
+def decode_from(view, offset):
+    tag = view[offset:offset + 1].tobytes()
+    offset += 1
+    if tag == b'N':
+        return None, offset
+    if tag == b'T':
+        return True, offset
+    if tag == b'F':
+        return False, offset
+    if tag == b'i':
+        return INT64.unpack_from(view, offset)[0], offset + INT64.size
+    if tag == b'f':
+        return FLOAT64.unpack_from(view, offset)[0], offset + FLOAT64.size
+    if tag in (b's', b'b', b'L'):
+        length = LENGTH.unpack_from(view, offset)[0]
+        offset += LENGTH.size
+        data = view[offset:offset + length]
+        offset += length
+        if tag == b's':
+            return str(data, 'utf-8'), offset
+        if tag == b'L':
+            return int(str(data, 'ascii')), offset
+        return data.tobytes(), offset
+    if tag in (b'l', b't'):
+        count = LENGTH.unpack_from(view, offset)[0]
+        offset += LENGTH.size
+        items = []
+        for _ in range(count):
+            item, offset = decode_from(view, offset)
+            items.append(item)
+        return (items if tag == b'l' else tuple(items)), offset
+    if tag == b'd':
+        count = LENGTH.unpack_from(view, offset)[0]
+        offset += LENGTH.size
+        result = {}
+        for _ in range(count):
+            key, offset = decode_from(view, offset)
+            value, offset = decode_from(view, offset)
+            result[key] = value
+        return result, offset
+    if tag == b'H':
+        fields = []
+        for _ in range(5):
+            field, offset = decode_from(view, offset)
+            fields.append(field)
+        hop_id, node, action, parameters, sequence_number = fields
+        return Hop(hop_id, node, action, parameters, sequence_number), offset
+    if tag == b'X':
+        fields = []
+        for _ in range(4):
+            field, offset = decode_from(view, offset)
+            fields.append(field)
+        transaction_id, type, hops, sequence_number = fields
+        return Transaction(transaction_id, type, hops, sequence_number), offset
+    raise ProtocolError(f"Unknown type tag {tag!r}")
+
+
+# ---- Framing ----
+
+def recv_exactly(sock, length):
+    # Read straight into a preallocated buffer instead of concatenating recv() results
+    buf = bytearray(length)
+    view = memoryview(buf)
+    received = 0
+    while received < length:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            if received == 0:
+                return None
+            raise ProtocolError("Connection closed in the middle of a frame")
+        received += n
+    return buf
+
+
+class FramedChannel:
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.partial = {}
+        self.legacy = False
+        # Optional MetricsRegistry that gets encode/decode times
+        self.metrics = None
+
+    def send(self, msg_type, request_id, message):
+        start = perf_counter()
+        payload = memoryview(encode(message))
+        if self.metrics is not None:
+            self.metrics.observe('serialize.encode', perf_counter() - start)
+        total = len(payload)
+        offset = 0
+        # Large payloads go out as a stream of chunks; the lock is taken per chunk so
+        # responses to other requests on the same connection can be interleaved
+        while True:
+            chunk = payload[offset:offset + CHUNK_SIZE]
+            offset += len(chunk)
+            flags = FLAG_MORE if offset < total else 0
+            frame = bytearray(HEADER.size + len(chunk))
+            HEADER.pack_into(frame, 0, MAGIC, msg_type, flags, request_id, len(chunk))
+            frame[HEADER.size:] = chunk
+            with self.send_lock:
+                self.sock.sendall(frame)
+            if offset >= total:
+                break
+
+    def recv(self):
+        while True:
+            header = recv_exactly(self.sock, HEADER.size)
+            if header is None:
+                return None
+            magic, msg_type, flags, request_id, length = HEADER.unpack(header)
+            if magic != MAGIC:
+                raise ProtocolError(f"Bad frame magic {magic!r}")
+            payload = recv_exactly(self.sock, length) if length else bytearray()
+            if payload is None:
+                raise ProtocolError("Connection closed in the middle of a frame")
+
+            if flags & FLAG_MORE:
+                self.partial.setdefault(request_id, []).append(payload)
+                continue
+            if request_id in self.partial:
+                chunks = self.partial.pop(request_id)
+                chunks.append(payload)
+                payload = b''.join(chunks)
+            if msg_type == MSG_PING:
+                # Health checks are answered here so servers never see them
+                self.send(MSG_PONG, request_id, None)
+                continue
+            if self.metrics is None:
+                return msg_type, request_id, decode(payload)
+            start = perf_counter()
+            message = decode(payload)
+            self.metrics.observe('serialize.decode', perf_counter() - start)
+            return msg_type, request_id, message
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PickleChannel:
+    # Fallback for peers that still speak the original pickle-per-recv format
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.legacy = True
+        self.metrics = None
+
+    def send(self, msg_type, request_id, message):
+        with self.send_lock:
+            self.sock.sendall(pickle.dumps(message))
+
+    def recv(self):
+        data = b''
+        while True:
+            chunk = self.sock.recv(CHUNK_SIZE)
+            if not chunk:
+                if data:
+                    raise ProtocolError("Connection closed in the middle of a message")
+                return None
+            data += chunk
+            try:
+                return MSG_REQUEST, 0, pickle.loads(data)
+            except (EOFError, pickle.UnpicklingError):
+                continue
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ---- Negotiation ----
+
+def accept_channel(conn):
+    # Framed peers open with a HELLO frame; anything else is treated as a pickle peer
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    magic = conn.recv(len(MAGIC), socket.MSG_PEEK | socket.MSG_WAITALL)
+    if magic != MAGIC:
+        return PickleChannel(conn)
+
+    channel = FramedChannel(conn)
+    message = channel.recv()
+    if message is None or message[0] != MSG_HELLO:
+        raise ProtocolError("Expected HELLO as the first frame")
+    version = min(VERSION, message[2].get('version', VERSION))
+    channel.send(MSG_HELLO, message[1], {'version': version})
+    return channel
+
+
+def connect_channel(address, legacy=False, timeout=None):
+    sock = socket.create_connection(address, timeout=timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if legacy:
+        return PickleChannel(sock)
+
+    channel = FramedChannel(sock)
+    try:
+        channel.send(MSG_HELLO, 0, {'version': VERSION})
+        reply = channel.recv()
+    except (OSError, ProtocolError) as e:
+        # A reset or timeout says nothing about the protocol the server speaks
+        channel.close()
+        raise ConnectionError(f"HELLO to {address} failed: {e}")
+    if reply is None:
+        # Old servers fail to unpickle the HELLO frame and close the connection cleanly
+        channel.close()
+        return None
+    if reply[0] != MSG_HELLO:
+        channel.close()
+        raise ProtocolError(f"Expected HELLO reply from {address}, got message type {reply[0]}")
+    return channel
@@ -0,0 +1,147 @@
+import threading
+from collections import OrderedDict
+
+# Writes that can change a cached user row or the set of outstanding loans
+USER_WRITES = {'add_user', 'bulk_add_users'}
+LOAN_WRITES = {'borrow_book', 'return_book', 'delete_book', 'add_loan', 'update_loan'}
+
+# Column positions of a Loans row
+LOAN_BOOK_ID = 1
+
+
+class ReadCache:
+    # Per-server cache for the two hot reads: an LRU of user rows for query_user and the set of
+    # outstanding loans for track_loans, kept up to date by apply() after each write commits.
+    # A reader notes the generation before it queries the database and its result is only
+    # stored if no write of the same kind was applied in between, so a slow reader never
+    # caches a stale row
+    def __init__(self, max_users=10000, max_loans=100000, enabled=True):
+        self.max_users = max_users
+        self.max_loans = max_loans
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.user_generation = 0
+        self.loan_generation = 0
+        self.users = OrderedDict()
+        # loan_id -> Loans row of every loan whose book is out, or None until first loaded
+        self.loans = None
+        self.book_loans = {}
+        self.loans_epoch = None
+
+        self.user_hits = 0
+        self.user_misses = 0
+        self.loan_hits = 0
+        self.loan_misses = 0
+        self.invalidations = 0
+
+    def set_enabled(self, enabled):
+        with self.lock:
+            self.enabled = enabled
+            self.clear()
+
+    def clear(self):
+        self.user_generation += 1
+        self.loan_generation += 1
+        self.users.clear()
+        self.loans = None
+        self.book_loans = {}
+
+    def get_user(self, user_id):
+        # Returns (row, generation); row is None on a miss and the generation is passed to put_user
+        with self.lock:
+            if not self.enabled:
+                return None, None
+            row = self.users.get(user_id)
+            if row is None:
+                self.user_misses += 1
+                return None, self.user_generation
+            self.users.move_to_end(user_id)
+            self.user_hits += 1
+            return row, self.user_generation
+
+    def put_user(self, user_id, row, generation):
+        with self.lock:
+            if not self.enabled or generation != self.user_generation or row is None:
+                return
+            self.users[user_id] = row
+            self.users.move_to_end(user_id)
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+
+    def get_loans(self, epoch=None):
+        # Outstanding loans in loan_id order; a change of routing epoch means books moved
+        # between libraries outside of any action, so the set is reloaded
+        with self.lock:
+            if not self.enabled:
+                return None, None
+            if self.loans is None or epoch != self.loans_epoch:
+                self.loans = None
+                self.loan_misses += 1
+                return None, self.loan_generation
+            self.loan_hits += 1
+            return [self.loans[loan_id] for loan_id in sorted(self.loans)], self.loan_generation
+
+    def put_loans(self, rows, generation, epoch=None):
+        with self.lock:
+            if not self.enabled or generation != self.loan_generation or len(rows) > self.max_loans:
+                return
+            self.loans = {row[0]: tuple(row) for row in rows}
+            self.book_loans = {row[LOAN_BOOK_ID]: row[0] for row in rows}
+            self.loans_epoch = epoch
+
+    def apply(self, action, parameters, result):
+        # Called once a successful write has committed
+        if action not in USER_WRITES and action not in LOAN_WRITES:
+            return
+        with self.lock:
+            if not self.enabled:
+                return
+            self.invalidations += 1
+            if action == 'add_user':
+                self.user_generation += 1
+                self.users.pop(parameters['user_id'], None)
+                return
+            if action == 'bulk_add_users':
+                self.user_generation += 1
+                for row in parameters['users']:
+                    self.users.pop(row['user_id'], None)
+                return
+            self.loan_generation += 1
+            if self.loans is None:
+                return
+            if action == 'borrow_book':
+                loan_id = result['return_value']['loan_id']
+                self.loans[loan_id] = (loan_id, parameters['book_id'], parameters['user_id'],
+                                       parameters['borrow_date'], None, parameters['due_date'])
+                self.book_loans[parameters['book_id']] = loan_id
+                if len(self.loans) > self.max_loans:
+                    self.loans = None
+            elif action == 'return_book':
+                loan_id = self.book_loans.pop(parameters['book_id'], None)
+                self.loans.pop(loan_id, None)
+            elif action == 'delete_book':
+                # A deleted book no longer marks its loan as outstanding
+                loan_id = self.book_loans.pop(parameters['book_id'], None)
+                self.loans.pop(loan_id, None)
+            elif action in ('update_loan', 'add_loan'):
+                loan_id = (result.get('return_value') or {}).get('loan_id')
+                if loan_id in self.loans:
+                    # The loan row itself is part of track_loans' answer
+                    self.loans = None
+
+    def stats(self):
+        with self.lock:
+            lookups = self.user_hits + self.user_misses + self.loan_hits + self.loan_misses
+            return {
+                "enabled": self.enabled,
+                "users": len(self.users),
+                "max_users": self.max_users,
+                "loans": None if self.loans is None else len(self.loans),
+                "max_loans": self.max_loans,
+                "user_hits": self.user_hits,
+                "user_misses": self.user_misses,
+                "loan_hits": self.loan_hits,
+                "loan_misses": self.loan_misses,
+                "hit_rate": (self.user_hits + self.loan_hits) / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+            }
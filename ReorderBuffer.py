@@ -0,0 +1,138 @@
+import heapq
+import threading
+from collections import deque
+from time import monotonic
+from Instrumentation import get_logger
+
+logger = get_logger('reorder')
+
+class ReorderBuffer:
+    # Ordering engine for one stream of hops (one client) at one node. Every hop names the
+    # sequence number of the stream's previous hop at this node, so it is released as soon as
+    # that hop has been, and unused numbers of a leased block or numbers meant for other nodes
+    # never hold it up. A min-heap keyed by sequence number finds the oldest parked hop when
+    # its predecessor never arrives; the server calls check_gaps to give up on it
+    def __init__(self, apply_batch, gap_timeout=0.05, history=1024):
+        self.apply_batch = apply_batch
+        self.gap_timeout = gap_timeout
+        self.last_applied = None
+        # Highest number released; an unknown hop at or below it had its turn given up
+        self.horizon = None
+        # Recently released numbers, so a retried hop is recognised instead of reported late
+        self.released = set()
+        self.release_order = deque()
+        self.history = history
+        # previous sequence number -> hops waiting for it
+        self.parked = {}
+        self.parked_numbers = set()
+        self.heap = []
+        self.lock = threading.Lock()
+        # Held while a batch is applied so runs are executed strictly in stream order
+        self.apply_lock = threading.Lock()
+
+        self.max_depth = 0
+        self.applied = 0
+        self.batches = 0
+        self.gap_timeouts = 0
+        self.late = 0
+        self.retries = 0
+        self.total_hol_wait = 0.0
+        self.max_hol_wait = 0.0
+
+    def submit(self, sequence_number, previous, item):
+        # Returns False when the hop arrived after its turn was given up; it is not applied
+        with self.lock:
+            if sequence_number in self.released:
+                # A retry of a hop whose turn already came has nothing left to wait for
+                self.retries += 1
+                retry = True
+            elif self.horizon is not None and sequence_number <= self.horizon:
+                self.late += 1
+                return False
+            else:
+                retry = False
+                arrived = monotonic()
+                self.parked.setdefault(previous, deque()).append((sequence_number, arrived, item))
+                self.parked_numbers.add(sequence_number)
+                heapq.heappush(self.heap, (sequence_number, arrived, previous))
+                self.max_depth = max(self.max_depth, len(self.parked_numbers))
+        if retry:
+            if item is not None:
+                self.apply_batch([item])
+            return True
+        self.drain()
+        return True
+
+    def pop_ready(self):
+        # The hop following the last one released, or the first hop of a new chain
+        for previous in (self.last_applied, None):
+            waiting = self.parked.get(previous)
+            if waiting:
+                entry = waiting.popleft()
+                if not waiting:
+                    del self.parked[previous]
+                return entry
+        return None
+
+    def release(self, sequence_number):
+        self.last_applied = sequence_number
+        self.horizon = sequence_number if self.horizon is None else max(self.horizon, sequence_number)
+        self.parked_numbers.discard(sequence_number)
+        self.released.add(sequence_number)
+        self.release_order.append(sequence_number)
+        if len(self.release_order) > self.history:
+            self.released.discard(self.release_order.popleft())
+
+    def drain(self):
+        with self.apply_lock:
+            batch = []
+            with self.lock:
+                now = monotonic()
+                while True:
+                    entry = self.pop_ready()
+                    if entry is None:
+                        break
+                    sequence_number, arrived, item = entry
+                    self.release(sequence_number)
+                    wait = now - arrived
+                    self.total_hol_wait += wait
+                    self.max_hol_wait = max(self.max_hol_wait, wait)
+                    batch.append(item)
+                if batch:
+                    self.applied += len(batch)
+                    self.batches += 1
+            if batch:
+                self.apply_batch(batch)
+
+    def check_gaps(self):
+        with self.lock:
+            while self.heap and self.heap[0][0] not in self.parked_numbers:
+                heapq.heappop(self.heap)
+            if not self.heap:
+                return False
+            sequence_number, arrived, previous = self.heap[0]
+            if monotonic() - arrived < self.gap_timeout:
+                return False
+            # The predecessor never came (a lost message or a crashed client): give up on it
+            # and resume the stream at the oldest parked hop
+            logger.warning("Gave up on sequence number %s after %ss, resuming at %s", previous, self.gap_timeout, sequence_number)
+            self.last_applied = previous
+            self.gap_timeouts += 1
+        self.drain()
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "depth": len(self.parked_numbers),
+                "max_depth": self.max_depth,
+                "last_applied": self.last_applied,
+                "applied": self.applied,
+                "batches": self.batches,
+                "avg_batch_size": self.applied / self.batches if self.batches else 0.0,
+                "gap_timeouts": self.gap_timeouts,
+                "late": self.late,
+                "retries": self.retries,
+                "avg_hol_wait": self.total_hol_wait / self.applied if self.applied else 0.0,
+                "max_hol_wait": self.max_hol_wait,
+            }
@@ -0,0 +1,43 @@
+import threading
+
+class SequenceAllocator:
+    # Server side: hands out single numbers or whole blocks from one counter
+    def __init__(self, start=1):
+        self.next_value = start
+        self.lock = threading.Lock()
+        self.leases = 0
+
+    def next(self):
+        return self.lease(1)[0]
+
+    def lease(self, size):
+        with self.lock:
+            start = self.next_value
+            self.next_value += size
+            self.leases += 1
+        return start, start + size
+
+
+class SequenceLease:
+    # Client side: numbers come from a locally held block, so a transaction costs no round-trip.
+    # next() on the block's range iterator is atomic, so the lock is only taken to refill it
+    def __init__(self, fetch_block, block_size=64):
+        self.fetch_block = fetch_block
+        self.block_size = block_size
+        self.block = iter(())
+        self.lock = threading.Lock()
+        self.refills = 0
+
+    def next(self):
+        try:
+            return next(self.block)
+        except StopIteration:
+            pass
+        with self.lock:
+            try:
+                return next(self.block)
+            except StopIteration:
+                start, end = self.fetch_block(self.block_size)
+                self.block = iter(range(start, end))
+                self.refills += 1
+                return next(self.block)
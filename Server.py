@@ -1,179 +1,637 @@
+import json
+import os
 import socket
-import sqlite3
 import threading
-import pickle
+from datetime import date
+from time import sleep, perf_counter, time
+from concurrent.futures import ThreadPoolExecutor
+from Database import migrate_database
+from DatabasePool import DatabasePool
+from ConnectionPool import ConnectionPool
+from Protocol import accept_channel, MSG_RESPONSE
+from ReorderBuffer import ReorderBuffer
+from GroupCommit import GroupCommitter
+from Chopping import default_analyzer
+from Partition import PartitionDirectory
+from Sequencer import SequenceAllocator
+from KeyScheduler import KeyScheduler, hop_keys
+from ReadCache import ReadCache
+from ChangeLog import ChangeLog, LogReplicator, DEFAULT_RETENTION
+from Admission import AdmissionQueue, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BULK
+from Snapshot import SnapshotStore, copy_database, load_database
+from Archive import LoanArchiver, query_archives, HISTORY_FILTERS, LOAN_COLUMNS
+from Instrumentation import get_logger, configure_logging, MetricsRegistry, MetricsEndpoint, SnapshotWriter, SamplingProfiler
+
+logger = get_logger('server')
+
+READ_ACTIONS = {'query_user', 'track_loans', 'loan_history'}
+# Actions that must run on the library owning parameters['book_id']
+OWNER_ACTIONS = {'add_book', 'delete_book', 'borrow_book', 'return_book'}
+# Chunked loads, which commit outside the group-commit stage
+BULK_ACTIONS = {'bulk_add_books', 'bulk_add_users'}
+BOOK_COLUMNS = ('book_id', 'title', 'author', 'publication_date', 'category', 'status')
+USER_COLUMNS = ('user_id', 'name', 'email', 'membership')
+
+# Statements are module constants so every pooled connection compiles each one once and then
+# reuses it from its statement cache
+SQL_ADD_BOOK = ("INSERT INTO Books (book_id, title, author, publication_date, category, status) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(book_id) DO NOTHING")
+SQL_ADD_USER = "INSERT INTO Users (user_id, name, email, membership) VALUES (?, ?, ?, ?) ON CONFLICT(user_id) DO NOTHING"
+SQL_DELETE_BOOK = "DELETE FROM Books WHERE book_id = ?"
+SQL_ADD_LOAN = "INSERT INTO Loans (loan_id, book_id, user_id, borrow_date, due_date) VALUES (?, ?, ?, ?, ?)"
+SQL_BORROW_BOOK = ("UPDATE Books SET status = 'Borrowed', loan_id = ? "
+                   "WHERE book_id = ? AND status = 'Available' RETURNING book_id")
+SQL_CLOSE_BOOK_LOAN = ("UPDATE Loans SET return_date = ? WHERE loan_id = "
+                       "(SELECT loan_id FROM Books WHERE book_id = ? AND status != 'Available') RETURNING loan_id")
+SQL_RETURN_BOOK = "UPDATE Books SET status = 'Available', loan_id = NULL WHERE book_id = ?"
+# The next free loan id congruent to ? modulo ?, so libraries striped on different residues
+# never hand out the same id. It is counted from the LoanIds high-water mark, as archiving can
+# take the newest loans out of Loans, and starts with INSERT so sqlite3 opens the transaction
+SQL_ADD_STRIDED_LOAN = ("INSERT INTO Loans (loan_id, book_id, user_id, borrow_date, due_date) "
+                        "SELECT next + ((? - next) % ? + ?) % ?, ?, ?, ?, ? "
+                        "FROM (SELECT MAX(COALESCE(MAX(loan_id), 0), COALESCE((SELECT high FROM LoanIds), 0)) + 1 AS next "
+                        "FROM Loans)")
+SQL_RAISE_LOAN_IDS = "UPDATE LoanIds SET high = ? WHERE high < ?"
+SQL_UPDATE_LOAN = "UPDATE Loans SET return_date = ? WHERE loan_id = ?"
+SQL_QUERY_USER = "SELECT * FROM Users WHERE user_id = ?"
+SQL_TRACK_LOANS = "SELECT * FROM Loans WHERE loan_id IN (SELECT loan_id FROM Books WHERE status = 'Borrowed')"
+SQL_BOOK_STATUS = "SELECT status, loan_id FROM Books WHERE book_id = ?"
+SQL_APPLIED_HOP = "SELECT result FROM AppliedHops WHERE transaction_key = ? AND hop_id = ?"
+SQL_RECORD_HOP = "INSERT INTO AppliedHops (transaction_key, hop_id, result, applied_at) VALUES (?, ?, ?, ?)"
+# At most ? of the pieces applied before ?, found through idx_applied_hops_time
+SQL_EXPIRE_HOPS = ("DELETE FROM AppliedHops WHERE (transaction_key, hop_id) IN "
+                   "(SELECT transaction_key, hop_id FROM AppliedHops WHERE applied_at < ? LIMIT ?)")
+# Seconds a piece's result is kept for its retries: longer than an outbox retries a piece
+DEDUP_RETENTION = 24 * 3600.0
+# Keyset pages of outstanding loans walk idx_books_status_loan from the last loan_id returned
+SQL_LOANS_PAGE = ("SELECT l.* FROM Books b JOIN Loans l ON l.loan_id = b.loan_id "
+                  "WHERE b.status = 'Borrowed' AND b.loan_id > ?")
+LOAN_FILTERS = {'user_id': " AND l.user_id = ?", 'due_before': " AND l.due_date < ?", 'overdue': " AND l.due_date < ?"}
+# Loan ids are striped across libraries: the library at position n of the directory's nodes
+# takes the ids congruent to n + 1 modulo this, which leaves room for as many libraries
+LOAN_ID_STRIDE = 64
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+# action -> Server method that runs it on an open connection, filled in by @action_handler
+ACTION_HANDLERS = {}
+
+
+def action_handler(action):
+    def register(method):
+        ACTION_HANDLERS[action] = method
+        return method
+    return register
+
 
 class Server:
-    def __init__(self, host, port, db_name):
+    def __init__(self, host, port, db_name, pool_size=8, group_commit=False, commit_window=0.002, max_batch_size=64,
+                 directory=None, peers=None, max_retries=3, request_workers=32, max_queue_depth=1024,
+                 metrics_port=None, metrics_file=None, metrics_interval=10.0,
+                 read_cache=True, cache_users=10000, cache_loans=100000,
+                 change_log=False, log_batch_size=500, log_poll_interval=0.05, log_retention=DEFAULT_RETENTION,
+                 loan_id_stride=None, memory=False, checkpoint_interval=None,
+                 dedup_retention=DEDUP_RETENTION, dedup_sweep_interval=600.0,
+                 archive_horizon=None, archive_batch_size=500, archive_rate=5000, archive_interval=60.0):
         self.host = host
         self.port = port
         self.db_name = db_name
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.bind((self.host, self.port))
-        self.socket.listen(5)
-        print(f"Server started and listening on {self.host}:{self.port} for database {self.db_name}")
+        self.directory = directory
+        # Addresses of the other libraries, used to forward later pieces of chained transactions
+        self.peers = peers or {}
+        self.max_retries = max_retries
+        # (residue, modulus) of the loan ids this server hands out. A library missing from the
+        # directory has none and cannot lend, only replicate the loans of others
+        if loan_id_stride is None:
+            nodes = (directory or PartitionDirectory()).nodes
+            if db_name in nodes:
+                if nodes.index(db_name) >= LOAN_ID_STRIDE:
+                    raise ValueError(f"Loan ids are striped over at most {LOAN_ID_STRIDE} libraries")
+                loan_id_stride = (nodes.index(db_name) + 1, LOAN_ID_STRIDE)
+        self.loan_id_stride = loan_id_stride
+        self.peer_pools = {}
+        self.peer_lock = threading.Lock()
+        # Background chains and the hops they forward use separate executors, so chains waiting
+        # on their hops can never take every worker the hops need
+        self.forward_executor = ThreadPoolExecutor(max_workers=8)
+        self.hop_executor = ThreadPoolExecutor(max_workers=16)
+        self.metrics = MetricsRegistry()
+        # Framed requests on one connection are served concurrently and answered by request id,
+        # by a fixed pool of workers behind a bounded queue that sheds load it cannot take
+        self.admission = AdmissionQueue(workers=request_workers, max_depth=max_queue_depth, metrics=self.metrics)
+        self.metrics.register_gauge('admission', self.admission.stats)
+        self.profiler = SamplingProfiler()
+        migrate_database(db_name)
+        # memory=True serves an in-memory copy of the file, written back by checkpoint(): every
+        # checkpoint_interval seconds if set. Connections to a shared in-memory database lock
+        # whole tables and do not wait on each other, so the pool has a single connection
+        self.memory = memory
+        self.pool = DatabasePool(db_name, size=1 if memory else pool_size, memory=memory)
+        if memory:
+            with self.pool.connection() as conn:
+                load_database(conn, db_name)
+            if checkpoint_interval:
+                threading.Thread(target=self.checkpoint_periodically, args=(checkpoint_interval,), daemon=True).start()
+        self.metrics.register_gauge('pool', self.pool.stats)
+        # Results of retried pieces are forgotten dedup_retention seconds after they were
+        # applied, by a sweep every dedup_sweep_interval seconds
+        self.dedup_retention = dedup_retention
+        if dedup_sweep_interval:
+            threading.Thread(target=self.sweep_applied_hops_periodically, args=(dedup_sweep_interval,),
+                             daemon=True).start()
+        self.snapshots = SnapshotStore(self.pool, db_name)
+        self.metrics.register_gauge('snapshots', self.snapshots.stats)
+        # query_user and track_loans are answered from here when possible; read_cache=False
+        # (or cache.set_enabled(False) at runtime) sends every read to SQLite
+        self.cache = ReadCache(max_users=cache_users, max_loans=cache_loans, enabled=read_cache)
+        self.metrics.register_gauge('read_cache', self.cache.stats)
+        self.committer = None
+        if group_commit:
+            self.committer = GroupCommitter(self.pool, self.run_action, window=commit_window, max_batch_size=max_batch_size,
+                                            on_commit=self.cache.apply,
+                                            metrics=self.metrics)
+            self.metrics.register_gauge('group_commit', self.committer.stats)
+        # With change_log on, borrows and returns of owned books are logged and the other
+        # libraries' logs are pulled and applied here, so clients need not send add_loan and
+        # update_loan hops to every replica
+        self.change_log = None
+        self.replicator = None
+        if change_log:
+            self.change_log = ChangeLog(self.pool, retention=log_retention)
+            self.replicator = LogReplicator(self, batch_size=log_batch_size, poll_interval=log_poll_interval)
+            self.metrics.register_gauge('change_log', self.change_log.stats)
+            self.metrics.register_gauge('replication', self.replicator.stats)
+            threading.Thread(target=self.replicator.run, daemon=True).start()
+        # With archive_horizon (days) set, loans returned longer ago than that move to per-month
+        # archive files in the background; loan_history still finds them
+        self.archiver = None
+        if archive_horizon is not None:
+            self.archiver = LoanArchiver(self, archive_horizon, batch_size=archive_batch_size, rate=archive_rate,
+                                         interval=archive_interval)
+            self.metrics.register_gauge('archive', self.archiver.stats)
+            threading.Thread(target=self.archiver.run, daemon=True).start()
+        # Sub-shard workers are reached through their node's listener and take no connections
+        self.socket = None
+        if port is not None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.bind((self.host, self.port))
+            self.socket.listen(5)
+        # Scrape endpoint and snapshot file are both optional; the registry is always kept
+        self.metrics_endpoint = None
+        if metrics_port is not None:
+            self.metrics_endpoint = MetricsEndpoint(self.metrics, self.profiler, (self.host, metrics_port))
+        self.snapshot_writer = None
+        if metrics_file is not None:
+            self.snapshot_writer = SnapshotWriter(self.metrics, metrics_file, metrics_interval)
+        logger.info("Server started and listening on %s:%s for database %s", self.host, self.port, self.db_name)
 
     def handle_client(self, conn, addr):
-        raise NotImplementedError("Must be implemented by subclass.")
+        logger.debug("Connected by %s at database %s", addr, self.db_name)
 
-    def execute_action(self, node, action, parameters, return_value = None):
-        conn_db = sqlite3.connect(self.db_name)
-        cursor = conn_db.cursor()
-
-        result = {}
-        if action == 'add_book':
-            book_id = parameters['book_id']
-            title = parameters['title']
-            author = parameters['author']
-            publication_date = parameters['publication_date']
-            category = parameters['category']
-            status = parameters['status']
-            
-            # check if the book already exists
-            if self.book_exist(cursor, book_id):
-                result = {"status": "Failed", "message": f"Book {book_id} already exists"}
-            else:
-                cursor.execute("INSERT INTO Books (book_id, title, author, publication_date, category, status) VALUES (?, ?, ?, ?, ?, ?)", 
-                               (book_id, title, author, publication_date, category, status))
-                conn_db.commit()
-                result = {"status": "Success", "message": f"Book {book_id} added"}
-        
-        elif action == 'add_user':
-            user_id = parameters['user_id']
-            name = parameters['name']
-            email = parameters['email']
-            membership = parameters['membership']
-
-            # check if the user already exists
-            if self.user_exist(cursor, user_id):
-                result = {"status": "Failed", "message": f"User {user_id} already exists"}
-            else:
-                cursor.execute("INSERT INTO Users (user_id, name, email, membership) VALUES (?, ?, ?, ?)", 
-                            (user_id, name, email, membership))
-                conn_db.commit()
-                result = {"status": "Success", "message": f"User {user_id} added"}
+        channel = None
+        while True:
+            try:
+                if channel is None:
+                    channel = accept_channel(conn)
+                    channel.metrics = self.metrics
+                message = channel.recv()
+                if message is None:
+                    break
+                _, request_id, received_data = message
+                if channel.legacy:
+                    # Pickle peers match responses by order, so their requests stay serial
+                    self.serve_request(channel, request_id, received_data)
+                else:
+                    self.admit(channel, request_id, received_data)
+            except Exception as e:
+                logger.warning("Error handling client %s: %s", addr, e)
+                break
 
-        elif action == 'delete_book':
-            book_id = parameters['book_id']
+        conn.close()
 
-            cursor.execute("DELETE FROM Books WHERE book_id = ?", (book_id,))
-            conn_db.commit()
-            if cursor.rowcount == 0:
-                result = {"status": "Failed", "message": f"Book {book_id} doesn't exist"}
+    def admit(self, channel, request_id, received_data):
+        priority, force = self.request_priority(received_data)
+        self.admission.submit(priority, lambda: self.serve_request(channel, request_id, received_data),
+                              lambda response: self.respond(channel, request_id, response),
+                              deadline=received_data.get('deadline'), force=force)
+
+    def request_priority(self, received_data):
+        # (priority, force): reads and sequence numbers go first and bulk loads last. Requests
+        # that are cheap, or whose refusal would hold up a whole stream, are never turned away
+        if 'get_sequence_number' in received_data or 'lease_sequence' in received_data:
+            return PRIORITY_HIGH, True
+        if 'snapshot' in received_data:
+            return PRIORITY_BULK, False
+        if 'hop' not in received_data:
+            return PRIORITY_NORMAL, False
+        action = received_data['hop'].action
+        force = 'sequence_number' in received_data
+        if action in READ_ACTIONS:
+            return PRIORITY_HIGH, force
+        if action in BULK_ACTIONS:
+            return PRIORITY_BULK, force
+        return PRIORITY_NORMAL, force
+
+    def respond(self, channel, request_id, result):
+        try:
+            channel.send(MSG_RESPONSE, request_id, result)
+        except OSError as e:
+            logger.warning("Could not send response to request %s at %s: %s", request_id, self.db_name, e)
+
+    def serve_request(self, channel, request_id, received_data):
+        try:
+            if 'pull_log' in received_data:
+                result = self.serve_log(received_data['pull_log'])
+            elif 'snapshot' in received_data:
+                result = self.snapshots.serve(received_data['snapshot'])
             else:
-                result = {"status": "Success", "message": f"Book {book_id} deleted"}
-        
-        elif action == 'borrow_book':
-            book_id = parameters['book_id']
-            user_id = parameters['user_id']
-            borrow_date = parameters['borrow_date']
-            due_date = parameters['due_date']
-
-            if self.book_exist(cursor, book_id):
-                if self.book_available(cursor, book_id): 
-                    cursor.execute("INSERT INTO Loans (book_id, user_id, borrow_date, due_date) VALUES (?, ?, ?, ?)", 
-                                (book_id, user_id, borrow_date, due_date))
-                    loan_id = cursor.lastrowid
-                    cursor.execute("UPDATE Books SET status = 'Borrowed', loan_id = ? WHERE book_id = ?", (loan_id, book_id))
-                    conn_db.commit()
-                    result = {"status": "Success", "message": f"User {user_id} borrowed book {book_id}", "return_value": {"loan_id": loan_id}}
-                else:
-                    result = {"status": "Failed", "message": f"Book {book_id} is not available"}
-            else:
-                result = {"status": "Failed", "message": f"Book {book_id} is not exist"}
+                result = self.process_request(channel, request_id, received_data)
+        except Exception as e:
+            logger.exception("Error processing request %s at %s", request_id, self.db_name)
+            self.metrics.inc('requests.error')
+            result = {"status": "Failed", "message": f"{type(e).__name__}: {e}"}
+        if result is None:
+            # The request answers itself later, e.g. once its turn in the origin order comes
+            return
+        self.respond(channel, request_id, result)
+
+    def process_request(self, channel, request_id, received_data):
+        raise NotImplementedError("Must be implemented by subclass.")
 
-        elif action == 'add_loan':
-            book_id = parameters['book_id']
-            user_id = parameters['user_id']
-            borrow_date = parameters['borrow_date']
-            due_date = parameters['due_date']
-            loan_id = return_value.get("loan_id")
-            print(f"Add Loans at {self.db_name} / {self.port}")
-            cursor.execute("INSERT INTO Loans (loan_id, book_id, user_id, borrow_date, due_date) VALUES (?, ?, ?, ?, ?)", 
-                        (loan_id, book_id, user_id, borrow_date, due_date))
-            conn_db.commit()
-            result = {"status": "Success", "message": f"Loan {loan_id} added", "return_value": {"loan_id": loan_id}}
+    def checkpoint(self):
+        # Writes the in-memory database back to its file, atomically
+        if not self.memory:
+            return
+        started = perf_counter()
+        with self.pool.connection() as conn:
+            copy_database(conn, self.db_name)
+        self.metrics.observe('checkpoint', perf_counter() - started)
 
-        elif action == 'return_book':
-            book_id = parameters['book_id']
-            return_date = parameters['return_date']
+    def checkpoint_periodically(self, interval):
+        while True:
+            sleep(interval)
+            try:
+                self.checkpoint()
+            except Exception as e:
+                logger.warning("Checkpoint of %s failed: %s", self.db_name, e)
 
-            cursor.execute("SELECT loan_id from Books WHERE book_id = ?", (book_id,))
-            loan_id = cursor.fetchone()[0]
+    def sweep_applied_hops(self, batch_size=1000):
+        # Short batches, so hops keep getting the write lock while a large backlog is swept
+        cutoff = time() - self.dedup_retention
+        swept = 0
+        while True:
+            with self.pool.connection() as conn:
+                count = conn.execute(SQL_EXPIRE_HOPS, (cutoff, batch_size)).rowcount
+                conn.commit()
+            swept += count
+            if count < batch_size:
+                break
+        if swept:
+            self.metrics.inc('dedup.expired', swept)
+        return swept
 
-            if not loan_id:
-                result = {"status": "Failed", "message": f"Book {book_id} is not borrowed"}
+    def sweep_applied_hops_periodically(self, interval):
+        while True:
+            sleep(interval)
+            try:
+                self.sweep_applied_hops()
+            except Exception as e:
+                logger.warning("Sweeping applied hops of %s failed: %s", self.db_name, e)
+
+    def serve_log(self, request):
+        if self.change_log is None:
+            return {"status": "Failed", "message": f"{self.db_name} keeps no change log"}
+        return self.change_log.read(request['peer'], request['after'], request['limit'])
+
+    def misrouted(self, hop):
+        # Returns a redirect for hops sent here under a stale routing epoch
+        if self.directory is None or hop.action not in OWNER_ACTIONS and hop.action != 'bulk_add_books':
+            return None
+        self.directory.refresh()
+        if hop.action == 'bulk_add_books':
+            # A chunk is refused whole if any row belongs elsewhere; the client re-partitions it
+            owned = {row['book_id']: self.directory.node_for_book(row['book_id']) for row in hop.parameters['books']}
+            book_id, owner = next(((book_id, owner) for book_id, owner in owned.items() if owner != self.db_name),
+                                  (None, self.db_name))
+        else:
+            book_id = hop.parameters['book_id']
+            owner = self.directory.node_for_book(book_id)
+        if owner == self.db_name:
+            return None
+        return {"status": "Redirect", "node": owner, "directory": self.directory.to_dict(),
+                "message": f"Book {book_id} is owned by {owner}"}
+
+    def execute_owned(self, hop, return_value = None, dedup = None):
+        # A hop that passed the ownership check while its range was being moved finds the rows
+        # gone once the move commits; checking again turns that failure into a redirect
+        result = self.misrouted(hop) or self.submit_action(hop.node, hop.action, hop.parameters, return_value, dedup)
+        if result.get('status') == 'Failed' and hop.action in OWNER_ACTIONS:
+            result = self.misrouted(hop) or result
+        return result
 
-            elif self.book_available(cursor, book_id):
-                result = {"status": "Failed", "message": f"Book {book_id} is now available"}
+    def peer_pool(self, node):
+        with self.peer_lock:
+            if node not in self.peer_pools:
+                self.peer_pools[node] = ConnectionPool(node, self.peers[node])
+            return self.peer_pools[node]
+
+    def execute_chain(self, transaction, ack='first'):
+        # Run piece 1 here and forward the later pieces straight to the peer libraries, so the
+        # client pays one round-trip instead of one per piece
+        first_hop = transaction.hops[0]
+        result = self.execute_owned(first_hop)
+        if result.get('status') != 'Success' or len(transaction.hops) == 1:
+            return result
+
+        return_value = result.get('return_value', None)
+        if ack == 'first':
+            self.forward_executor.submit(self.forward_pieces, transaction, return_value)
+            return result
+
+        responses = self.forward_pieces(transaction, return_value)
+        result = dict(result, pieces={hop.hop_id: response for hop, response in zip(transaction.hops[1:], responses)})
+        if any(response.get('status') != 'Success' for response in responses):
+            result['status'] = 'Failed'
+            result['message'] = f"Transaction {transaction.transaction_id} committed piece 1 but a later piece failed"
+        return result
 
-            else:
-                cursor.execute("UPDATE Books SET status = 'Available', loan_id = NULL WHERE book_id = ?", (book_id,))
+    def forward_pieces(self, transaction, return_value):
+        hops = transaction.hops[1:]
+        futures = [self.hop_executor.submit(self.forward_hop, transaction, hop, return_value) for hop in hops]
+        responses = []
+        for hop, future in zip(hops, futures):
+            try:
+                responses.append(future.result())
+            except Exception as e:
+                responses.append({"status": "Failed", "message": str(e)})
+        return responses
 
-                cursor.execute("UPDATE Loans SET return_date = ? WHERE loan_id = ?", (return_date, loan_id))
-                
-                conn_db.commit()
-                result = {"status": "Success", "message": f"Book {book_id} is returned", "return_value": {"loan_id": loan_id}}
-        
-        elif action == 'update_loan':
-            return_date = parameters['return_date']
-            loan_id = return_value.get("loan_id")
-
-            if self.loan_exist(cursor, loan_id):
-                cursor.execute("UPDATE Loans SET return_date = ? WHERE loan_id = ?", (return_date, loan_id))
+    def forward_hop(self, transaction, hop, return_value):
+        hop_data = {'hop': hop, 'return_value': return_value}
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                if hop.node == self.db_name:
+                    response = self.submit_action(hop.node, hop.action, hop.parameters, return_value)
+                else:
+                    response = self.peer_pool(hop.node).request(hop_data)
+            except OSError as e:
+                # A peer that is down or restarting gets the same retries as a failed hop
+                response = {"status": "Failed", "message": f"{hop.node} is unreachable: {e}"}
+            if response.get('status') == 'Success':
+                return response
+            if attempt < self.max_retries:
+                logger.info("Retrying forwarded hop %s for transaction %s, attempt %s",
+                            hop.hop_id, transaction.transaction_id, attempt)
+                self.metrics.inc('forward.retries')
+                sleep(response.get('retry_after', 1))
+        logger.warning("Forwarded hop %s of transaction %s failed at %s", hop.hop_id, transaction.transaction_id, hop.node)
+        return response
+
+    def submit_action(self, node, action, parameters, return_value = None, dedup = None):
+        # Writes go through the group-commit stage when it is enabled; reads never need it
+        # Bulk chunks are already one large transaction each
+        if self.committer is None or action in READ_ACTIONS or action in BULK_ACTIONS:
+            return self.execute_action(node, action, parameters, return_value, dedup)
+        return self.committer.submit(action, parameters, return_value, dedup)
+
+    def execute_action(self, node, action, parameters, return_value = None, dedup = None):
+        started = perf_counter()
+        with self.pool.connection() as conn_db:
+            acquired = perf_counter()
+            try:
+                result = self.run_action(conn_db, action, parameters, return_value, dedup)
+            except Exception:
+                conn_db.rollback()
+                self.metrics.inc(f"actions.{action}.error")
+                raise
+            if result.get('status') == 'Success':
                 conn_db.commit()
-                result = {"status": "Success", "message": f"Loan {loan_id} closed", "return_value": {"loan_id": loan_id}}
-
+                self.cache.apply(action, parameters, result)
             else:
-                result = {"status": "Failed", "message": f"Loan doesn't exist"}
-        
-        elif action == 'query_user':
-            user_id = parameters['user_id']
-
-            cursor.execute("SELECT * FROM Users WHERE user_id = ?", (user_id,))
-            user_info = cursor.fetchone()
-            if not user_info:
-                result = {"status": "Failed", "message": f"User {user_id} not the member in {self.db_name}"}
-            result = {"status": "Success", "data": user_info}
-        
-        elif action == 'track_loans':
-            cursor.execute("SELECT * FROM Loans WHERE loan_id IN (SELECT loan_id FROM Books WHERE status = 'Borrowed')")
-            unreturned_loans = cursor.fetchall()
-            if not unreturned_loans:
-                result = {"status": "Success", "message": f"All books in {self.db_name} are available"}
-            else:
-                result = {"status": "Success", "data": unreturned_loans}
-        
-        else:
-            result = {"status": "Unknown action"}
-        
-        conn_db.close()
-        print(result)
+                conn_db.rollback()
+        # Time waiting for a pooled connection and time spent in SQLite, including the commit
+        self.metrics.observe(f"pool_wait.{action}", acquired - started)
+        self.metrics.observe(f"sql.{action}", perf_counter() - acquired)
+        self.metrics.inc(f"actions.{action}.{result.get('status')}")
         return result
 
+    def run_action(self, conn_db, action, parameters, return_value = None, dedup = None):
+        # `dedup` is the (transaction_key, hop_id) of a piece the client may send more than once;
+        # its result is recorded in the same transaction as its writes, so a repeat gets the
+        # first result back instead of being applied again
+        handler = ACTION_HANDLERS.get(action)
+        if handler is None:
+            return {"status": "Unknown action"}
+        cursor = conn_db.cursor()
+        try:
+            if dedup is not None:
+                cursor.execute(SQL_APPLIED_HOP, dedup)
+                applied = cursor.fetchone()
+                if applied is not None:
+                    self.metrics.inc('dedup.repeats')
+                    return json.loads(applied[0])
+            result = handler(self, cursor, parameters, return_value)
+            if dedup is not None and result.get('status') == 'Success':
+                # Two deliveries racing past the check above collide on the primary key here,
+                # and the later one is rolled back
+                cursor.execute(SQL_RECORD_HOP, (*dedup, json.dumps(result), time()))
+        finally:
+            cursor.close()
+        logger.debug("%s at %s: %s", action, self.db_name, result)
+        return result
 
-    def user_exist(self, cursor, user_id):
-        cursor.execute("SELECT * FROM Users WHERE user_id = ?", (user_id,))
-        user_info = cursor.fetchone()
-        return True if user_info else False
-        
-
-    def book_exist(self, cursor, book_id):
-        cursor.execute("SELECT * FROM Books WHERE book_id = ?", (book_id,))
-        book_info = cursor.fetchone()
-        return True if book_info else False
-    
-
-    def book_available(self, cursor, book_id):
-        cursor.execute("SELECT status FROM Books WHERE book_id = ?", (book_id,))
-        book_status = cursor.fetchone()[0]
-        return True if book_status == 'Available' else False
-    
-    def loan_exist(self, cursor, loan_id):
-        cursor.execute("SELECT * FROM Loans WHERE loan_id = ?", (loan_id,))
-        loan_info = cursor.fetchone()
-        return True if loan_info else False
-
+    # Each write is a single conditional statement where the old code checked first, so no other
+    # writer can slip in between the check and the write. Failed writes leave nothing behind:
+    # the caller rolls back (or rolls back to the hop's savepoint) whenever a hop does not succeed
+
+    @action_handler('add_book')
+    def add_book(self, cursor, parameters, return_value = None):
+        book_id = parameters['book_id']
+        cursor.execute(SQL_ADD_BOOK, (book_id, parameters['title'], parameters['author'],
+                                      parameters['publication_date'], parameters['category'], parameters['status']))
+        if cursor.rowcount == 0:
+            return {"status": "Failed", "message": f"Book {book_id} already exists"}
+        return {"status": "Success", "message": f"Book {book_id} added"}
+
+    @action_handler('add_user')
+    def add_user(self, cursor, parameters, return_value = None):
+        user_id = parameters['user_id']
+        cursor.execute(SQL_ADD_USER, (user_id, parameters['name'], parameters['email'], parameters['membership']))
+        if cursor.rowcount == 0:
+            return {"status": "Failed", "message": f"User {user_id} already exists"}
+        return {"status": "Success", "message": f"User {user_id} added"}
+
+    @action_handler('delete_book')
+    def delete_book(self, cursor, parameters, return_value = None):
+        book_id = parameters['book_id']
+        cursor.execute(SQL_DELETE_BOOK, (book_id,))
+        if cursor.rowcount == 0:
+            return {"status": "Failed", "message": f"Book {book_id} doesn't exist"}
+        return {"status": "Success", "message": f"Book {book_id} deleted"}
+
+    @action_handler('borrow_book')
+    def borrow_book(self, cursor, parameters, return_value = None):
+        book_id = parameters['book_id']
+        user_id = parameters['user_id']
+        if self.loan_id_stride is None:
+            return {"status": "Failed", "message": f"{self.db_name} is not in the directory and has no loan ids"}
+        residue, modulus = self.loan_id_stride
+        cursor.execute(SQL_ADD_STRIDED_LOAN, (residue, modulus, modulus, modulus, book_id, user_id,
+                                              parameters['borrow_date'], parameters['due_date']))
+        loan_id = cursor.lastrowid
+        cursor.execute(SQL_RAISE_LOAN_IDS, (loan_id, loan_id))
+        # Only an available book is taken; the loan above is rolled back if it was not
+        cursor.execute(SQL_BORROW_BOOK, (loan_id, book_id))
+        if not cursor.fetchall():
+            if self.book_status(cursor, book_id) is None:
+                return {"status": "Failed", "message": f"Book {book_id} is not exist"}
+            return {"status": "Failed", "message": f"Book {book_id} is not available"}
+        if self.change_log is not None:
+            ChangeLog.append(cursor, 'borrow', loan_id, book_id, user_id, parameters['borrow_date'],
+                             due_date=parameters['due_date'])
+        return {"status": "Success", "message": f"User {user_id} borrowed book {book_id}", "return_value": {"loan_id": loan_id}}
+
+    @action_handler('add_loan')
+    def add_loan(self, cursor, parameters, return_value = None):
+        loan_id = return_value.get("loan_id")
+        logger.debug("Add loan %s at %s", loan_id, self.db_name)
+        cursor.execute(SQL_ADD_LOAN, (loan_id, parameters['book_id'], parameters['user_id'],
+                                      parameters['borrow_date'], parameters['due_date']))
+        return {"status": "Success", "message": f"Loan {loan_id} added", "return_value": {"loan_id": loan_id}}
+
+    @action_handler('return_book')
+    def return_book(self, cursor, parameters, return_value = None):
+        book_id = parameters['book_id']
+        # Closes the loan the book is out on; matches nothing unless the book is borrowed
+        cursor.execute(SQL_CLOSE_BOOK_LOAN, (parameters['return_date'], book_id))
+        rows = cursor.fetchall()
+        if not rows:
+            status = self.book_status(cursor, book_id)
+            if status is None:
+                return {"status": "Failed", "message": f"Book {book_id} is not exist"}
+            if status[1] is None:
+                return {"status": "Failed", "message": f"Book {book_id} is not borrowed"}
+            if status[0] == 'Available':
+                return {"status": "Failed", "message": f"Book {book_id} is now available"}
+            return {"status": "Failed", "message": f"Loan {status[1]} of book {book_id} doesn't exist"}
+        loan_id = rows[0][0]
+        cursor.execute(SQL_RETURN_BOOK, (book_id,))
+        if self.change_log is not None:
+            ChangeLog.append(cursor, 'return', loan_id, book_id, return_date=parameters['return_date'])
+        return {"status": "Success", "message": f"Book {book_id} is returned", "return_value": {"loan_id": loan_id}}
+
+    @action_handler('update_loan')
+    def update_loan(self, cursor, parameters, return_value = None):
+        loan_id = return_value.get("loan_id")
+        cursor.execute(SQL_UPDATE_LOAN, (parameters['return_date'], loan_id))
+        if cursor.rowcount == 0:
+            return {"status": "Failed", "message": f"Loan doesn't exist"}
+        return {"status": "Success", "message": f"Loan {loan_id} closed", "return_value": {"loan_id": loan_id}}
+
+    @action_handler('query_user')
+    def query_user(self, cursor, parameters, return_value = None):
+        user_id = parameters['user_id']
+        user_info, generation = self.cached_read(cursor, self.cache.get_user, user_id)
+        if user_info is None:
+            cursor.execute(SQL_QUERY_USER, (user_id,))
+            user_info = cursor.fetchone()
+            self.cache.put_user(user_id, user_info, generation)
+        if not user_info:
+            return {"status": "Failed", "message": f"User {user_id} not the member in {self.db_name}"}
+        return {"status": "Success", "data": user_info}
+
+    @action_handler('track_loans')
+    def track_loans(self, cursor, parameters, return_value = None):
+        if parameters:
+            return self.track_loans_page(cursor, parameters)
+        epoch = self.directory.epoch if self.directory is not None else None
+        unreturned_loans, generation = self.cached_read(cursor, self.cache.get_loans, epoch)
+        if unreturned_loans is None:
+            cursor.execute(SQL_TRACK_LOANS)
+            unreturned_loans = cursor.fetchall()
+            self.cache.put_loans(unreturned_loans, generation, epoch)
+        if not unreturned_loans:
+            return {"status": "Success", "message": f"All books in {self.db_name} are available"}
+        return {"status": "Success", "data": unreturned_loans}
+
+    def track_loans_page(self, cursor, parameters):
+        # One page of outstanding loans in loan_id order after parameters['after']; 'next' is the
+        # cursor of the following page, or None after the last one. Optional filters: user_id,
+        # due_before (a date) and overdue (due before parameters['today'], default today)
+        limit = min(parameters.get('limit') or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        sql = SQL_LOANS_PAGE
+        arguments = [parameters.get('after') or 0]
+        for name, condition in LOAN_FILTERS.items():
+            value = parameters.get(name)
+            if name == 'overdue' and value:
+                value = parameters.get('today') or date.today().isoformat()
+            if value:
+                sql += condition
+                arguments.append(value)
+        cursor.execute(f"{sql} ORDER BY b.loan_id LIMIT ?", arguments + [limit])
+        rows = cursor.fetchall()
+        return {"status": "Success", "data": rows, "next": rows[-1][0] if len(rows) == limit else None}
+
+    @action_handler('loan_history')
+    def loan_history(self, cursor, parameters, return_value = None):
+        # Loans in the hot table and the archives matching loan_id, book_id and user_id; since
+        # and until ('YYYY-MM') limit which archive months are read
+        sql = f"SELECT {LOAN_COLUMNS} FROM Loans WHERE 1"
+        arguments = []
+        for name, condition in HISTORY_FILTERS.items():
+            if parameters.get(name) is not None:
+                sql += condition
+                arguments.append(parameters[name])
+        cursor.execute(sql, arguments)
+        loans = {row[0]: row for row in cursor.fetchall()}
+        archived = query_archives(self.db_name, parameters)
+        # A loan caught between its copy and its delete is in both; the hot row wins
+        for row in archived:
+            loans.setdefault(row[0], row)
+        return {"status": "Success", "data": [loans[loan_id] for loan_id in sorted(loans)], "archived": len(archived)}
+
+    @action_handler('bulk_add_books')
+    def bulk_add_books(self, cursor, parameters, return_value = None):
+        return self.bulk_insert(cursor, 'Books', 'book_id', BOOK_COLUMNS, parameters['books'])
+
+    @action_handler('bulk_add_users')
+    def bulk_add_users(self, cursor, parameters, return_value = None):
+        return self.bulk_insert(cursor, 'Users', 'user_id', USER_COLUMNS, parameters['users'])
+
+    def cached_read(self, cursor, get, key):
+        # Inside a write transaction (a group-commit batch) the reader must see the batch's own
+        # uncommitted writes and must not cache them, so the cache is bypassed; a None
+        # generation makes the following put a no-op
+        if cursor.connection.in_transaction:
+            return None, None
+        return get(key)
+
+    def bulk_insert(self, cursor, table, key, columns, rows):
+        # One executemany per chunk. Rows whose key exists already, or repeats within the chunk,
+        # are skipped by ON CONFLICT and reported back as duplicates
+        if not cursor.connection.in_transaction:
+            # Take the write lock first, so no other writer can add a key between the two statements
+            cursor.execute("BEGIN IMMEDIATE")
+        keys = [row[key] for row in rows]
+        cursor.execute(f"SELECT {key} FROM {table} WHERE {key} IN (SELECT value FROM json_each(?))", (json.dumps(keys),))
+        existing = {row[0] for row in cursor.fetchall()}
+        seen = set()
+        duplicates = []
+        for value in keys:
+            if value in existing or value in seen:
+                duplicates.append(value)
+            seen.add(value)
+        cursor.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                           f"ON CONFLICT({key}) DO NOTHING",
+                           ([row.get(column) for column in columns] for row in rows))
+        added = len(rows) - len(duplicates)
+        return {"status": "Success", "message": f"Added {added} of {len(rows)} rows to {table}",
+                "return_value": {"added": added, "duplicates": duplicates}}
+
+    def book_status(self, cursor, book_id):
+        # (status, loan_id) of a book, or None; only used to explain a failed conditional write
+        cursor.execute(SQL_BOOK_STATUS, (book_id,))
+        return cursor.fetchone()
 
     def start(self):
         while True:
@@ -182,76 +640,153 @@ class Server:
 
 
 class BaseServer(Server):
-    def handle_client(self, conn, addr):
-        print(f"Connected by {addr}")
-        print(f"At Database: {self.db_name}, Port: {self.port}, Host: {self.host}")
+    def process_request(self, channel, request_id, received_data):
+        if 'transaction' in received_data:
+            return self.execute_chain(received_data['transaction'], received_data.get('chain', 'first'))
 
-        while True:
-            try:
-                data = conn.recv(1024)
-                if not data:
-                    break
-                received_data = pickle.loads(data)
-                hop = received_data['hop']
-                return_value = received_data.get('return_value', None)
-
-                result = self.execute_action(hop.node, hop.action, hop.parameters, return_value)
-                conn.sendall(pickle.dumps(result))
-            except Exception as e:
-                print(f"Error handling client {addr}: {e}")
-                break
-
-        conn.close()
+        hop = received_data['hop']
+        return_value = received_data.get('return_value', None)
+        dedup = received_data.get('dedup')
+        return self.execute_owned(hop, return_value, tuple(dedup) if dedup else None)
 
 
 class OriginOrderServer(Server):
-    def __init__(self, host, port, db_name):
-        super().__init__(host, port, db_name)
-        self.sequence_number = 0
-        self.sequence_numbers = {}
+    def __init__(self, host, port, db_name, gap_timeout=0.05, scheduling='node', scheduler_workers=8, **kwargs):
+        super().__init__(host, port, db_name, **kwargs)
+        self.sequencer = SequenceAllocator()
+        # 'node' applies each stream's hops one run at a time; 'key' only orders hops that
+        # touch the same book, user or loan and runs the rest in parallel
+        self.scheduling = scheduling
+        self.key_scheduler = None
+        if scheduling == 'key':
+            self.key_scheduler = KeyScheduler(lambda entry: self.apply_batch([entry]), fail=self.fail_hop,
+                                              workers=scheduler_workers, metrics=self.metrics)
+            self.metrics.register_gauge('key_scheduler', lambda: dict(self.key_scheduler.stats(),
+                                                                      hot_keys=self.key_scheduler.hot_keys()))
+        self.gap_timeout = gap_timeout
+        # One ordering engine per (node, client stream), shared by every client connection
+        self.reorder_buffers = {}
+        self.reorder_lock = threading.Lock()
+        # Actions the chopping analysis proves safe to run without origin ordering
+        self.unordered_actions = default_analyzer().unordered_actions()
+        self.metrics.register_gauge('reorder', self.reorder_stats)
+        threading.Thread(target=self.watch_gaps, daemon=True).start()
+
+    def reorder_buffer(self, node, stream=None):
+        with self.reorder_lock:
+            if (node, stream) not in self.reorder_buffers:
+                apply = self.apply_batch if self.key_scheduler is None else self.schedule_batch
+                self.reorder_buffers[(node, stream)] = ReorderBuffer(apply, gap_timeout=self.gap_timeout)
+            return self.reorder_buffers[(node, stream)]
+
+    def reorder_stats(self):
+        with self.reorder_lock:
+            buffers = dict(self.reorder_buffers)
+        return {f"{node} {stream}": buffer.stats() for (node, stream), buffer in buffers.items()}
+
+    def watch_gaps(self):
+        # One watcher for every stream, so idle clients cost no thread
+        while True:
+            sleep(self.gap_timeout / 2)
+            with self.reorder_lock:
+                buffers = list(self.reorder_buffers.values())
+            for buffer in buffers:
+                buffer.check_gaps()
+
+    def apply_batch(self, batch):
+        # A contiguous run shares one pooled connection (or one group commit), and every
+        # hop is answered on the connection it arrived on
+        # Placeholders only fill the sequence gap left by a hop that already ran unordered
+        batch = [entry for entry in batch if entry is not None]
+        try:
+            if self.committer is not None:
+                results = self.committer.submit_many([(hop.action, hop.parameters, return_value)
+                                                      for hop, return_value, _, _ in batch])
+            else:
+                with self.pool.connection():
+                    results = [self.execute_hop(hop, return_value) for hop, return_value, _, _ in batch]
+        except Exception as e:
+            results = [{"status": "Failed", "message": f"Batch failed: {e}"}] * len(batch)
+
+        # Every hop gets an answer, so a failing hop never leaves the rest of the run hanging
+        for (hop, _, channel, request_id), result in zip(batch, results):
+            if result.get('status') == 'Failed' and hop.action in OWNER_ACTIONS:
+                result = self.misrouted(hop) or result
+            try:
+                channel.send(MSG_RESPONSE, request_id, result)
+            except OSError as e:
+                logger.warning("Could not return result of hop %s at %s: %s", hop.hop_id, hop.node, e)
+
+    def schedule_batch(self, batch):
+        # In key mode the stream order only decides the order hops enter the scheduler
+        for entry in batch:
+            if entry is not None:
+                hop, return_value, _, _ = entry
+                self.key_scheduler.submit(hop_keys(hop.action, hop.parameters, return_value), entry)
+
+    def fail_hop(self, entry, error):
+        hop, _, channel, request_id = entry
+        try:
+            channel.send(MSG_RESPONSE, request_id, {"status": "Failed", "message": f"{hop.action} failed: {error}"})
+        except OSError as e:
+            logger.warning("Could not return result of hop %s at %s: %s", hop.hop_id, hop.node, e)
+
+    def execute_hop(self, hop, return_value):
+        try:
+            return self.execute_action(hop.node, hop.action, hop.parameters, return_value)
+        except Exception as e:
+            logger.exception("Hop %s (%s) failed at %s", hop.hop_id, hop.action, self.db_name)
+            return {"status": "Failed", "message": f"{hop.action} failed: {e}"}
 
     def get_sequence_number(self):
-        self.sequence_number += 1
-        return self.sequence_number
-    
-    def handle_client(self, conn, addr):
-        print(f"Connected by {addr}")
-        print(f"At Database: {self.db_name}, Port: {self.port}, Host: {self.host}")
+        return self.sequencer.next()
 
-        while True:
-            try:
-                data = conn.recv(1024)
-                if not data:
-                    break
-                received_data = pickle.loads(data)
-
-                # Case 1: Get sequence numbe
-                if 'get_sequence_number' in received_data:
-                    sequence_number = self.get_sequence_number()
-                    conn.sendall(pickle.dumps(sequence_number))
-                    continue
-
-                # Case 2: Process hop data
-                hop = received_data['hop']
-                return_value = received_data.get('return_value', None)
-                sequence_number = received_data.get('sequence_number')
-
-                if hop.node not in self.sequence_numbers:
-                    self.sequence_numbers[hop.node] = []
-
-                self.sequence_numbers[hop.node].append((sequence_number, hop, return_value))
-                self.sequence_numbers[hop.node].sort()  # Ensure hops are processed in order
-
-                while self.sequence_numbers[hop.node]:
-                    seq_num, hop, return_value = self.sequence_numbers[hop.node].pop(0)
-                    result = self.execute_action(hop.node, hop.action, hop.parameters, return_value)
-                    conn.sendall(pickle.dumps(result))
-            
-            except Exception as e:
-                print(f"Error handling client {addr}: {e}")
-                break
+    def lease_sequence(self, size):
+        return self.sequencer.lease(size)
+    
+    def process_request(self, channel, request_id, received_data):
+        # Case 1: Get sequence numbe
+        if 'get_sequence_number' in received_data:
+            return self.get_sequence_number()
+
+        if 'lease_sequence' in received_data:
+            return self.lease_sequence(received_data['lease_sequence'])
+
+        if 'transaction' in received_data:
+            return {"status": "Failed", "message": "Chained transactions are not origin ordered"}
+
+        # Case 2: Process hop data
+        hop = received_data['hop']
+        return_value = received_data.get('return_value', None)
+        sequence_number = received_data.get('sequence_number')
+        stream = received_data.get('stream', received_data.get('origin'))
+        previous = received_data.get('previous')
+
+        if 'skip' in received_data:
+            # The transaction aborted before this piece was sent; move the stream past it
+            self.reorder_buffer(hop.node, stream).submit(sequence_number, previous, None)
+            return {"status": "Success", "message": f"Hop {hop.hop_id} skipped"}
+
+        redirect = self.misrouted(hop)
+        if redirect is not None:
+            return redirect
+
+        entry = (hop, return_value, channel, request_id)
+        if sequence_number is None or hop.action in self.unordered_actions:
+            if self.key_scheduler is not None:
+                self.key_scheduler.run_unordered(hop_keys(hop.action, hop.parameters, return_value),
+                                                 lambda: self.apply_batch([entry]))
+            else:
+                self.apply_batch([entry])
+            if sequence_number is not None:
+                self.reorder_buffer(hop.node, stream).submit(sequence_number, previous, None)
+            return None
 
-        conn.close()
+        # Ensure hops are processed in order; the response is sent once the hop's turn comes
+        if not self.reorder_buffer(hop.node, stream).submit(sequence_number, previous, entry):
+            return {"status": "Failed",
+                    "message": f"Hop {hop.hop_id} (sequence number {sequence_number}) arrived after its turn was given up"}
+        return None
 
 
 if __name__ == "__main__":
@@ -259,8 +794,13 @@ if __name__ == "__main__":
     PORTS = [9000, 9001, 9002]
     DB_NAMES = ['Library A', 'Library B', 'Library C']
 
+    directory = PartitionDirectory.load('partitions.json') if os.path.exists('partitions.json') else None
+    peers = {db_name: (HOST, port) for port, db_name in zip(PORTS, DB_NAMES)}
+
+    configure_logging('INFO')
     servers = []
     for port, db_name in zip(PORTS, DB_NAMES):
-        server = BaseServer(HOST, port, db_name)
+        # Metrics of each library are served on its port + 100, e.g. http://localhost:9100/metrics
+        server = BaseServer(HOST, port, db_name, directory=directory, peers=peers, metrics_port=port + 100)
         threading.Thread(target=server.start).start()
         servers.append(server)
\ No newline at end of file
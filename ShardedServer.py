@@ -0,0 +1,234 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ConnectionPool import PendingResponse
+from Database import split_database
+from Partition import PartitionDirectory, RangeMap, HashRing
+from Server import BaseServer, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from Instrumentation import get_logger
+
+logger = get_logger('sharded_server')
+
+# Actions that touch the rows of one book, or of one user, and so run on that row's sub-shard
+BOOK_ACTIONS = {'add_book', 'delete_book', 'borrow_book', 'return_book', 'add_loan'}
+USER_ACTIONS = {'add_user', 'query_user'}
+# update_loan only names the loan, which lives with its book on some sub-shard
+SCATTER_ACTIONS = {'track_loans', 'update_loan', 'loan_history'}
+# Options that configure how the workers execute actions rather than the listener
+WORKER_OPTIONS = ('pool_size', 'group_commit', 'commit_window', 'max_batch_size',
+                  'read_cache', 'cache_users', 'cache_loans',
+                  'archive_horizon', 'archive_batch_size', 'archive_rate', 'archive_interval',
+                  'dedup_retention', 'dedup_sweep_interval')
+# Width of the last range of a library, which has no next range to end it
+DEFAULT_SPAN = 1000
+
+
+def shard_files(db_name, subshards):
+    return [f"{db_name}.shard{index}" for index in range(subshards)]
+
+
+def run_worker(db_file, loan_id_stride, requests, responses, threads, options):
+    # Body of one worker process: executes the actions routed to its sub-shard and answers on
+    # the shared response queue, tagged with the listener's request id
+    server = BaseServer(None, None, db_file, loan_id_stride=loan_id_stride, **options)
+    executor = ThreadPoolExecutor(max_workers=threads)
+    parent = multiprocessing.parent_process()
+
+    def serve(request_id, message):
+        try:
+            if 'metrics' in message:
+                result = server.metrics.snapshot()
+            else:
+                result = server.submit_action(db_file, message['action'], message['parameters'],
+                                              message['return_value'], message['dedup'])
+        except Exception as e:
+            logger.exception("%s failed in sub-shard %s", message.get('action'), db_file)
+            result = {"status": "Failed", "message": f"{type(e).__name__}: {e}"}
+        responses.put((request_id, result))
+
+    while True:
+        try:
+            message = requests.get(timeout=1.0)
+        except queue.Empty:
+            # A listener killed without close() cannot tell its workers to stop
+            if not parent.is_alive():
+                break
+            continue
+        if message is None:
+            break
+        executor.submit(serve, *message)
+    executor.shutdown()
+
+
+class ShardedServer(BaseServer):
+    # A library served by `subshards` worker processes, so SQL and result encoding use as many
+    # cores as there are workers. Each worker owns a sub-range of book_id and user_id in its own
+    # file, seeded once from the library's file. This process only accepts connections, checks
+    # ownership and routes every action to the worker owning its rows; actions that span
+    # sub-shards are sent to all of them and their answers merged
+    def __init__(self, host, port, db_name, subshards=None, worker_threads=8, book_starts=None, user_starts=None,
+                 worker_timeout=30.0, **kwargs):
+        if kwargs.get('change_log'):
+            raise ValueError("The change log is not kept per sub-shard; use replication='sync' clients")
+        options = {name: kwargs.pop(name) for name in WORKER_OPTIONS if name in kwargs}
+        super().__init__(host, port, db_name, **kwargs)
+        self.subshards = subshards or os.cpu_count()
+        self.worker_timeout = worker_timeout
+        directory = self.directory or PartitionDirectory()
+        self.book_shards = self.subshard_map(directory, directory.books, book_starts)
+        self.user_shards = self.subshard_map(directory, directory.users, user_starts)
+
+        self.files = shard_files(db_name, self.subshards)
+        existing = [name for name in self.files if os.path.exists(name)]
+        if not existing:
+            split_database(db_name, self.files, self.book_shards.lookup, self.user_shards.lookup)
+        elif len(existing) != len(self.files):
+            raise ValueError(f"{db_name} has {len(existing)} sub-shard files, expected {len(self.files)}")
+
+        # spawn rather than fork: this process already runs threads
+        context = multiprocessing.get_context('spawn')
+        self.responses = context.Queue()
+        self.requests = [context.Queue() for _ in self.files]
+        self.workers = [context.Process(target=run_worker, daemon=True,
+                                        args=(name, self.worker_loan_ids(index), self.requests[index], self.responses,
+                                              worker_threads, options))
+                        for index, name in enumerate(self.files)]
+        for worker in self.workers:
+            worker.start()
+        self.request_ids = itertools.count(1)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.routed = [0] * self.subshards
+        threading.Thread(target=self.read_responses, daemon=True).start()
+        self.metrics.register_gauge('subshards', self.subshard_stats)
+
+    def subshard_map(self, directory, ranges, starts):
+        # Explicit starts, or the library's first range cut into equal parts. Ids outside it
+        # go to the first or the last part, like ids outside the directory's ranges do
+        if starts is not None:
+            return RangeMap([[start, index] for index, start in enumerate(starts)])
+        if directory.kind != 'range':
+            return HashRing(list(range(self.subshards)))
+        bounds = ranges.starts + [None]
+        owned = [(bounds[index], bounds[index + 1]) for index, node in enumerate(ranges.nodes) if node == self.db_name]
+        start, end = owned[0] if owned else (0, None)
+        step = max(1, ((end if end is not None else start + DEFAULT_SPAN) - start) // self.subshards)
+        return RangeMap([[start + index * step, index] for index in range(self.subshards)])
+
+    def worker_loan_ids(self, index):
+        # Each worker takes every subshards-th id of the library's stripe, so its ids are the
+        # library's as far as the other libraries can tell, and no two workers share one.
+        # Loans replicated from elsewhere are on other stripes and can land on any worker
+        if self.loan_id_stride is None:
+            return None
+        residue, modulus = self.loan_id_stride
+        return residue + index * modulus, modulus * self.subshards
+
+    def read_responses(self):
+        while True:
+            request_id, result = self.responses.get()
+            with self.pending_lock:
+                pending = self.pending.pop(request_id, None)
+            if pending is not None:
+                pending.set(result)
+
+    def send(self, index, message):
+        pending = PendingResponse()
+        request_id = next(self.request_ids)
+        with self.pending_lock:
+            self.pending[request_id] = pending
+            self.routed[index] += 1
+        self.requests[index].put((request_id, message))
+        return request_id, pending
+
+    def wait(self, request_id, pending):
+        try:
+            return pending.wait(self.worker_timeout)
+        except TimeoutError:
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+            return {"status": "Failed", "message": f"Sub-shard worker of {self.db_name} did not answer"}
+
+    def call(self, indexes, action, parameters, return_value=None, dedup=None):
+        # Sends one action to several workers at once and returns their answers in order
+        sent = [self.send(index, {'action': action, 'parameters': parameters, 'return_value': return_value,
+                                  'dedup': dedup})
+                for index in indexes]
+        return [self.wait(*request) for request in sent]
+
+    def submit_action(self, node, action, parameters, return_value = None, dedup = None):
+        everyone = range(self.subshards)
+        if action == 'track_loans':
+            return self.merge_loans(parameters, self.call(everyone, action, parameters, return_value, dedup))
+        if action == 'loan_history':
+            results = self.call(everyone, action, parameters, return_value, dedup)
+            failed = next((result for result in results if result.get('status') != 'Success'), None)
+            return failed or {"status": "Success",
+                              "data": sorted((row for result in results for row in result['data']), key=lambda row: row[0]),
+                              "archived": sum(result['archived'] for result in results)}
+        if action in SCATTER_ACTIONS:
+            # Only the sub-shard holding the loan can succeed
+            results = self.call(everyone, action, parameters, return_value, dedup)
+            return next((result for result in results if result.get('status') == 'Success'), results[-1])
+        if action == 'bulk_add_books':
+            return self.split_bulk(action, 'books', 'book_id', self.book_shards, parameters, dedup)
+        if action == 'bulk_add_users':
+            return self.split_bulk(action, 'users', 'user_id', self.user_shards, parameters, dedup)
+        if action in BOOK_ACTIONS:
+            index = self.book_shards.lookup(parameters['book_id'])
+        elif action in USER_ACTIONS:
+            index = self.user_shards.lookup(parameters['user_id'])
+        else:
+            index = 0
+        return self.call([index], action, parameters, return_value, dedup)[0]
+
+    def merge_loans(self, parameters, results):
+        failed = next((result for result in results if result.get('status') != 'Success'), None)
+        if failed is not None:
+            return failed
+        rows = sorted((row for result in results for row in result.get('data', ())), key=lambda row: row[0])
+        if not parameters:
+            if not rows:
+                return {"status": "Success", "message": f"All books in {self.db_name} are available"}
+            return {"status": "Success", "data": rows}
+        # Every sub-shard returned its first `limit` loans after the cursor, so the first `limit`
+        # of all of them are the page
+        limit = min(parameters.get('limit') or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        rows = rows[:limit]
+        return {"status": "Success", "data": rows, "next": rows[-1][0] if len(rows) == limit else None}
+
+    def split_bulk(self, action, field, key, shards, parameters, dedup):
+        parts = {}
+        for row in parameters[field]:
+            parts.setdefault(shards.lookup(row[key]), []).append(row)
+        indexes = sorted(parts)
+        sent = [self.send(index, {'action': action, 'parameters': {field: parts[index]}, 'return_value': None,
+                                  'dedup': dedup})
+                for index in indexes]
+        results = [self.wait(*request) for request in sent]
+        failed = next((result for result in results if result.get('status') != 'Success'), None)
+        if failed is not None:
+            return failed
+        added = sum(result['return_value']['added'] for result in results)
+        duplicates = [value for result in results for value in result['return_value']['duplicates']]
+        return {"status": "Success", "message": f"Added {added} of {len(parameters[field])} rows",
+                "return_value": {"added": added, "duplicates": duplicates}}
+
+    def worker_metrics(self):
+        sent = [self.send(index, {'metrics': True}) for index in range(self.subshards)]
+        return {name: self.wait(*request) for name, request in zip(self.files, sent)}
+
+    def subshard_stats(self):
+        with self.pending_lock:
+            return {"workers": self.subshards, "in_flight": len(self.pending),
+                    "routed": dict(zip(self.files, self.routed)),
+                    "alive": sum(worker.is_alive() for worker in self.workers)}
+
+    def close(self):
+        for requests in self.requests:
+            requests.put(None)
+        for worker in self.workers:
+            worker.join(5)
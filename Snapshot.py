@@ -0,0 +1,170 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import uuid
+from time import monotonic, time
+from Instrumentation import get_logger
+
+logger = get_logger('snapshot')
+
+SQL_LOG_HEAD = "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'LoanLog'), 0)"
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+
+def copy_database(conn, path):
+    # Consistent copy of the database behind `conn` at `path`. The backup API copies every page
+    # in one step under a single read transaction, so writers on other connections carry on
+    # and the copy is one point in time; it is renamed into place only once complete
+    tmp_path = f"{path}.tmp"
+    target = sqlite3.connect(tmp_path)
+    try:
+        conn.backup(target)
+    finally:
+        target.close()
+    # Nothing else has `path` open, so journals left next to it belong to an older file
+    remove_journals(path)
+    os.replace(tmp_path, path)
+
+
+def remove_journals(path):
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def load_database(conn, path):
+    # Fills the (usually in-memory) database behind `conn` with the file at `path`
+    source = sqlite3.connect(path)
+    try:
+        source.backup(conn)
+    finally:
+        source.close()
+
+
+def snapshot_position(path):
+    # Where a restored node resumes replication: the head of its own change log and how far
+    # it had applied each peer's log when the snapshot was taken
+    conn = sqlite3.connect(path)
+    try:
+        head = conn.execute(SQL_LOG_HEAD).fetchone()[0]
+        cursors = dict(conn.execute("SELECT origin, seq FROM LogCursors").fetchall())
+    except sqlite3.OperationalError:
+        # A file from before the change log existed
+        head, cursors = 0, {}
+    finally:
+        conn.close()
+    return head, cursors
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(DEFAULT_CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class SnapshotStore:
+    # Server side of snapshot streaming. The first request takes a snapshot into a file next to
+    # the database and later requests read it chunk by chunk by offset, so a large catalogue is
+    # never held in memory. A snapshot is removed once its last chunk is read, or when its
+    # reader has been silent for `ttl` seconds
+    def __init__(self, pool, db_name, ttl=300.0):
+        self.pool = pool
+        self.db_name = db_name
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # snapshot id -> {"path", "size", "sha256", "head", "cursors", "used"}
+        self.snapshots = {}
+        self.taken = 0
+        self.served_bytes = 0
+
+    def take(self):
+        snapshot_id = uuid.uuid4().hex
+        path = f"{self.db_name}.snapshot-{snapshot_id}"
+        started = time()
+        with self.pool.connection() as conn:
+            copy_database(conn, path)
+        head, cursors = snapshot_position(path)
+        snapshot = {"path": path, "size": os.path.getsize(path), "sha256": file_digest(path),
+                    "head": head, "cursors": cursors, "used": monotonic()}
+        with self.lock:
+            self.snapshots[snapshot_id] = snapshot
+            self.taken += 1
+        logger.info("Snapshot %s of %s taken in %.3fs: %s bytes, log head %s", snapshot_id, self.db_name,
+                    time() - started, snapshot["size"], head)
+        return snapshot_id, snapshot
+
+    def serve(self, request):
+        self.expire()
+        snapshot_id = request.get('id')
+        if snapshot_id is None:
+            snapshot_id, snapshot = self.take()
+        else:
+            with self.lock:
+                snapshot = self.snapshots.get(snapshot_id)
+            if snapshot is None:
+                return {"status": "Failed", "message": f"Snapshot {snapshot_id} of {self.db_name} has expired"}
+        offset = request.get('offset', 0)
+        with open(snapshot["path"], 'rb') as f:
+            f.seek(offset)
+            data = f.read(request.get('size') or DEFAULT_CHUNK_SIZE)
+        done = offset + len(data) >= snapshot["size"]
+        with self.lock:
+            snapshot["used"] = monotonic()
+            self.served_bytes += len(data)
+        if done:
+            self.discard(snapshot_id)
+        return {"status": "Success", "id": snapshot_id, "offset": offset, "data": data, "done": done,
+                "size": snapshot["size"], "sha256": snapshot["sha256"], "head": snapshot["head"],
+                "cursors": snapshot["cursors"]}
+
+    def discard(self, snapshot_id):
+        with self.lock:
+            snapshot = self.snapshots.pop(snapshot_id, None)
+        if snapshot is not None and os.path.exists(snapshot["path"]):
+            os.remove(snapshot["path"])
+
+    def expire(self):
+        now = monotonic()
+        with self.lock:
+            stale = [snapshot_id for snapshot_id, snapshot in self.snapshots.items() if now - snapshot["used"] > self.ttl]
+        for snapshot_id in stale:
+            logger.warning("Snapshot %s of %s was abandoned", snapshot_id, self.db_name)
+            self.discard(snapshot_id)
+
+    def stats(self):
+        with self.lock:
+            return {"open": len(self.snapshots), "taken": self.taken, "served_bytes": self.served_bytes}
+
+
+def fetch_snapshot(pool, path, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Streams a snapshot from the server behind `pool` (a ConnectionPool) into `path` and returns
+    # {"size", "sha256", "head", "cursors"}. The file only appears at `path` once its checksum
+    # matches, ready for restore_snapshot
+    tmp_path = f"{path}.part"
+    request = {'id': None, 'offset': 0, 'size': chunk_size}
+    with open(tmp_path, 'wb') as f:
+        while True:
+            response = pool.request({'snapshot': request})
+            if response.get('status') != 'Success':
+                raise RuntimeError(f"Snapshot transfer failed: {response.get('message')}")
+            f.write(response['data'])
+            if response['done']:
+                break
+            request = {'id': response['id'], 'offset': response['offset'] + len(response['data']), 'size': chunk_size}
+    if os.path.getsize(tmp_path) != response['size'] or file_digest(tmp_path) != response['sha256']:
+        os.remove(tmp_path)
+        raise RuntimeError("Snapshot transfer was corrupted")
+    os.replace(tmp_path, path)
+    return {name: response[name] for name in ("size", "sha256", "head", "cursors")}
+
+
+def restore_snapshot(path, db_name):
+    # Installs a fetched snapshot as a library's database file, before its server starts. The
+    # file is used as it is, with no rows replayed; a server started on it with change_log=True
+    # pulls the peers' logs from the cursors saved in the snapshot onwards
+    remove_journals(db_name)
+    os.replace(path, db_name)
+    return snapshot_position(db_name)
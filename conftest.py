@@ -0,0 +1,36 @@
+import threading
+import pytest
+from Database import create_database
+
+LIBRARIES = {'Library A': 1000, 'Library B': 2000, 'Library C': 3000}
+
+
+@pytest.fixture
+def libraries(tmp_path, monkeypatch):
+    # Servers open their database by library name, so every test gets its own directory
+    monkeypatch.chdir(tmp_path)
+    for name, base_id in LIBRARIES.items():
+        create_database(name, base_id)
+    return tmp_path
+
+
+@pytest.fixture
+def start_servers(libraries):
+    started = []
+
+    def start(cls, **kwargs):
+        servers = {name: cls('localhost', 0, name, **kwargs) for name in LIBRARIES}
+        started.extend(servers.values())
+        addresses = {name: server.socket.getsockname() for name, server in servers.items()}
+        for server in servers.values():
+            server.peers = addresses
+            threading.Thread(target=server.start, daemon=True).start()
+        return servers, addresses
+    yield start
+    # Servers are left to die with the test run, but their background pullers and archivers
+    # must not keep working on the files of a finished test
+    for server in started:
+        if server.replicator is not None:
+            server.replicator.stop()
+        if server.archiver is not None:
+            server.archiver.stop()
@@ -0,0 +1,85 @@
+import threading
+from time import sleep
+from Admission import AdmissionQueue, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BULK
+from Client import BaseClient
+from Hop import Hop
+from Server import BaseServer
+
+
+def blocked_queue(**kwargs):
+    # A single worker held on an event, so submitted requests stay queued until release
+    queue = AdmissionQueue(workers=1, **kwargs)
+    release = threading.Event()
+    started = threading.Event()
+    queue.submit(PRIORITY_NORMAL, lambda: (started.set(), release.wait()), None)
+    started.wait()
+    return queue, release
+
+
+def test_higher_priorities_run_first():
+    queue, release = blocked_queue()
+    ran = []
+    done = threading.Event()
+    queue.submit(PRIORITY_BULK, lambda: ran.append('bulk'), None)
+    queue.submit(PRIORITY_NORMAL, lambda: ran.append('write'), None)
+    queue.submit(PRIORITY_HIGH, lambda: ran.append('read'), None)
+    queue.submit(PRIORITY_BULK, done.set, None)
+    release.set()
+    assert done.wait(5)
+    assert ran == ['read', 'write', 'bulk']
+
+
+def test_a_full_queue_sheds_lower_priorities_then_rejects():
+    queue, release = blocked_queue(max_depth=2)
+    refused = []
+    reject = refused.append
+    assert queue.submit(PRIORITY_BULK, lambda: None, lambda response: refused.append(('bulk', response)))
+    assert queue.submit(PRIORITY_NORMAL, lambda: None, reject)
+    # A read takes the bulk load's place, which is answered at once
+    assert queue.submit(PRIORITY_HIGH, lambda: None, reject)
+    assert refused[0][0] == 'bulk' and refused[0][1]['status'] == 'Overloaded'
+    # Nothing lower is left to drop for another write
+    assert not queue.submit(PRIORITY_NORMAL, lambda: None, reject)
+    assert refused[1]['status'] == 'Overloaded' and refused[1]['retry_after'] > 0
+    # Forced requests are queued anyway
+    assert queue.submit(PRIORITY_NORMAL, lambda: None, reject, force=True)
+    stats = queue.stats()
+    assert (stats['depth'], stats['shed'], stats['rejected']) == (3, 1, 1)
+    release.set()
+
+
+def test_requests_past_their_deadline_are_not_run():
+    queue, release = blocked_queue()
+    ran = []
+    refused = []
+    done = threading.Event()
+    queue.submit(PRIORITY_HIGH, lambda: ran.append('late'), refused.append, deadline=0.01)
+    queue.submit(PRIORITY_NORMAL, done.set, None)
+    sleep(0.05)
+    release.set()
+    assert done.wait(5)
+    assert ran == [] and refused[0]['status'] == 'Overloaded'
+    assert queue.stats()['expired'] == 1
+
+
+def test_clients_retry_overloaded_requests_and_then_give_up(start_servers):
+    servers, addresses = start_servers(BaseServer, request_workers=1, max_queue_depth=0)
+    client = BaseClient(addresses, 1001, 'Library A', overload_retries=2)
+    hop = Hop(hop_id=1, node='Library A', action='query_user', parameters={'user_id': 1001})
+    response = client.send_hop('Library A', hop)
+    client.close()
+    assert response['status'] == 'Failed' and 'overloaded' in response['message']
+    assert client.overloaded == 3
+    snapshot = servers['Library A'].metrics.snapshot()
+    assert snapshot['counters']['admission.rejected'] == 3
+    assert snapshot['gauges']['admission']['rejected'] == 3
+
+
+def test_requests_are_served_through_the_queue(start_servers):
+    servers, addresses = start_servers(BaseServer, request_workers=2, max_queue_depth=8)
+    client = BaseClient(addresses, 1001, 'Library A', queue_deadline=5.0)
+    assert client.query_user(1, {'user_id': 1001})
+    client.close()
+    snapshot = servers['Library A'].metrics.snapshot()
+    assert snapshot['timers']['queue_wait.priority0']['count'] >= 1
+    assert snapshot['gauges']['admission']['admitted'] >= 1
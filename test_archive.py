@@ -0,0 +1,91 @@
+import sqlite3
+from datetime import date
+from Archive import LoanArchiver, archive_months, archive_path
+from Client import BaseClient
+from Server import BaseServer, LOAN_ID_STRIDE
+
+LOANS = [(1, 1001, 1001, '2023-01-02', '2023-01-10', '2023-02-01'),
+         (2, 1002, 1002, '2023-01-05', '2023-02-03', '2023-02-05'),
+         (3, 1003, 1001, '2023-02-01', '2023-02-20', '2023-03-01'),
+         (4, 1001, 1002, '2023-03-01', '2023-05-30', '2023-04-01'),
+         (5, 1002, 1001, '2023-06-01', None, '2023-07-01')]
+
+
+def rows(db_name, sql):
+    with sqlite3.connect(db_name) as conn:
+        return conn.execute(sql).fetchall()
+
+
+def archived_library(libraries):
+    with sqlite3.connect('Library A') as conn:
+        conn.executemany("INSERT INTO Loans VALUES (?, ?, ?, ?, ?, ?)", LOANS)
+    server = BaseServer('localhost', 0, 'Library A')
+    # Loans returned more than 30 days before June 10th, 2023 are archived
+    archiver = LoanArchiver(server, 30, batch_size=2, rate=1000, today=lambda: date(2023, 6, 10))
+    return server, archiver
+
+
+def test_returned_loans_past_the_horizon_move_to_monthly_archives(libraries):
+    server, archiver = archived_library(libraries)
+    assert archiver.archive() == 3
+    # A full batch of two, then the batch that found the last row
+    assert archiver.stats()['batches'] == 2
+    assert rows('Library A', "SELECT loan_id FROM Loans ORDER BY loan_id") == [(4,), (5,)]
+    assert archive_months('Library A') == ['2023-01', '2023-02']
+    assert rows(archive_path('Library A', '2023-02'), "SELECT loan_id FROM Loans ORDER BY loan_id") == [(2,), (3,)]
+    assert archiver.archive() == 0
+
+
+def test_history_reaches_archived_loans(libraries):
+    server, archiver = archived_library(libraries)
+    archiver.archive()
+    with server.pool.connection() as conn:
+        everything = server.run_action(conn, 'loan_history', {})
+        assert [row[0] for row in everything['data']] == [1, 2, 3, 4, 5] and everything['archived'] == 3
+        by_user = server.run_action(conn, 'loan_history', {'user_id': 1001})
+        assert [row[0] for row in by_user['data']] == [1, 3, 5]
+        recent = server.run_action(conn, 'loan_history', {'since': '2023-02'})
+        assert [row[0] for row in recent['data']] == [2, 3, 4, 5]
+
+
+def test_rows_left_in_both_places_are_reported_once_and_cleaned_up(libraries):
+    server, archiver = archived_library(libraries)
+    archiver.archive()
+    # As if a batch was copied but the process died before deleting it from Loans
+    with sqlite3.connect('Library A') as conn:
+        conn.execute("INSERT INTO Loans VALUES (?, ?, ?, ?, ?, ?)", LOANS[0])
+    with server.pool.connection() as conn:
+        assert [row[0] for row in server.run_action(conn, 'loan_history', {'book_id': 1001})['data']] == [1, 4]
+    assert archiver.archive() == 1
+    assert rows(archive_path('Library A', '2023-01'), "SELECT COUNT(*) FROM Loans") == [(1,)]
+
+
+def test_clients_query_history_through_the_server(start_servers):
+    servers, addresses = start_servers(BaseServer, archive_horizon=0, archive_interval=0.01)
+    client = BaseClient(addresses, 1002, 'Library A')
+    assert client.borrow_book(1, {'book_id': 1001, 'user_id': 1002, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'})
+    assert client.return_book(2, {'book_id': 1001, 'return_date': '2023-02-10'})
+    server = servers['Library A']
+    for _ in range(500):
+        if server.archiver.stats()['archived']:
+            break
+        server.archiver.stopped.wait(0.01)
+    assert rows('Library A', "SELECT COUNT(*) FROM Loans") == [(0,)]
+    assert [row[0] for row in client.loan_history(user_id=1002)] == [1]
+    client.close()
+
+
+def test_loan_ids_are_not_reused_after_archiving(start_servers):
+    servers, addresses = start_servers(BaseServer)
+    archiver = LoanArchiver(servers['Library A'], 0, today=lambda: date(2023, 6, 10))
+    client = BaseClient(addresses, 1002, 'Library A')
+    borrow = {'book_id': 1001, 'user_id': 1002, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'}
+    assert client.borrow_book(1, borrow)
+    assert client.return_book(2, {'book_id': 1001, 'return_date': '2023-02-10'})
+    assert archiver.archive() == 1
+    # The archived loan was the newest, so MAX(loan_id) of Loans went back to nothing
+    assert client.borrow_book(3, dict(borrow, borrow_date='2023-06-01'))
+    assert [row[0] for row in client.loan_history(book_id=1001)] == [1, 1 + LOAN_ID_STRIDE]
+    for db_name in ('Library B', 'Library C'):
+        assert rows(db_name, "SELECT loan_id, return_date FROM Loans ORDER BY loan_id") == [(1, '2023-02-10'), (1 + LOAN_ID_STRIDE, None)]
+    client.close()
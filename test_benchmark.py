@@ -0,0 +1,36 @@
+import random
+from Benchmark import ZipfKeys, WorkloadGenerator, Benchmark, percentile, save_workload, load_workload, parse_mix
+
+
+def test_zipf_keys_favour_low_ranks():
+    keys = ZipfKeys(range(100), s=1.2, rng=random.Random(1))
+    draws = [keys.draw() for _ in range(5000)]
+    assert draws.count(0) > draws.count(50) * 10
+    uniform = ZipfKeys(range(4), s=0, rng=random.Random(1))
+    assert {uniform.draw() for _ in range(200)} == {0, 1, 2, 3}
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 1001))
+    assert (percentile(values, 50), percentile(values, 99), percentile(values, 99.9)) == (500, 990, 999)
+    assert percentile([], 50) is None
+
+
+def test_workload_round_trip(tmp_path):
+    generator = WorkloadGenerator(parse_mix("borrow_book=1,query_user=1"), books_per_library=10, seed=3)
+    records = [generator.record() for _ in range(20)]
+    assert {record['type'] for record in records} == {'borrow_book', 'query_user'}
+    assert [record['request_id'] for record in records[:2]] == ['t-1', 't-2']
+    save_workload(tmp_path / 'workload.jsonl', records)
+    assert list(load_workload(tmp_path / 'workload.jsonl')) == records
+
+
+def test_closed_loop_run_reports_json_ready_results():
+    benchmark = Benchmark(system='origin', clients=2, duration=2.0, transactions=20, books_per_library=20, seed=7,
+                          mix=parse_mix("query_user=2,add_user=1,track_loans=1"))
+    report = benchmark.run()
+    assert report['transactions'] == 20
+    assert report['errors'] == 0
+    assert set(report['per_type']) <= {'query_user', 'add_user', 'track_loans'}
+    assert all(stats['p50_ms'] <= stats['p999_ms'] for stats in report['per_type'].values())
+    assert report['consistency']['consistent']
@@ -0,0 +1,81 @@
+import json
+import sqlite3
+from Client import BaseClient, OriginOrderClient, read_rows
+from Partition import PartitionDirectory
+from Server import BaseServer, OriginOrderServer
+
+
+def book(book_id):
+    return {'book_id': book_id, 'title': f'Book {book_id}', 'author': 'Author', 'publication_date': '2023-01-01',
+            'category': 'Fiction', 'status': 'Available'}
+
+
+def count_books(db_name, ids):
+    with sqlite3.connect(db_name) as conn:
+        return conn.execute("SELECT COUNT(*) FROM Books WHERE book_id IN (SELECT value FROM json_each(?))",
+                            (json.dumps(list(ids)),)).fetchone()[0]
+
+
+def test_bulk_insert_reports_existing_and_repeated_keys(libraries):
+    server = BaseServer('localhost', 0, 'Library A')
+    result = server.execute_action('Library A', 'bulk_add_books', {'books': [book(1001), book(1500), book(1500)]})
+    assert result['status'] == 'Success'
+    assert result['return_value'] == {'added': 1, 'duplicates': [1001, 1500]}
+    assert count_books('Library A', [1500]) == 1
+
+
+def test_bulk_add_books_routes_chunks_per_partition(start_servers):
+    _, addresses = start_servers(BaseServer)
+    client = BaseClient(addresses, 1001, 'Library A')
+    reports = []
+    # 1001 exists already; the new ids fall in the ranges of all three libraries
+    ids = list(range(1500, 1700)) + list(range(2500, 2650)) + list(range(3500, 3650))
+    rows = (book(book_id) for book_id in [1001] + ids)
+    summary = client.bulk_add_books(1, rows, chunk_size=64, on_chunk=reports.append)
+    client.close()
+    assert summary['rows'] == 501 and summary['added'] == 500 and summary['duplicates'] == 1
+    assert summary['failed'] == 0
+    assert all(report['rows'] <= 64 for report in reports)
+    assert sum(len(report['duplicates']) for report in reports) == 1
+    directory = PartitionDirectory()
+    for node in addresses:
+        owned = [book_id for book_id in ids if directory.node_for_book(book_id) == node]
+        assert owned and count_books(node, ids) == len(owned)
+
+
+def test_bulk_add_books_follows_a_redirect(start_servers):
+    directory = PartitionDirectory()
+    owner = directory.node_for_book(10000)
+    other = next(node for node in directory.nodes if node != owner)
+    servers, addresses = start_servers(OriginOrderServer)
+    # The servers moved the range to another library; the client still has the old routing
+    moved = PartitionDirectory()
+    moved.publish_books(10000, 10100, other)
+    for server in servers.values():
+        server.directory = PartitionDirectory.from_dict(moved.to_dict())
+    client = OriginOrderClient(addresses, 1001, 'Library A', directory=directory)
+    summary = client.bulk_add_books(1, (book(book_id) for book_id in range(10000, 10200)), chunk_size=1000)
+    client.close()
+    assert summary['added'] == 200 and summary['failed'] == 0
+    assert count_books(other, range(10000, 10200)) == 100
+
+
+def test_bulk_add_users_from_csv(start_servers, tmp_path):
+    _, addresses = start_servers(BaseServer)
+    path = tmp_path / 'users.csv'
+    with open(path, 'w') as f:
+        f.write("user_id,name,email,membership\n")
+        for user_id in range(7000, 7010):
+            f.write(f"{user_id},User {user_id},u{user_id}@example.com,Library B\n")
+    client = BaseClient(addresses, 1001, 'Library A')
+    summary = client.bulk_add_users(1, read_rows(str(path)), chunk_size=4)
+    client.close()
+    assert summary == {'chunks': 3, 'rows': 10, 'added': 10, 'duplicates': 0, 'failed': 0}
+    with sqlite3.connect('Library B') as conn:
+        assert conn.execute("SELECT COUNT(*) FROM Users WHERE user_id >= 7000").fetchone()[0] == 10
+
+
+def test_read_rows_streams_jsonl(tmp_path):
+    path = tmp_path / 'books.jsonl'
+    path.write_text('\n'.join(json.dumps(book(book_id)) for book_id in (1, 2)) + '\n')
+    assert [row['book_id'] for row in read_rows(str(path))] == [1, 2]
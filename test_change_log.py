@@ -0,0 +1,121 @@
+import sqlite3
+import threading
+import pytest
+from time import monotonic, sleep
+from Client import BaseClient, OriginOrderClient
+from Server import BaseServer, OriginOrderServer, LOAN_ID_STRIDE
+
+LIBRARIES = ('Library A', 'Library B', 'Library C')
+
+
+def loans(db_name):
+    with sqlite3.connect(db_name) as conn:
+        return conn.execute("SELECT loan_id, book_id, user_id, return_date FROM Loans ORDER BY loan_id").fetchall()
+
+
+def wait_replicated(servers, timeout=5):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        if len({tuple(loans(name)) for name in LIBRARIES}) == 1 and all(
+                stats['lag'] == 0 for server in servers.values() for stats in server.replicator.stats().values()):
+            return
+        sleep(0.02)
+    raise AssertionError({name: loans(name) for name in LIBRARIES})
+
+
+def test_borrow_and_return_reach_replicas_through_the_log(start_servers):
+    servers, addresses = start_servers(BaseServer, change_log=True, log_poll_interval=0.01)
+    client = BaseClient(addresses, 1002, 'Library A', replication='log')
+    assert client.borrow_book(1, {'book_id': 2001, 'user_id': 1002, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'})
+    # Only the owner was written synchronously
+    assert len(loans('Library B')) == 1
+    assert client.return_book(2, {'book_id': 2001, 'return_date': '2023-02-10'})
+    wait_replicated(servers)
+    assert loans('Library A') == [(2, 2001, 1002, '2023-02-10')]
+    client.close()
+    stats = servers['Library A'].replicator.stats()['Library B']
+    assert stats['cursor'] == 2 and stats['applied'] == 2 and stats['conflicts'] == 0
+    assert servers['Library B'].change_log.stats()['head'] == 2
+
+
+def test_applying_a_batch_twice_changes_nothing(start_servers):
+    servers, addresses = start_servers(BaseServer, change_log=True, log_poll_interval=0.01)
+    client = BaseClient(addresses, 1002, 'Library A', replication='log')
+    client.borrow_book(1, {'book_id': 3001, 'user_id': 1002, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'})
+    client.close()
+    wait_replicated(servers)
+    replicator = servers['Library A'].replicator
+    # The entry Library C logged for the borrow, as a pull would return it again
+    entries = [(1, 'borrow', 3, 3001, 1002, '2023-02-01', None, '2023-03-01', 0.0)]
+    replicator.apply('Library C', entries)
+    assert loans('Library A') == loans('Library C')
+    # The cursor survives a restart, so a new replicator resumes where the old one stopped
+    with sqlite3.connect('Library A') as conn:
+        assert conn.execute("SELECT seq FROM LogCursors WHERE origin = 'Library C'").fetchone() == (1,)
+
+
+def test_sync_hops_and_log_together_stay_consistent(start_servers):
+    servers, addresses = start_servers(OriginOrderServer, change_log=True, log_poll_interval=0.01)
+    client = OriginOrderClient(addresses, 1002, 'Library A')
+    client.borrow_book(1, {'book_id': 1001, 'user_id': 1002, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'})
+    client.return_book(2, {'book_id': 1001, 'return_date': '2023-02-10'})
+    client.close()
+    wait_replicated(servers)
+    assert loans('Library C') == [(1, 1001, 1002, '2023-02-10')]
+
+
+def test_compaction_drops_entries_every_peer_applied(start_servers):
+    servers, addresses = start_servers(BaseServer, change_log=True, log_poll_interval=0.01, log_retention=0)
+    client = BaseClient(addresses, 1002, 'Library A', replication='log')
+    client.borrow_book(1, {'book_id': 1001, 'user_id': 1002, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'})
+    client.close()
+    wait_replicated(servers)
+    deadline = monotonic() + 5
+    while monotonic() < deadline:
+        with sqlite3.connect('Library A') as conn:
+            if conn.execute("SELECT COUNT(*) FROM LoanLog").fetchone()[0] == 0:
+                break
+        sleep(0.02)
+    with sqlite3.connect('Library A') as conn:
+        assert conn.execute("SELECT COUNT(*) FROM LoanLog").fetchone()[0] == 0
+
+
+def test_libraries_borrowing_at_once_hand_out_distinct_loan_ids(start_servers):
+    servers, addresses = start_servers(BaseServer, change_log=True, log_poll_interval=0.01)
+    clients = [BaseClient(addresses, 1002, 'Library A', replication='log'),
+               BaseClient(addresses, 2002, 'Library B', replication='log')]
+    borrows = [(client, t_id, {'book_id': book_id, 'user_id': client.id, 'borrow_date': '2023-02-01',
+                               'due_date': '2023-03-01'})
+               for client, first in zip(clients, (1001, 2001))
+               for t_id, book_id in enumerate(range(first, first + 3), start=1)]
+    threads = [threading.Thread(target=client.borrow_book, args=(t_id, params)) for client, t_id, params in borrows]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for client in clients:
+        client.close()
+    wait_replicated(servers)
+    replicated = loans('Library C')
+    assert sorted(row[1] for row in replicated) == [1001, 1002, 1003, 2001, 2002, 2003]
+    assert {row[0] % LOAN_ID_STRIDE for row in replicated if row[1] < 2000} == {1}
+    assert {row[0] % LOAN_ID_STRIDE for row in replicated if row[1] > 2000} == {2}
+    assert all(stats['conflicts'] == 0 for stats in servers['Library C'].replicator.stats().values())
+
+
+def test_a_clashing_loan_id_stops_the_apply(start_servers):
+    servers, addresses = start_servers(BaseServer, change_log=True, log_poll_interval=0.01)
+    client = BaseClient(addresses, 1002, 'Library A', replication='log')
+    client.borrow_book(1, {'book_id': 1001, 'user_id': 1002, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'})
+    client.close()
+    wait_replicated(servers)
+    replicator = servers['Library C'].replicator
+    replicator.stop()
+    cursor = replicator.stats()['Library B']['cursor']
+    # A loan of Library B's book under the id Library A gave its loan
+    entries = [(cursor + 1, 'borrow', 1, 2001, 2002, '2023-02-01', None, '2023-03-01', 0.0)]
+    with pytest.raises(RuntimeError, match='clashes'):
+        replicator.apply('Library B', entries)
+    assert replicator.stats()['Library B']['cursor'] == cursor
+    assert replicator.stats()['Library B']['conflicts'] == 1
+    assert loans('Library C') == [(1, 1001, 1002, None)]
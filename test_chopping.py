@@ -0,0 +1,59 @@
+from Chopping import ChoppingAnalyzer, TransactionType, default_analyzer
+
+
+def test_single_piece_types_are_unordered():
+    plans = default_analyzer().plans()
+    for name in ('add_user', 'add_book', 'delete_book', 'query_user', 'track_loans'):
+        assert not plans[name].ordered, name
+        assert plans[name].parallel_groups == [[0]]
+
+
+def test_chopped_types_on_sc_cycles_are_ordered():
+    plans = default_analyzer().plans()
+    for name in ('borrow_book', 'return_book'):
+        assert plans[name].ordered
+        # Both replica pieces go out in one wave after the owner piece
+        assert plans[name].parallel_groups == [[0], [1, 2]]
+
+
+def test_cycle_nodes_only_cover_witness_paths():
+    analyzer = ChoppingAnalyzer()
+    path_nodes = set()
+    for cycle in analyzer.find_sc_cycles():
+        assert cycle['path'][0].startswith(f"{cycle['type']}#0.")
+        assert cycle['path'][-1].startswith(f"{cycle['type']}#0.")
+        path_nodes.update(step.split('#')[0] for step in cycle['path'])
+    assert {name for name, _ in analyzer.cycle_nodes} == path_nodes
+
+
+def test_unordered_actions():
+    assert default_analyzer().unordered_actions() == {'add_user', 'add_book', 'delete_book', 'query_user', 'track_loans',
+                                                      'bulk_add_books', 'bulk_add_users', 'loan_history'}
+
+
+def test_self_conflicting_chopped_type_is_ordered():
+    analyzer = ChoppingAnalyzer([
+        TransactionType('register', [('add_user', 'local'), ('query_user', 'local')]),
+        TransactionType('shelve', [('add_book', 'owner')]),
+    ])
+    # Two concurrent registers close a cycle through each other's add_user piece
+    assert [cycle['type'] for cycle in analyzer.find_sc_cycles()] == ['register']
+    assert analyzer.plan('register').ordered
+    assert not analyzer.plan('shelve').ordered
+
+
+def test_pieces_without_conflicts_have_no_cycle():
+    analyzer = ChoppingAnalyzer([
+        TransactionType('lookup', [('query_user', 'local'), ('track_loans', 'local')]),
+    ])
+    assert analyzer.find_sc_cycles() == []
+    assert not analyzer.plan('lookup').ordered
+    assert analyzer.plan('lookup').commutes
+
+
+def test_replicated_types_have_one_piece_per_replica():
+    for replicas in (1, 3):
+        plans = default_analyzer(replicas).plans()
+        for name in ('borrow_book', 'return_book'):
+            assert len(plans[name].pieces) == replicas + 1
+            assert plans[name].parallel_groups == [[0], list(range(1, replicas + 1))]
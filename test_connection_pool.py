@@ -0,0 +1,66 @@
+import socket
+import threading
+from time import sleep, monotonic
+import pytest
+from Hop import Hop
+from ConnectionPool import ConnectionPool
+from Server import BaseServer
+
+
+def test_refused_connection_does_not_mark_pool_legacy():
+    listener = socket.create_server(('localhost', 0))
+    address = listener.getsockname()
+    listener.close()
+    pool = ConnectionPool('Library A', address)
+    with pytest.raises(ConnectionError):
+        pool.request({'hop': None})
+    assert pool.stats()['legacy'] is False
+
+
+def test_requests_on_one_connection_are_served_concurrently(start_servers):
+    servers, addresses = start_servers(BaseServer)
+    server = servers['Library A']
+    execute = server.submit_action
+
+    def slow_submit(node, action, parameters, return_value=None, dedup=None):
+        if parameters.get('slow'):
+            sleep(0.5)
+        return execute(node, action, parameters, return_value, dedup)
+    server.submit_action = slow_submit
+
+    pool = ConnectionPool('Library A', addresses['Library A'], max_connections=1)
+    finished = {}
+
+    def send(name, parameters):
+        pool.request({'hop': Hop(1, 'Library A', 'query_user', parameters)})
+        finished[name] = monotonic()
+
+    slow = threading.Thread(target=send, args=('slow', {'user_id': 1001, 'slow': True}))
+    slow.start()
+    sleep(0.1)
+    send('fast', {'user_id': 1002})
+    slow.join()
+    assert pool.stats()['connections'] == 1
+    assert finished['fast'] < finished['slow']
+    pool.close()
+
+
+def test_idle_connection_is_pinged_without_holding_the_pool_lock(start_servers):
+    _, addresses = start_servers(BaseServer)
+    pool = ConnectionPool('Library A', addresses['Library A'], health_check_interval=1.0)
+    conn = pool.checkout()
+    conn.last_used -= 2
+    pinged = []
+    ping = conn.ping
+
+    def observed_ping(timeout):
+        # Another caller can still use the pool while the health check is in flight
+        acquired = pool.lock.acquire(blocking=False)
+        if acquired:
+            pool.lock.release()
+        pinged.append(acquired)
+        return ping(timeout)
+    conn.ping = observed_ping
+    assert pool.checkout() is conn
+    assert pinged == [True]
+    pool.close()
@@ -0,0 +1,34 @@
+import threading
+from DatabasePool import DatabasePool
+
+
+def test_pool_connection_is_reentrant_per_thread(libraries):
+    pool = DatabasePool('Library A', size=2)
+    with pool.connection() as outer:
+        with pool.connection() as inner:
+            assert inner is outer
+        assert pool.stats()['in_use'] == 1
+    assert pool.stats()['in_use'] == 0
+    with pool.connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    pool.close()
+
+
+def test_pool_waits_for_a_free_connection(libraries):
+    pool = DatabasePool('Library A', size=1)
+    acquired = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with pool.connection():
+            acquired.set()
+            release.wait(5)
+    holder = threading.Thread(target=hold)
+    holder.start()
+    acquired.wait(5)
+    threading.Timer(0.05, release.set).start()
+    with pool.connection():
+        pass
+    holder.join()
+    assert pool.stats()['waits'] == 1
+    pool.close()
@@ -0,0 +1,59 @@
+import sqlite3
+import threading
+from GroupCommit import GroupCommitter
+from Server import BaseServer
+
+BOOK = {'title': 'T', 'author': 'A', 'publication_date': '2023-01-01', 'category': 'Fiction', 'status': 'Available'}
+
+
+def books(db_name):
+    with sqlite3.connect(db_name) as conn:
+        return {row[0] for row in conn.execute("SELECT book_id FROM Books")}
+
+
+def test_failed_hop_rolls_back_to_its_savepoint_only(libraries):
+    server = BaseServer('localhost', 0, 'Library A')
+    committer = GroupCommitter(server.pool, server.run_action, window=0.05)
+    results = committer.submit_many([
+        ('add_book', dict(BOOK, book_id=1100), None),
+        # Fails after nothing was written; the batch goes on
+        ('add_book', dict(BOOK, book_id=1001), None),
+        # Raises inside run_action after writing nothing
+        ('add_loan', {'book_id': 1100, 'user_id': 1001, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'}, None),
+        ('delete_book', {'book_id': 1002}, None),
+    ])
+    assert [result['status'] for result in results] == ['Success', 'Failed', 'Failed', 'Success']
+    assert books('Library A') == {1001, 1003, 1100}
+    assert committer.stats()['batches'] == 1
+
+
+def test_partial_writes_of_a_failed_hop_are_undone(libraries):
+    server = BaseServer('localhost', 0, 'Library A')
+
+    def run_action(conn_db, action, parameters, return_value=None, dedup=None):
+        result = server.run_action(conn_db, action, parameters, return_value, dedup)
+        if parameters.get('fail_after_write'):
+            return {"status": "Failed", "message": "rejected after writing"}
+        return result
+    committer = GroupCommitter(server.pool, run_action, window=0.05)
+    results = committer.submit_many([
+        ('add_book', dict(BOOK, book_id=1100, fail_after_write=True), None),
+        ('add_book', dict(BOOK, book_id=1101), None),
+    ])
+    assert [result['status'] for result in results] == ['Failed', 'Success']
+    assert books('Library A') == {1001, 1002, 1003, 1101}
+
+
+def test_concurrent_submitters_share_batches(libraries):
+    server = BaseServer('localhost', 0, 'Library A')
+    committer = GroupCommitter(server.pool, server.run_action, window=0.05, max_batch_size=64)
+    threads = [threading.Thread(target=committer.submit, args=('add_book', dict(BOOK, book_id=book_id)))
+               for book_id in range(1100, 1116)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = committer.stats()
+    assert stats['hops'] == 16 and stats['batches'] < 16
+    assert books('Library A') >= set(range(1100, 1116))
+
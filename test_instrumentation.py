@@ -0,0 +1,97 @@
+import io
+import json
+import threading
+import urllib.request
+from time import sleep
+from Instrumentation import (Histogram, MetricsRegistry, MetricsEndpoint, SnapshotWriter, SamplingProfiler,
+                             configure_logging, flush_logging, get_logger)
+from Client import BaseClient
+from Server import BaseServer
+
+
+def fetch(address, path):
+    with urllib.request.urlopen(f"http://{address[0]}:{address[1]}{path}", timeout=5) as response:
+        return json.load(response)
+
+
+def test_histogram_quantiles_are_bucket_upper_bounds():
+    histogram = Histogram()
+    for _ in range(99):
+        histogram.observe(0.001)
+    histogram.observe(1.0)
+    snapshot = histogram.snapshot()
+    assert snapshot['count'] == 100
+    assert 0.001 <= snapshot['p50'] < 0.002
+    assert 0.001 <= snapshot['p99'] < 0.002
+    assert 1.0 <= snapshot['p999'] < 2.0
+    assert snapshot['max'] == 1.0
+
+
+def test_registry_snapshot_has_counters_timers_and_gauges():
+    metrics = MetricsRegistry()
+    metrics.inc('actions.add_book.Success')
+    metrics.inc('actions.add_book.Success')
+    with metrics.timer('sql.add_book'):
+        pass
+    metrics.register_gauge('depth', lambda: 3)
+    metrics.register_gauge('broken', lambda: 1 / 0)
+    snapshot = metrics.snapshot()
+    assert snapshot['counters'] == {'actions.add_book.Success': 2}
+    assert snapshot['timers']['sql.add_book']['count'] == 1
+    assert snapshot['gauges']['depth'] == 3
+    assert 'error' in snapshot['gauges']['broken']
+
+
+def test_endpoint_serves_metrics_and_drives_the_profiler():
+    metrics = MetricsRegistry()
+    metrics.inc('requests')
+    profiler = SamplingProfiler()
+    endpoint = MetricsEndpoint(metrics, profiler)
+    try:
+        assert fetch(endpoint.address, '/metrics')['counters'] == {'requests': 1}
+        assert fetch(endpoint.address, '/profile/start?interval=0.001') == {'started': True}
+        sleep(0.05)
+        report = fetch(endpoint.address, '/profile/stop')
+        assert not report['running'] and report['samples'] > 0 and report['stacks']
+        assert fetch(endpoint.address, '/profile/reset') == {'reset': True}
+        assert fetch(endpoint.address, '/profile')['samples'] == 0
+    finally:
+        endpoint.close()
+
+
+def test_snapshot_writer_replaces_the_file(tmp_path):
+    metrics = MetricsRegistry()
+    metrics.inc('requests')
+    writer = SnapshotWriter(metrics, str(tmp_path / 'metrics.json'), interval=60)
+    writer.write()
+    writer.stop()
+    with open(tmp_path / 'metrics.json') as f:
+        assert json.load(f)['counters'] == {'requests': 1}
+
+
+def test_logging_is_leveled_and_written_by_the_listener():
+    stream = io.StringIO()
+    configure_logging('INFO', stream=stream)
+    try:
+        logger = get_logger('test')
+        logger.debug("hidden %s", 1)
+        logger.info("shown %s", 2)
+        flush_logging()
+        assert 'shown 2' in stream.getvalue() and 'hidden' not in stream.getvalue()
+    finally:
+        configure_logging('WARNING')
+
+
+def test_server_records_action_timers(libraries):
+    server = BaseServer('localhost', 0, 'Library A', metrics_port=0)
+    address = server.socket.getsockname()
+    threading.Thread(target=server.start, daemon=True).start()
+    client = BaseClient({'Library A': address}, 1001, 'Library A')
+    client.query_user(1, {'user_id': 1001})
+    client.close()
+    snapshot = fetch(server.metrics_endpoint.address, '/metrics')
+    assert snapshot['counters']['actions.query_user.Success'] == 1
+    for timer in ('sql.query_user', 'pool_wait.query_user', 'queue_wait.request', 'serialize.decode'):
+        assert snapshot['timers'][timer]['count'] >= 1
+    assert 'pool' in snapshot['gauges']
+    server.metrics_endpoint.close()
@@ -0,0 +1,104 @@
+import sqlite3
+import threading
+from time import monotonic, sleep
+from KeyScheduler import KeyScheduler, hop_keys
+from Client import OriginOrderClient
+from Server import OriginOrderServer
+
+
+class Recorder:
+    def __init__(self):
+        self.started = []
+        self.gates = {}
+        self.lock = threading.Lock()
+        self.done = threading.Semaphore(0)
+
+    def execute(self, item):
+        with self.lock:
+            self.started.append(item)
+        gate = self.gates.get(item)
+        if gate is not None:
+            assert gate.wait(5)
+        self.done.release()
+
+    def wait(self, count):
+        for _ in range(count):
+            assert self.done.acquire(timeout=5)
+
+
+def wait_idle(scheduler):
+    # Hops leave the scheduler just after their execute call returns
+    deadline = monotonic() + 5
+    while scheduler.stats()['pending'] and monotonic() < deadline:
+        sleep(0.01)
+    assert scheduler.stats()['pending'] == 0
+
+
+def test_hop_keys():
+    assert hop_keys('borrow_book', {'book_id': 2002, 'user_id': 1002}) == [('book', 2002), ('user', 1002)]
+    assert hop_keys('update_loan', {'return_date': '2023-02-10'}, {'loan_id': 7}) == [('loan', 7)]
+    assert hop_keys('track_loans', {}) is None
+
+
+def test_disjoint_hops_run_in_parallel_and_conflicting_ones_in_order():
+    recorder = Recorder()
+    recorder.gates['first'] = threading.Event()
+    scheduler = KeyScheduler(recorder.execute, workers=4)
+    scheduler.submit([('book', 1)], 'first')
+    scheduler.submit([('book', 1), ('user', 5)], 'second')
+    scheduler.submit([('user', 6)], 'other')
+    # 'other' finishes while 'first' still holds book 1, and 'second' has not started
+    recorder.wait(1)
+    assert 'other' in recorder.started and 'second' not in recorder.started
+    recorder.gates['first'].set()
+    recorder.wait(2)
+    assert recorder.started.index('first') < recorder.started.index('second')
+    wait_idle(scheduler)
+    assert scheduler.hot_keys()[0]['key'] == ['book', 1]
+
+
+def test_global_hops_wait_for_earlier_hops_and_block_later_ones():
+    recorder = Recorder()
+    recorder.gates['first'] = threading.Event()
+    scheduler = KeyScheduler(recorder.execute, workers=4)
+    scheduler.submit([('book', 1)], 'first')
+    scheduler.submit(None, 'global')
+    scheduler.submit([('book', 2)], 'later')
+    assert recorder.started in ([], ['first'])
+    recorder.gates['first'].set()
+    recorder.wait(3)
+    assert recorder.started == ['first', 'global', 'later']
+
+
+def test_failing_hop_is_reported_and_releases_its_keys():
+    failures = []
+    recorder = Recorder()
+
+    def execute(item):
+        if item == 'bad':
+            raise ValueError("boom")
+        recorder.execute(item)
+    scheduler = KeyScheduler(execute, fail=lambda item, e: failures.append((item, str(e))), workers=2)
+    scheduler.submit([('book', 1)], 'bad')
+    scheduler.submit([('book', 1)], 'good')
+    recorder.wait(1)
+    assert failures == [('bad', 'boom')]
+    assert recorder.started == ['good']
+
+
+def test_key_locks_are_taken_in_stripe_order():
+    scheduler = KeyScheduler(lambda item: None, lock_stripes=8)
+    locks = scheduler.locks_for([('user', n) for n in range(20)])
+    indexes = [scheduler.key_locks.index(lock) for lock in locks]
+    assert indexes == sorted(set(indexes))
+
+
+def test_key_scheduling_server_keeps_replicas_consistent(start_servers):
+    _, addresses = start_servers(OriginOrderServer, scheduling='key', gap_timeout=5.0)
+    client = OriginOrderClient(addresses, 1002, 'Library A')
+    client.borrow_book(1, {'book_id': 1001, 'user_id': 1002, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'})
+    client.return_book(2, {'book_id': 1001, 'return_date': '2023-02-10'})
+    for db_name in ('Library A', 'Library B', 'Library C'):
+        with sqlite3.connect(db_name) as conn:
+            assert conn.execute("SELECT book_id, return_date FROM Loans").fetchall() == [(1001, '2023-02-10')]
+    client.close()
@@ -0,0 +1,121 @@
+import sqlite3
+from time import sleep, time
+from Client import BaseClient
+from Hop import Hop
+from Outbox import Outbox, backoff_delay
+from Server import BaseServer
+
+LIBRARIES = ('Library A', 'Library B', 'Library C')
+BORROW = {'book_id': 2001, 'user_id': 1002, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'}
+
+
+def loans(db_name):
+    with sqlite3.connect(db_name) as conn:
+        return conn.execute("SELECT loan_id, book_id, user_id FROM Loans ORDER BY loan_id").fetchall()
+
+
+def test_backoff_is_jittered_below_an_exponential_cap():
+    for attempt in range(12):
+        for _ in range(50):
+            assert 0 <= backoff_delay(attempt, base=0.05, cap=1.0) <= min(1.0, 0.05 * 2 ** attempt)
+
+
+def test_entries_survive_reopening_with_the_same_client_key(tmp_path):
+    path = str(tmp_path / 'outbox')
+    outbox = Outbox(path, retry_base=0.001, retry_cap=0.001)
+    client_key = outbox.client_key
+    hops = [Hop(hop_id=2, node='Library A', action='add_loan', parameters=BORROW),
+            Hop(hop_id=3, node='Library C', action='add_loan', parameters=BORROW)]
+    outbox.enqueue('t/1', hops, {'loan_id': 1})
+    # Enqueueing the same piece again keeps one entry
+    outbox.enqueue('t/1', hops[:1], {'loan_id': 1})
+    first = outbox.claim(timeout=0.1)
+    second = outbox.claim(timeout=0.1)
+    assert {first.hop.hop_id, second.hop.hop_id} == {2, 3}
+    assert first.return_value == {'loan_id': 1}
+    assert outbox.claim(timeout=0.01) is None
+    outbox.delivered_entry(first)
+    outbox.failed_entry(second, 'unreachable')
+    assert outbox.stats()['pending'] == 1 and outbox.stats()['retries'] == 1
+    outbox.close()
+
+    outbox = Outbox(path)
+    assert outbox.client_key == client_key
+    entry = outbox.claim(timeout=1.0)
+    assert (entry.transaction_key, entry.hop.hop_id, entry.attempts) == ('t/1', second.hop.hop_id, 1)
+    outbox.close()
+
+
+def test_entries_are_given_up_after_max_attempts(tmp_path):
+    outbox = Outbox(str(tmp_path / 'outbox'), retry_base=0.001, retry_cap=0.001, max_attempts=2)
+    outbox.enqueue('t/1', [Hop(hop_id=2, node='Library A', action='add_loan', parameters=BORROW)])
+    for _ in range(2):
+        outbox.failed_entry(outbox.claim(timeout=1.0), 'refused')
+    assert outbox.claim(timeout=0.01) is None
+    assert outbox.stats()['pending'] == 0 and outbox.stats()['dead'] == 1
+    outbox.close()
+
+
+def test_a_repeated_piece_is_applied_once(start_servers):
+    servers, addresses = start_servers(BaseServer)
+    client = BaseClient(addresses, 1002, 'Library A')
+    hop = Hop(hop_id=2, node='Library A', action='add_loan', parameters=BORROW)
+    first = client.send_hop('Library A', hop, {'loan_id': 7}, dedup=('t/1', 2))
+    repeat = client.send_hop('Library A', hop, {'loan_id': 7}, dedup=('t/1', 2))
+    client.close()
+    assert first == repeat and first['status'] == 'Success'
+    assert loans('Library A') == [(7, 2001, 1002)]
+    assert servers['Library A'].metrics.snapshot()['counters']['dedup.repeats'] == 1
+
+
+def test_client_returns_after_the_first_piece_and_replicas_catch_up(start_servers, tmp_path):
+    servers, addresses = start_servers(BaseServer)
+    client = BaseClient(addresses, 1002, 'Library A', outbox=str(tmp_path / 'outbox'), retry_base=0.01, retry_cap=0.1)
+    assert client.borrow_book(1, BORROW)
+    assert client.flush_outbox(timeout=5)
+    client.close()
+    assert loans('Library A') == loans('Library B') == loans('Library C') == [(2, 2001, 1002)]
+
+
+def test_pending_pieces_are_sent_after_a_restart(start_servers, tmp_path):
+    servers, addresses = start_servers(BaseServer)
+    path = str(tmp_path / 'outbox')
+    # A client that stopped before delivering the later pieces of its borrow
+    outbox = Outbox(path)
+    hops = [Hop(hop_id=2, node='Library A', action='add_loan', parameters=BORROW),
+            Hop(hop_id=3, node='Library C', action='add_loan', parameters=BORROW)]
+    outbox.enqueue(f"{outbox.client_key}/1/x", hops, {'loan_id': 5})
+    with outbox.conn:
+        outbox.conn.execute("UPDATE Outbox SET next_attempt = ?", (time(),))
+    outbox.close()
+    client = BaseClient(addresses, 1002, 'Library A', outbox=path, retry_base=0.01, retry_cap=0.1)
+    assert client.flush_outbox(timeout=5)
+    assert client.outbox.stats()['delivered'] == 2
+    client.close()
+    assert loans('Library A') == loans('Library C') == [(5, 2001, 1002)]
+
+
+def test_entries_are_given_up_after_max_age(tmp_path):
+    outbox = Outbox(str(tmp_path / 'outbox'), retry_base=0.001, retry_cap=0.001, max_age=0.05)
+    outbox.enqueue('t/1', [Hop(hop_id=2, node='Library A', action='add_loan', parameters=BORROW)])
+    outbox.failed_entry(outbox.claim(timeout=1.0), 'refused')
+    sleep(0.05)
+    outbox.failed_entry(outbox.claim(timeout=1.0), 'refused')
+    assert outbox.claim(timeout=0.01) is None
+    assert outbox.stats()['dead'] == 1
+    outbox.close()
+
+
+def test_applied_pieces_are_forgotten_after_the_retention(start_servers):
+    servers, addresses = start_servers(BaseServer)
+    server = servers['Library A']
+    client = BaseClient(addresses, 1002, 'Library A')
+    hop = Hop(hop_id=2, node='Library A', action='add_loan', parameters=BORROW)
+    client.send_hop('Library A', hop, {'loan_id': 7}, dedup=('t/1', 2))
+    client.close()
+    assert server.sweep_applied_hops() == 0
+    server.dedup_retention = 0
+    assert server.sweep_applied_hops(batch_size=1) == 1
+    with sqlite3.connect('Library A') as conn:
+        assert conn.execute("SELECT COUNT(*) FROM AppliedHops").fetchone() == (0,)
+    assert server.metrics.snapshot()['counters']['dedup.expired'] == 1
@@ -0,0 +1,93 @@
+import sqlite3
+import threading
+from Database import create_database
+from Partition import RangeMap, HashRing, PartitionDirectory, DEFAULT_RANGES
+from Client import BaseClient
+from Server import BaseServer
+
+DATABASES = {name: name for name in ('Library A', 'Library B', 'Library C')}
+
+
+def test_range_map_lookup_and_assign():
+    ranges = RangeMap([[1000, 'A'], [2000, 'B'], [3000, 'C']])
+    assert [ranges.lookup(key) for key in (5, 1500, 2000, 2999, 9000)] == ['A', 'A', 'B', 'B', 'C']
+    ranges.assign(2500, 3000, 'C')
+    assert ranges.to_list() == [[1000, 'A'], [2000, 'B'], [2500, 'C']]
+    ranges.assign(2000, 2500, 'A')
+    # Neighbouring ranges with one owner are merged back together
+    assert ranges.to_list() == [[1000, 'A'], [2500, 'C']]
+
+
+def test_hash_ring_is_stable():
+    ring = HashRing(['A', 'B', 'C'])
+    assert [ring.lookup(key) for key in range(100)] == [HashRing(['A', 'B', 'C']).lookup(key) for key in range(100)]
+    assert {ring.lookup(key) for key in range(100)} == {'A', 'B', 'C'}
+
+
+def book_ids(db_name):
+    with sqlite3.connect(db_name) as conn:
+        return {row[0] for row in conn.execute("SELECT book_id FROM Books")}
+
+
+def test_move_publishes_routing_before_source_rows_disappear(libraries):
+    directory = PartitionDirectory(path=str(libraries / 'partitions.json'))
+    directory.save()
+    seen_at_publish = {}
+    save = directory.save
+
+    def observed_save():
+        # Other connections still see the rows at the source while the new epoch goes out
+        seen_at_publish['source'] = book_ids('Library B')
+        seen_at_publish['target'] = book_ids('Library C')
+        save()
+    directory.save = observed_save
+
+    assert directory.move_books(2000, 3000, 'Library C', DATABASES) == 3
+    assert seen_at_publish == {'source': {2001, 2002, 2003}, 'target': {3001, 3002, 3003}}
+    assert book_ids('Library B') == set()
+    assert book_ids('Library C') == {2001, 2002, 2003, 3001, 3002, 3003}
+    reloaded = PartitionDirectory.load(directory.path)
+    assert reloaded.epoch == 1
+    assert reloaded.node_for_book(2002) == 'Library C'
+
+
+def test_redirected_first_hop_replans_later_pieces(start_servers):
+    path = 'partitions.json'
+    PartitionDirectory(path=path).save()
+    servers, addresses = start_servers(BaseServer, directory=PartitionDirectory.load(path))
+    client = BaseClient(addresses, 1002, 'Library A', directory=PartitionDirectory.load(path))
+
+    PartitionDirectory.load(path).move_books(2000, 3000, 'Library C', DATABASES)
+    client.borrow_book(1, {'book_id': 2002, 'user_id': 1002, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'})
+
+    assert client.directory.epoch == 1
+    for db_name in ('Library A', 'Library B', 'Library C'):
+        with sqlite3.connect(db_name) as conn:
+            assert conn.execute("SELECT book_id, user_id FROM Loans").fetchall() == [(2002, 1002)], db_name
+    client.close()
+
+
+def test_loans_reach_every_replica_of_the_directory(start_servers):
+    create_database('Library D', 4000)
+    servers, addresses = start_servers(BaseServer)
+    extra = BaseServer('localhost', 0, 'Library D')
+    threading.Thread(target=extra.start, daemon=True).start()
+    addresses = dict(addresses, **{'Library D': extra.socket.getsockname()})
+    borrow = {'user_id': 1002, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'}
+
+    four = PartitionDirectory(nodes=list(addresses), book_ranges=DEFAULT_RANGES + [[4000, 'Library D']])
+    client = BaseClient(addresses, 1002, 'Library A', directory=four)
+    assert client.borrow_book(1, dict(borrow, book_id=1001))
+    assert client.return_book(2, {'book_id': 1001, 'return_date': '2023-02-10'})
+    client.close()
+    for db_name in addresses:
+        with sqlite3.connect(db_name) as conn:
+            assert conn.execute("SELECT book_id, return_date FROM Loans").fetchall() == [(1001, '2023-02-10')], db_name
+
+    two = PartitionDirectory(nodes=['Library A', 'Library B'], book_ranges=[[1000, 'Library A'], [2000, 'Library B']])
+    client = BaseClient(addresses, 1002, 'Library A', directory=two)
+    assert client.borrow_book(3, dict(borrow, book_id=2001))
+    client.close()
+    for db_name, expected in (('Library A', 1), ('Library B', 1), ('Library C', 0), ('Library D', 0)):
+        with sqlite3.connect(db_name) as conn:
+            assert conn.execute("SELECT COUNT(*) FROM Loans WHERE book_id = 2001").fetchone() == (expected,), db_name
@@ -0,0 +1,68 @@
+import socket
+import threading
+import pytest
+from Hop import Hop
+from Transaction import Transaction
+from Protocol import (encode, decode, FramedChannel, connect_channel, ProtocolError,
+                      CHUNK_SIZE, MSG_REQUEST, MSG_PING)
+
+
+def test_codec_round_trip():
+    message = {'n': None, 'flags': [True, False], 'small': -7, 'big': 2**80, 'pi': 3.5,
+               'text': 'héllo', 'raw': b'\x00\x01', 'pair': (1, 'a'), 'nested': {'k': [{}]}}
+    assert decode(encode(message)) == message
+
+
+def test_codec_round_trip_hops_and_transactions():
+    hops = [Hop(1, 'Library A', 'borrow_book', {'book_id': 1001}, 7),
+            Hop(2, 'Library B', 'add_loan', {'book_id': 1001})]
+    transaction = decode(encode(Transaction(5, 'borrow_book', hops, 7)))
+    assert (transaction.transaction_id, transaction.type, transaction.sequence_number) == (5, 'borrow_book', 7)
+    assert [(h.hop_id, h.node, h.action, h.parameters, h.sequence_number) for h in transaction.hops] == \
+           [(1, 'Library A', 'borrow_book', {'book_id': 1001}, 7), (2, 'Library B', 'add_loan', {'book_id': 1001}, None)]
+
+
+def test_decode_rejects_trailing_bytes():
+    with pytest.raises(ProtocolError):
+        decode(encode(1) + b'N')
+
+
+def test_framed_channel_streams_large_messages_and_answers_pings():
+    left, right = socket.socketpair()
+    sender, receiver = FramedChannel(left), FramedChannel(right)
+    payload = {'data': b'x' * (3 * CHUNK_SIZE + 17)}
+    try:
+        sender.send(MSG_PING, 9, None)
+        sender.send(MSG_REQUEST, 4, payload)
+        assert receiver.recv() == (MSG_REQUEST, 4, payload)
+        # The ping was answered by the receiving channel itself
+        assert sender.recv()[:2] == (5, 9)
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def listen_once(handler):
+    listener = socket.create_server(('localhost', 0))
+
+    def serve():
+        conn, _ = listener.accept()
+        handler(conn)
+        conn.close()
+        listener.close()
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()
+
+
+def test_connect_channel_falls_back_only_when_hello_is_rejected():
+    # An old pickle server reads the HELLO frame, fails to unpickle it and hangs up
+    address = listen_once(lambda conn: conn.recv(1024))
+    assert connect_channel(address) is None
+
+
+def test_connect_channel_raises_on_transient_errors():
+    listener = socket.create_server(('localhost', 0))
+    address = listener.getsockname()
+    listener.close()
+    with pytest.raises(ConnectionError):
+        connect_channel(address)
@@ -0,0 +1,67 @@
+import sqlite3
+import threading
+from Client import BaseClient
+from ReadCache import ReadCache
+from Server import BaseServer
+
+
+BORROW = {'book_id': 1001, 'user_id': 1001, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'}
+
+
+def uncached_loans(db_name):
+    with sqlite3.connect(db_name) as conn:
+        return conn.execute("SELECT * FROM Loans WHERE loan_id IN (SELECT loan_id FROM Books WHERE status = 'Borrowed')").fetchall()
+
+
+def test_user_lru_is_bounded_and_counts_hits():
+    cache = ReadCache(max_users=2)
+    for user_id in (1, 2, 3):
+        _, generation = cache.get_user(user_id)
+        cache.put_user(user_id, (user_id, 'User'), generation)
+    assert cache.get_user(1)[0] is None
+    assert cache.get_user(3)[0] == (3, 'User')
+    stats = cache.stats()
+    assert stats['users'] == 2 and stats['user_hits'] == 1 and stats['user_misses'] == 4
+
+
+def test_reads_racing_a_write_are_not_cached():
+    cache = ReadCache()
+    _, generation = cache.get_user(1)
+    cache.apply('add_user', {'user_id': 1}, {"status": "Success"})
+    cache.put_user(1, (1, 'Old'), generation)
+    assert cache.get_user(1)[0] is None
+
+
+def test_outstanding_loans_follow_the_writes(libraries):
+    server = BaseServer('localhost', 0, 'Library A')
+    track = lambda: server.execute_action('Library A', 'track_loans', {}).get('data', [])
+    assert track() == []
+    loan_id = server.execute_action('Library A', 'borrow_book', BORROW)['return_value']['loan_id']
+    assert track() == uncached_loans('Library A') == [(loan_id, 1001, 1001, '2023-02-01', None, '2023-03-01')]
+    # A failed borrow is rolled back and never reaches the cache
+    assert server.execute_action('Library A', 'borrow_book', BORROW)['status'] == 'Failed'
+    assert track() == uncached_loans('Library A')
+    server.execute_action('Library A', 'return_book', {'book_id': 1001, 'return_date': '2023-02-10'})
+    assert track() == uncached_loans('Library A') == []
+    stats = server.cache.stats()
+    assert stats['loan_misses'] == 1 and stats['loan_hits'] == 3
+
+
+def test_group_commit_keeps_the_cache_consistent(libraries):
+    server = BaseServer('localhost', 0, 'Library A', group_commit=True)
+    server.execute_action('Library A', 'track_loans', {})
+    server.submit_action('Library A', 'borrow_book', BORROW)
+    assert server.execute_action('Library A', 'track_loans', {})['data'] == uncached_loans('Library A')
+
+
+def test_cache_can_be_switched_off(start_servers):
+    servers, addresses = start_servers(BaseServer, read_cache=False)
+    client = BaseClient(addresses, 1001, 'Library A')
+    threads = [threading.Thread(target=client.query_user, args=(n, {'user_id': 1001})) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    client.close()
+    stats = servers['Library A'].cache.stats()
+    assert not stats['enabled'] and stats['users'] == 0 and stats['user_misses'] == 0
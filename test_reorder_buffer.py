@@ -0,0 +1,84 @@
+import sqlite3
+from time import monotonic, sleep
+from ReorderBuffer import ReorderBuffer
+from Client import OriginOrderClient
+from Server import OriginOrderServer
+
+
+def recording_buffer(gap_timeout=0.05):
+    applied = []
+    buffer = ReorderBuffer(lambda batch: applied.append([item for item in batch if item is not None]),
+                           gap_timeout=gap_timeout)
+    return buffer, applied
+
+
+def test_chained_hops_run_at_once_despite_unused_numbers():
+    buffer, applied = recording_buffer(gap_timeout=60)
+    # Numbers 2-64 went to other nodes or stayed unused in a leased block
+    buffer.submit(1, None, 'a')
+    buffer.submit(65, 1, 'b')
+    buffer.submit(130, 65, 'c')
+    assert applied == [['a'], ['b'], ['c']]
+
+
+def test_out_of_order_hops_are_released_in_stream_order():
+    buffer, applied = recording_buffer(gap_timeout=60)
+    buffer.submit(9, 5, 'c')
+    buffer.submit(5, 3, 'b')
+    assert applied == []
+    buffer.submit(3, None, 'a')
+    assert applied == [['a', 'b', 'c']]
+    assert buffer.stats()['depth'] == 0
+
+
+def test_placeholders_advance_the_stream():
+    buffer, applied = recording_buffer(gap_timeout=60)
+    buffer.submit(4, 2, 'b')
+    buffer.submit(2, None, None)
+    assert applied == [['b']]
+
+
+def test_missing_predecessor_is_given_up_and_rejected_when_late():
+    buffer, applied = recording_buffer(gap_timeout=0.2)
+    buffer.submit(1, None, 'a')
+    buffer.submit(7, 4, 'c')
+    assert buffer.check_gaps() is False
+    sleep(0.25)
+    assert buffer.check_gaps() is True
+    assert applied == [['a'], ['c']]
+    # Number 4 finally shows up after hop 7 already ran in its place
+    assert buffer.submit(4, 1, 'b') is False
+    assert applied == [['a'], ['c']]
+    assert buffer.stats()['late'] == 1 and buffer.stats()['gap_timeouts'] == 1
+
+
+def test_retry_of_released_hop_runs_again():
+    buffer, applied = recording_buffer(gap_timeout=60)
+    buffer.submit(1, None, 'a')
+    buffer.submit(3, 1, 'b')
+    assert buffer.submit(1, None, 'a-retry') is True
+    assert applied == [['a'], ['b'], ['a-retry']]
+    assert buffer.stats()['retries'] == 1
+
+
+def loans(db_name):
+    with sqlite3.connect(db_name) as conn:
+        return conn.execute("SELECT book_id, return_date FROM Loans ORDER BY loan_id").fetchall()
+
+
+def test_leased_client_is_not_held_up_by_gaps_or_aborts(start_servers):
+    _, addresses = start_servers(OriginOrderServer, gap_timeout=5.0)
+    client = OriginOrderClient(addresses, 1002, 'Library A', lease_size=8)
+    # Another client of the same library takes numbers from the allocator in between
+    OriginOrderClient(addresses, 1003, 'Library A', lease_size=8).get_sequence_number()
+
+    started = monotonic()
+    client.borrow_book(1, {'book_id': 1001, 'user_id': 1002, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'})
+    # Aborts at the owner, so the replicas are told to skip it
+    client.borrow_book(2, {'book_id': 1001, 'user_id': 1002, 'borrow_date': '2023-02-02', 'due_date': '2023-03-02'})
+    client.return_book(3, {'book_id': 1001, 'return_date': '2023-02-10'})
+    assert monotonic() - started < 2.0
+
+    for db_name in ('Library A', 'Library B', 'Library C'):
+        assert loans(db_name) == [(1001, '2023-02-10')], db_name
+    client.close()
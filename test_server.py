@@ -0,0 +1,130 @@
+import socket
+import sqlite3
+import threading
+from time import monotonic, sleep
+from Hop import Hop
+from Transaction import Transaction
+from Client import BaseClient
+from Server import BaseServer, OriginOrderServer
+
+
+class RecordingChannel:
+    def __init__(self):
+        self.responses = {}
+
+    def send(self, msg_type, request_id, message):
+        self.responses[request_id] = message
+
+
+def test_return_book_of_unknown_book_fails_cleanly(libraries):
+    server = OriginOrderServer('localhost', 0, 'Library A')
+    result = server.execute_action('Library A', 'return_book', {'book_id': 999999, 'return_date': '2023-02-10'})
+    assert result['status'] == 'Failed'
+
+
+def test_apply_batch_answers_every_hop_when_one_raises(libraries):
+    server = OriginOrderServer('localhost', 0, 'Library A')
+    channel = RecordingChannel()
+    batch = [
+        (Hop(1, 'Library A', 'query_user', {'user_id': 1001}), None, channel, 1),
+        # add_loan without a return value raises inside run_action
+        (Hop(2, 'Library A', 'add_loan', {'book_id': 1001, 'user_id': 1001,
+                                          'borrow_date': '2023-02-01', 'due_date': '2023-03-01'}), None, channel, 2),
+        (Hop(3, 'Library A', 'query_user', {'user_id': 1002}), None, channel, 3),
+    ]
+    server.apply_batch(batch)
+    assert [channel.responses[i]['status'] for i in (1, 2, 3)] == ['Success', 'Failed', 'Success']
+
+
+def test_apply_batch_answers_every_hop_with_group_commit(libraries):
+    server = OriginOrderServer('localhost', 0, 'Library A', group_commit=True)
+    channel = RecordingChannel()
+    batch = [
+        (Hop(1, 'Library A', 'return_book', {'book_id': 999999, 'return_date': '2023-02-10'}), None, channel, 1),
+        (Hop(2, 'Library A', 'delete_book', {'book_id': 1001}), None, channel, 2),
+    ]
+    server.apply_batch(batch)
+    assert [channel.responses[i]['status'] for i in (1, 2)] == ['Failed', 'Success']
+
+
+def loan_count(db_name):
+    with sqlite3.connect(db_name) as conn:
+        return conn.execute("SELECT COUNT(*) FROM Loans").fetchone()[0]
+
+
+def test_many_concurrent_chains_forward_without_deadlock(start_servers):
+    servers, addresses = start_servers(BaseServer)
+    owner = servers['Library A']
+    for book_id in range(1100, 1132):
+        owner.execute_action('Library A', 'add_book', {'book_id': book_id, 'title': 'T', 'author': 'A',
+                                                       'publication_date': '2023-01-01', 'category': 'Fiction',
+                                                       'status': 'Available'})
+    client = BaseClient(addresses, 1002, 'Library A', chained=True, chain_ack='first')
+    threads = [threading.Thread(target=client.borrow_book, args=(book_id, {
+        'book_id': book_id, 'user_id': 1002, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'}))
+        for book_id in range(1100, 1132)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    deadline = monotonic() + 10
+    while monotonic() < deadline and (loan_count('Library B'), loan_count('Library C')) != (32, 32):
+        sleep(0.05)
+    assert (loan_count('Library A'), loan_count('Library B'), loan_count('Library C')) == (32, 32, 32)
+    client.close()
+
+
+def test_forward_hop_retries_an_unreachable_peer(libraries, monkeypatch):
+    monkeypatch.setattr('Server.sleep', lambda seconds: None)
+    listener = socket.create_server(('localhost', 0))
+    dead_address = listener.getsockname()
+    listener.close()
+    server = BaseServer('localhost', 0, 'Library A', peers={'Library B': dead_address})
+    attempts = []
+    peer_pool = server.peer_pool
+
+    def counted_peer_pool(node):
+        attempts.append(node)
+        return peer_pool(node)
+    server.peer_pool = counted_peer_pool
+
+    hop = Hop(2, 'Library B', 'add_loan', {'book_id': 1001, 'user_id': 1001,
+                                           'borrow_date': '2023-02-01', 'due_date': '2023-03-01'})
+    response = server.forward_hop(Transaction(1, 'borrow_book', [hop]), hop, {'loan_id': 1})
+    assert response['status'] == 'Failed'
+    assert attempts == ['Library B'] * server.max_retries
+
+
+def test_handlers_turn_check_then_act_into_conditional_writes(libraries):
+    server = BaseServer('localhost', 0, 'Library A')
+    statements = []
+    with server.pool.connection() as conn:
+        conn.set_trace_callback(statements.append)
+        borrow = {'book_id': 1001, 'user_id': 1001, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'}
+        result = server.run_action(conn, 'borrow_book', borrow)
+        assert result['status'] == 'Success'
+        # One INSERT, the loan id high-water mark and one conditional UPDATE, where there used to
+        # be two SELECTs before them
+        assert [sql.split()[0] for sql in statements if not sql.startswith('BEGIN')] == ['INSERT', 'UPDATE', 'UPDATE']
+        assert server.run_action(conn, 'borrow_book', borrow)['message'] == "Book 1001 is not available"
+        loan_id = server.run_action(conn, 'track_loans', {})['data'][0][0]
+        statements.clear()
+        result = server.run_action(conn, 'return_book', {'book_id': 1001, 'return_date': '2023-02-10'})
+        assert result['return_value'] == {'loan_id': loan_id}
+        assert len([sql for sql in statements if not sql.startswith('BEGIN')]) == 2
+        assert server.run_action(conn, 'return_book', {'book_id': 1001, 'return_date': '2023-02-10'})['message'] \
+            == "Book 1001 is not borrowed"
+        conn.set_trace_callback(None)
+        conn.rollback()
+
+
+def test_handlers_report_failures(libraries):
+    server = BaseServer('localhost', 0, 'Library A')
+    book = {'book_id': 1001, 'title': 'Book 1', 'author': 'Author 1', 'publication_date': '2023-01-01',
+            'category': 'Fiction', 'status': 'Available'}
+    assert server.execute_action('Library A', 'add_book', book)['message'] == "Book 1001 already exists"
+    assert server.execute_action('Library A', 'query_user', {'user_id': 999999})['status'] == 'Failed'
+    assert server.execute_action('Library A', 'update_loan', {'return_date': '2023-02-10'},
+                                 {'loan_id': 999999})['status'] == 'Failed'
+    assert server.execute_action('Library A', 'no_such_action', {}) == {"status": "Unknown action"}
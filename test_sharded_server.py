@@ -0,0 +1,106 @@
+import sqlite3
+import pytest
+from Client import BaseClient
+from Database import split_database
+from Hop import Hop
+from Partition import RangeMap
+from ShardedServer import ShardedServer, shard_files
+
+BOOK = {'title': 'Book', 'author': 'Author', 'publication_date': '2023-01-01', 'category': 'Fiction',
+        'status': 'Available'}
+
+
+def rows(db_name, sql):
+    with sqlite3.connect(db_name) as conn:
+        return conn.execute(sql).fetchall()
+
+
+@pytest.fixture
+def sharded(start_servers):
+    started = []
+
+    def start(**kwargs):
+        servers, addresses = start_servers(ShardedServer, subshards=2, **kwargs)
+        started.extend(servers.values())
+        return servers, addresses
+    yield start
+    for server in started:
+        server.close()
+
+
+def test_split_database_routes_rows_and_loans_follow_their_book(libraries):
+    with sqlite3.connect('Library A') as conn:
+        conn.execute("INSERT INTO Loans VALUES (7, 1003, 1001, '2023-02-01', NULL, '2023-03-01')")
+    halves = RangeMap([[1000, 0], [1002, 1]])
+    split_database('Library A', ['a0', 'a1'], halves.lookup, halves.lookup)
+    assert rows('a0', "SELECT book_id FROM Books") == [(1001,)]
+    assert rows('a1', "SELECT book_id FROM Books ORDER BY book_id") == [(1002,), (1003,)]
+    assert rows('a0', "SELECT user_id FROM Users") == [(1001,)]
+    assert rows('a1', "SELECT loan_id, book_id FROM Loans") == [(7, 1003)]
+    assert rows('a0', "SELECT COUNT(*) FROM Loans") == [(0,)]
+    assert rows('a1', "PRAGMA user_version") == rows('Library A', "PRAGMA user_version")
+
+
+def test_hops_run_on_the_owning_worker_and_loans_are_gathered(sharded):
+    servers, addresses = sharded()
+    client = BaseClient(addresses, 1001, 'Library A')
+    # Library A's ids 1000-1999 are split at 1500 between its two workers
+    assert client.add_book(1, dict(BOOK, book_id=1600))
+    assert client.borrow_book(2, {'book_id': 1001, 'user_id': 1001, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'})
+    assert client.borrow_book(3, {'book_id': 1600, 'user_id': 1002, 'borrow_date': '2023-02-02', 'due_date': '2023-03-02'})
+    low, high = shard_files('Library A', 2)
+    assert rows(high, "SELECT book_id FROM Books WHERE book_id = 1600") == [(1600,)]
+    assert rows(low, "SELECT book_id FROM Books WHERE book_id = 1600") == []
+    # The two workers hand out different loan ids
+    [(first,)], [(second,)] = rows(low, "SELECT loan_id FROM Loans"), rows(high, "SELECT loan_id FROM Loans")
+    assert first != second
+
+    hop = Hop(hop_id=1, node='Library A', action='track_loans', parameters={'limit': 1})
+    page = client.send_hop('Library A', hop)
+    assert [row[0] for row in page['data']] == [min(first, second)] and page['next'] == min(first, second)
+    hop.parameters = {}
+    assert sorted(row[1] for row in client.send_hop('Library A', hop)['data']) == [1001, 1600]
+    # The replica copies landed with their books in Library B's workers too
+    assert sorted(loan_id for name in shard_files('Library B', 2)
+                  for loan_id, in rows(name, "SELECT loan_id FROM Loans")) == sorted([first, second])
+
+    # update_loan names only the loan, and is found by asking every worker
+    assert client.return_book(4, {'book_id': 1600, 'return_date': '2023-02-10'})
+    assert sum(count for name in shard_files('Library B', 2)
+               for count, in rows(name, "SELECT COUNT(*) FROM Loans WHERE return_date IS NOT NULL")) == 1
+    assert client.query_user(5, {'user_id': 1002})
+    client.close()
+    stats = servers['Library A'].subshard_stats()
+    assert stats['alive'] == 2 and all(stats['routed'].values())
+
+
+def test_bulk_loads_are_split_between_workers(sharded):
+    servers, addresses = sharded()
+    client = BaseClient(addresses, 1001, 'Library A')
+    books = [dict(BOOK, book_id=book_id) for book_id in (1400, 1401, 1700, 1001)]
+    reports = []
+    summary = client.bulk_add_books(1, books, on_chunk=reports.append)
+    client.close()
+    assert (summary['added'], summary['duplicates']) == (3, 1)
+    assert [report['duplicates'] for report in reports] == [[1001]]
+    low, high = shard_files('Library A', 2)
+    assert rows(low, "SELECT COUNT(*) FROM Books WHERE book_id IN (1400, 1401)") == [(2,)]
+    assert rows(high, "SELECT COUNT(*) FROM Books WHERE book_id = 1700") == [(1,)]
+
+
+def test_worker_loan_ids_stay_clear_of_replicated_loans(sharded):
+    servers, addresses = sharded()
+    borrow = {'user_id': 2001, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'}
+    client = BaseClient(addresses, 2001, 'Library B')
+    # Replicated to Library A's second worker, which holds the ids above A's own range
+    for t_id, book_id in enumerate((2001, 2002, 2003), start=1):
+        assert client.borrow_book(t_id, dict(borrow, book_id=book_id))
+    # Then Library A's first worker lends, and replicates to B and C
+    assert client.borrow_book(4, dict(borrow, book_id=1001))
+    assert client.return_book(5, {'book_id': 1001, 'return_date': '2023-02-10'})
+    client.close()
+    for name in servers:
+        loans = sorted(row for path in shard_files(name, 2)
+                       for row in rows(path, "SELECT loan_id, book_id, return_date FROM Loans"))
+        assert len({loan_id for loan_id, _, _ in loans}) == 4, name
+        assert [(book_id, return_date) for _, book_id, return_date in loans if book_id == 1001] == [(1001, '2023-02-10')]
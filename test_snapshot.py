@@ -0,0 +1,99 @@
+import os
+import sqlite3
+from time import monotonic, sleep
+from ChangeLog import ChangeLog
+from Client import BaseClient
+from ConnectionPool import ConnectionPool
+from DatabasePool import DatabasePool
+from Server import BaseServer
+from Snapshot import fetch_snapshot, restore_snapshot
+
+BORROW = {'user_id': 1002, 'borrow_date': '2023-02-01', 'due_date': '2023-03-01'}
+
+
+def loans(db_name):
+    with sqlite3.connect(db_name) as conn:
+        return conn.execute("SELECT loan_id, book_id, user_id FROM Loans ORDER BY loan_id").fetchall()
+
+
+def wait_for(condition, timeout=5):
+    deadline = monotonic() + timeout
+    while not condition():
+        assert monotonic() < deadline
+        sleep(0.02)
+
+
+def test_snapshot_streams_in_chunks_and_restores(start_servers):
+    servers, addresses = start_servers(BaseServer)
+    client = BaseClient(addresses, 1002, 'Library A')
+    assert client.borrow_book(1, dict(BORROW, book_id=1001))
+    pool = ConnectionPool('Library A', addresses['Library A'])
+    position = fetch_snapshot(pool, 'copy', chunk_size=4096)
+    pool.close()
+    client.close()
+    assert position['size'] == os.path.getsize('copy') > 4096
+    assert servers['Library A'].snapshots.stats() == {"open": 0, "taken": 1, "served_bytes": position['size']}
+    assert not [name for name in os.listdir('.') if '.snapshot-' in name]
+    assert restore_snapshot('copy', 'Library A restored') == (0, {})
+    assert loans('Library A restored') == loans('Library A') == [(1, 1001, 1002)]
+
+
+def test_restored_node_catches_up_from_its_cursors(start_servers):
+    servers, addresses = start_servers(BaseServer, change_log=True, log_poll_interval=0.01)
+    client = BaseClient(addresses, 1002, 'Library A', replication='log')
+    assert client.borrow_book(1, dict(BORROW, book_id=2001))
+    wait_for(lambda: loans('Library A') == loans('Library B'))
+    pool = ConnectionPool('Library A', addresses['Library A'])
+    position = fetch_snapshot(pool, 'copy')
+    pool.close()
+    assert position['cursors']['Library B'] == 1
+    # Written after the snapshot was taken, so the restored node only sees it through the log
+    assert client.borrow_book(2, dict(BORROW, book_id=3001))
+    client.close()
+    restore_snapshot('copy', 'Library A restored')
+    assert len(loans('Library A restored')) == 1
+    restored = BaseServer('localhost', 0, 'Library A restored', change_log=True, log_poll_interval=0.01,
+                          peers={name: address for name, address in addresses.items() if name != 'Library A'})
+    try:
+        wait_for(lambda: loans('Library A restored') == loans('Library C'))
+    finally:
+        restored.replicator.stop()
+
+
+def test_log_keeps_entries_for_the_retention_window(libraries):
+    pool = DatabasePool('Library A', size=1)
+    log = ChangeLog(pool)
+    with pool.connection() as conn:
+        for loan_id in (1, 2, 3):
+            ChangeLog.append(conn.cursor(), 'borrow', loan_id, 1001)
+        conn.commit()
+    log.read('Library B', 3, 10)
+    # Every peer has the entries, but a snapshot taken a moment ago may not
+    assert log.compact(['Library B']) == 0
+    assert [entry[0] for entry in log.read('Library C', 0, 10)['entries']] == [1, 2, 3]
+    log.retention = 0
+    assert log.compact(['Library B']) == 3
+
+
+def test_log_refuses_a_peer_behind_the_compacted_prefix(libraries):
+    pool = DatabasePool('Library A', size=1)
+    log = ChangeLog(pool, retention=0)
+    with pool.connection() as conn:
+        for loan_id in (1, 2, 3):
+            ChangeLog.append(conn.cursor(), 'borrow', loan_id, 1001)
+        conn.commit()
+    log.read('Library B', 2, 10)
+    assert log.compact(['Library B']) == 2
+    assert log.read('Library C', 0, 10)['status'] == 'Failed'
+    assert [entry[0] for entry in log.read('Library B', 2, 10)['entries']] == [3]
+
+
+def test_memory_mode_writes_back_on_checkpoint(start_servers):
+    servers, addresses = start_servers(BaseServer, memory=True)
+    client = BaseClient(addresses, 1002, 'Library A')
+    assert client.borrow_book(1, dict(BORROW, book_id=1001))
+    client.close()
+    assert loans('Library A') == []
+    servers['Library A'].checkpoint()
+    assert loans('Library A') == [(1, 1001, 1002)]
+    assert servers['Library A'].metrics.snapshot()['timers']['checkpoint']['count'] == 1
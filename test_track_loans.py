@@ -0,0 +1,66 @@
+import sqlite3
+from Client import BaseClient
+from Database import MIGRATIONS, migrate_database
+from Server import BaseServer, SQL_LOANS_PAGE
+
+
+def borrow_many(server, count):
+    # Books 1100.. are borrowed by users 1001/1002 in turn, due on consecutive days of March
+    books = [{'book_id': 1100 + n, 'title': f'Book {n}', 'author': 'Author', 'publication_date': '2023-01-01',
+              'category': 'Fiction', 'status': 'Available'} for n in range(count)]
+    server.execute_action('Library A', 'bulk_add_books', {'books': books})
+    for n in range(count):
+        server.execute_action('Library A', 'borrow_book', {'book_id': 1100 + n, 'user_id': 1001 + n % 2,
+                                                           'borrow_date': '2023-02-01',
+                                                           'due_date': f'2023-03-{n % 28 + 1:02d}'})
+
+
+def test_migrations_add_the_indexes_once(libraries):
+    with sqlite3.connect('Library A') as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+        indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        conn.execute("DROP INDEX idx_books_status_loan")
+        conn.execute("PRAGMA user_version = 0")
+    assert {'idx_books_status_loan', 'idx_books_loan', 'idx_loans_user', 'idx_loans_return_due'} <= indexes
+    assert migrate_database('Library A') == len(MIGRATIONS)
+    assert migrate_database('Library A') == 0
+    with sqlite3.connect('Library A') as conn:
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {SQL_LOANS_PAGE} ORDER BY b.loan_id LIMIT 10", (0,)).fetchall()
+    assert 'idx_books_status_loan' in plan[0][3]
+
+
+def test_pages_follow_the_keyset_cursor(libraries):
+    server = BaseServer('localhost', 0, 'Library A')
+    borrow_many(server, 25)
+    pages = []
+    after = 0
+    while after is not None:
+        result = server.execute_action('Library A', 'track_loans', {'after': after, 'limit': 10})
+        pages.append(result['data'])
+        after = result['next']
+    assert [len(page) for page in pages] == [10, 10, 5]
+    loan_ids = [row[0] for page in pages for row in page]
+    assert loan_ids == sorted(loan_ids) and len(set(loan_ids)) == 25
+    # The paged listing agrees with the full one
+    assert [row[0] for row in server.execute_action('Library A', 'track_loans', {})['data']] == loan_ids
+
+
+def test_filters(libraries):
+    server = BaseServer('localhost', 0, 'Library A')
+    borrow_many(server, 10)
+    page = lambda **filters: server.execute_action('Library A', 'track_loans', filters)['data']
+    assert {row[2] for row in page(user_id=1002)} == {1002} and len(page(user_id=1002)) == 5
+    assert [row[5] for row in page(due_before='2023-03-04')] == ['2023-03-01', '2023-03-02', '2023-03-03']
+    assert len(page(overdue=True, today='2023-03-06')) == 5
+    assert len(page(overdue=True, today='2023-03-06', user_id=1001)) == 3
+
+
+def test_client_streams_loans(start_servers):
+    servers, addresses = start_servers(BaseServer)
+    borrow_many(servers['Library A'], 12)
+    client = BaseClient(addresses, 1001, 'Library A')
+    loans = list(client.iter_loans(page_size=5))
+    overdue = list(client.iter_loans(page_size=2, overdue=True, today='2023-03-03'))
+    client.close()
+    assert len(loans) == 12
+    assert [row[5] for row in overdue] == ['2023-03-01', '2023-03-02']